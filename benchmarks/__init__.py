@@ -0,0 +1,9 @@
+"""
+Benchmarks package.
+
+Trees are synthesized by `generators`, `dataset` and `endpoints`
+load test the running app, others compare DB strategies.
+
+Run from the repository root with the core modules on the path, e.g.
+`PYTHONPATH=core python -m benchmarks.drivers --env test`.
+"""
@@ -0,0 +1,101 @@
+"""
+Load a synthetic dataset for the endpoints benchmark.
+
+Creates benchmark users, a post with a tree of every shape(see `generators`)
+and Zipf-skewed hot posts, a few million rows with the defaults, then writes
+a manifest with their IDs for `benchmarks.endpoints`.
+The data is loaded into the database of the given env, don't use the dev one.
+
+    PYTHONPATH=core python -m benchmarks.dataset --env test
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from benchmarks.generators import SHAPES, create_post, load_tree, random_tree, zipf_sizes
+from db import close_pg, init_pg
+from settings import config
+
+
+# comment IDs of every tree kept in the manifest to address requests
+SAMPLE_SIZE = 100
+
+
+async def create_users(conn, count):
+    users = ['bench_user{}'.format(i) for i in range(count)]
+    await conn.execute(
+        """
+        INSERT INTO users(username, first_name, second_name)
+        SELECT u, %s, %s FROM unnest(%s::varchar[]) as u
+        ON CONFLICT DO NOTHING
+        """,
+        ('bench', 'bench', users)
+    )
+    return users
+
+
+async def load_post(conn, user, parents, batch_size, rnd):
+    start = time.perf_counter()
+    post_id = await create_post(conn, user)
+    ids = await load_tree(conn, user, post_id, parents, batch_size)
+    elapsed = time.perf_counter() - start
+    # comments with children, trees of the leaves are not found
+    parent_ids = [ids[i] for i in set(parents) if i is not None]
+    return {
+        'post_id': post_id,
+        'user': user,
+        'size': len(ids),
+        'comment_ids': rnd.sample(ids, min(SAMPLE_SIZE, len(ids))),
+        'parent_ids': rnd.sample(parent_ids, min(SAMPLE_SIZE, len(parent_ids))),
+        'load_seconds': round(elapsed, 3),
+    }
+
+
+async def main(args):
+    rnd = random.Random(args.seed)
+    app = {'config': config}
+    await init_pg(app, args.env)
+    manifest = {'env': args.env, 'shapes': {}, 'hot_posts': []}
+    try:
+        async with app['db'].acquire() as conn:
+            users = manifest['users'] = await create_users(conn, args.users)
+            sizes = {'deep_chain': args.chain_size}
+            for shape, generate in sorted(SHAPES.items()):
+                parents = generate(sizes.get(shape, args.shape_size))
+                post = await load_post(conn, rnd.choice(users), parents, args.batch_size, rnd)
+                manifest['shapes'][shape] = post
+                print('{:<12}{:>10} comments {:>10.1f}s'.format(
+                    shape, post['size'], post['load_seconds']))
+            start = time.perf_counter()
+            for size in zipf_sizes(args.zipf_comments, args.zipf_posts, args.zipf_s):
+                parents = random_tree(size, fanout=min(size, 50), rnd=rnd)
+                post = await load_post(conn, rnd.choice(users), parents, args.batch_size, rnd)
+                manifest['hot_posts'].append(post)
+            print('{:<12}{:>10} comments {:>10.1f}s'.format(
+                'zipf', args.zipf_comments, time.perf_counter() - start))
+    finally:
+        await close_pg(app)
+    with open(args.manifest, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print('manifest is written to {}'.format(args.manifest))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--env', default='test')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--shape-size', type=int, default=200000,
+                        help='comments of the balanced, wide flat and random trees')
+    parser.add_argument('--chain-size', type=int, default=2000,
+                        help='comments of the deep chain, it costs O(n^2) closure rows')
+    parser.add_argument('--zipf-posts', type=int, default=1000)
+    parser.add_argument('--zipf-comments', type=int, default=1000000)
+    parser.add_argument('--zipf-s', type=float, default=1.1)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--manifest', default='benchmarks/dataset.json')
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(parser.parse_args()))
@@ -0,0 +1,69 @@
+"""
+Benchmark of DB drivers on the tree and first level queries.
+
+Loads a tree of comments under a post, then runs `db_get_full_tree` and
+`db_get_1lvl_comments_page` with every driver and prints the timings.
+The data is loaded into the database of the given env, so use the test one.
+"""
+
+import argparse
+import asyncio
+import copy
+import time
+
+from benchmarks.generators import create_post, load_tree, random_tree
+from db import close_pg, db_get_1lvl_comments_page, db_get_full_tree, init_pg
+from drivers import DRIVERS
+from settings import config
+
+
+async def timeit(coro_factory, iterations):
+    """Return mean time of the coroutine in ms."""
+    await coro_factory()  # warm up, e.g. prepare statements
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await coro_factory()
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+async def bench_driver(env, driver, post_id, iterations):
+    app = {'config': copy.deepcopy(config)}
+    app['config'][env]['postgres']['driver'] = driver
+    await init_pg(app, env)
+    try:
+        async with app['db'].acquire() as conn:
+            tree = await timeit(
+                lambda: db_get_full_tree(conn, 'post', post_id), iterations)
+            lvl1 = await timeit(
+                lambda: db_get_1lvl_comments_page(conn, 'post', post_id, limit=20),
+                iterations)
+    finally:
+        await close_pg(app)
+    return tree, lvl1
+
+
+async def main(args):
+    app = {'config': config}
+    await init_pg(app, args.env)
+    try:
+        async with app['db'].acquire() as conn:
+            post_id = await create_post(conn, args.user)
+            await load_tree(conn, args.user, post_id, random_tree(args.size, args.fanout))
+    finally:
+        await close_pg(app)
+    print('{:<10}{:>12}{:>12}'.format('driver', 'tree, ms', 'lvl1, ms'))
+    for driver in args.drivers:
+        tree, lvl1 = await bench_driver(args.env, driver, post_id, args.iterations)
+        print('{:<10}{:>12.2f}{:>12.2f}'.format(driver, tree, lvl1))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--env', default='test')
+    parser.add_argument('--user', default='user1')
+    parser.add_argument('--size', type=int, default=5000)
+    parser.add_argument('--fanout', type=int, default=100)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--drivers', nargs='+', default=sorted(DRIVERS))
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(parser.parse_args()))
@@ -0,0 +1,392 @@
+"""
+Load test of every route of the app.
+
+Drives the running app with a concurrent aiohttp client over a dataset
+loaded by `benchmarks.dataset`, one endpoint at a time, and reports
+throughput, p50/p95/p99 latency and mean response size on the wire per
+endpoint(the client accepts compressed responses). Results are saved as JSON,
+`--compare` prints the changes against results of a previous run.
+
+    PYTHONPATH=core python -m benchmarks.endpoints --url http://localhost:8080 \\
+        --output benchmarks/results/$(date +%F).json --compare benchmarks/results/previous.json
+
+Every route of `setup_routes` needs a scenario below, a new route
+without one fails the run.
+"""
+
+import argparse
+import asyncio
+from collections import namedtuple
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+from routes import setup_routes
+
+
+Scenario = namedtuple('Scenario', 'method route request')
+
+
+def _user(data, rnd):
+    return rnd.choice(data['users'])
+
+
+def _post(data, rnd):
+    """Hot posts are requested more often, by Zipf law as they're sized."""
+    posts = data['hot_posts']
+    index = min(int(rnd.paretovariate(1.1)) - 1, len(posts) - 1)
+    return posts[index]
+
+
+def _tree(data, rnd):
+    """Tree of any shape or a hot post."""
+    trees = list(data['shapes'].values()) + [_post(data, rnd)]
+    return rnd.choice(trees)
+
+
+def _comment(data, rnd):
+    return rnd.choice(_tree(data, rnd)['comment_ids'])
+
+
+def _parent(data, rnd):
+    """Comment with children."""
+    tree = _tree(data, rnd)
+    while not tree['parent_ids']:
+        tree = _tree(data, rnd)
+    return rnd.choice(tree['parent_ids'])
+
+
+def index_request(data, rnd):
+    return '/', {}
+
+
+def create_comment_form_request(data, rnd):
+    return '/{}/create_comment'.format(_user(data, rnd)), {}
+
+
+def create_comment_request(data, rnd):
+    return '/{}/create_comment'.format(_user(data, rnd)), {'data': {
+        'text': 'load test comment',
+        'entity_type': 'post',
+        'entity_id': str(_post(data, rnd)['post_id']),
+    }}
+
+
+def create_comments_request(data, rnd):
+    post_id = _post(data, rnd)['post_id']
+    comments = [{'ref': 0, 'text': 'load test', 'entity_type': 'post', 'entity_id': post_id}]
+    # a small tree, every comment answers one of the earlier ones
+    comments.extend({'ref': i + 1, 'text': 'load test', 'parent_ref': i // 3} for i in range(9))
+    return '/{}/create_comments'.format(_user(data, rnd)), {'json': {'comments': comments}}
+
+
+def get_comments_request(data, rnd):
+    return '/{}/get_comments'.format(_user(data, rnd)), {'params': {'limit': '20'}}
+
+
+def search_request(data, rnd):
+    """Generated comments share their words, so every comment of the subtree matches."""
+    if rnd.random() < 0.5:
+        params = {'q': 'benchmark comments', 'root_type': 'post',
+                  'root_id': str(_post(data, rnd)['post_id'])}
+    else:
+        params = {'q': 'benchmark comments', 'root_type': 'comment',
+                  'root_id': str(_parent(data, rnd))}
+    return '/{}/search'.format(_user(data, rnd)), {'params': params}
+
+
+def lvl1_request(data, rnd):
+    if rnd.random() < 0.5:
+        params = {'entity_type': 'post', 'entity_id': str(_tree(data, rnd)['post_id'])}
+    else:
+        params = {'entity_type': 'comment', 'entity_id': str(_parent(data, rnd))}
+    return '/{}/lvl1'.format(_user(data, rnd)), {'params': params}
+
+
+def change_comment_form_request(data, rnd):
+    return '/{}/change_comment'.format(_user(data, rnd)), {}
+
+
+def change_comment_request(data, rnd):
+    return '/{}/change_comment'.format(_user(data, rnd)), {'data': {
+        'comment_id': str(_comment(data, rnd)),
+        'text': 'load test change',
+    }}
+
+
+def delete_comment_form_request(data, rnd):
+    return '/{}/delete_comment'.format(_user(data, rnd)), {}
+
+
+def delete_comment_request(data, rnd):
+    """Delete leaves created by `prepare_deletes`, every one once by its creator."""
+    leaf = data['leaves'].pop()
+    data.setdefault('deleted', []).append(leaf)
+    user, comment_id = leaf
+    return '/{}/delete_comment'.format(user), {'data': {'comment_id': str(comment_id)}}
+
+
+def restore_comment_form_request(data, rnd):
+    return '/{}/restore_comment'.format(_user(data, rnd)), {}
+
+
+def restore_comment_request(data, rnd):
+    """Restore comments deleted by the delete scenario, which runs before."""
+    user, comment_id = data['deleted'].pop()
+    return '/{}/restore_comment'.format(user), {'data': {'comment_id': str(comment_id)}}
+
+
+def get_children_request(data, rnd):
+    return '/{}/get_children'.format(_user(data, rnd)), {'params': {
+        'entity_id': str(_parent(data, rnd)),
+        'max_depth': '3',
+        'max_children': '20',
+    }}
+
+
+def get_full_tree_request(data, rnd):
+    # the biggest shaped trees aren't requested, they're MBs of json
+    return '/{}/get_full_tree'.format(_user(data, rnd)), {'params': {
+        'root_type': 'post',
+        'root_id': str(_post(data, rnd)['post_id']),
+        'format': 'flat',
+    }}
+
+
+def get_tree_window_request(data, rnd):
+    # windows are bounded, so the biggest shaped trees are requested too
+    return '/{}/get_tree_window'.format(_user(data, rnd)), {'params': {
+        'root_type': 'post',
+        'root_id': str(_tree(data, rnd)['post_id']),
+        'sort': rnd.choice(['oldest', 'newest', 'top']),
+    }}
+
+
+def subscribe_request(data, rnd):
+    # a stream doesn't end, time to its headers is measured
+    return '/{}/subscribe'.format(_user(data, rnd)), {'stream': True, 'params': {
+        'root_type': 'post',
+        'root_id': str(_post(data, rnd)['post_id']),
+    }}
+
+
+def get_history_form_request(data, rnd):
+    return '/{}/get_history'.format(_user(data, rnd)), {}
+
+
+def get_history_request(data, rnd):
+    tree = _tree(data, rnd)
+    return '/{}/get_history'.format(tree['user']), {'data': {
+        'download_format': 'json',
+        'comment_id': str(rnd.choice(tree['comment_ids'])),
+    }}
+
+
+def search_history_request(data, rnd):
+    return '/{}/search_history'.format(_user(data, rnd)), {}
+
+
+def cache_stats_request(data, rnd):
+    return '/cache_stats', {}
+
+
+def metrics_request(data, rnd):
+    return '/metrics', {}
+
+
+SCENARIOS = [
+    Scenario('GET', '/', index_request),
+    Scenario('GET', '/{user}/create_comment', create_comment_form_request),
+    Scenario('POST', '/{user}/create_comment', create_comment_request),
+    Scenario('POST', '/{user}/create_comments', create_comments_request),
+    Scenario('GET', '/{user}/get_comments', get_comments_request),
+    Scenario('GET', '/{user}/search', search_request),
+    Scenario('GET', '/{user}/lvl1', lvl1_request),
+    Scenario('GET', '/{user}/change_comment', change_comment_form_request),
+    Scenario('POST', '/{user}/change_comment', change_comment_request),
+    Scenario('GET', '/{user}/delete_comment', delete_comment_form_request),
+    Scenario('POST', '/{user}/delete_comment', delete_comment_request),
+    Scenario('GET', '/{user}/restore_comment', restore_comment_form_request),
+    Scenario('POST', '/{user}/restore_comment', restore_comment_request),
+    Scenario('GET', '/{user}/get_children', get_children_request),
+    Scenario('GET', '/{user}/get_full_tree', get_full_tree_request),
+    Scenario('GET', '/{user}/get_tree_window', get_tree_window_request),
+    Scenario('GET', '/{user}/subscribe', subscribe_request),
+    Scenario('GET', '/{user}/get_history', get_history_form_request),
+    Scenario('POST', '/{user}/get_history', get_history_request),
+    Scenario('GET', '/{user}/search_history', search_history_request),
+    Scenario('POST', '/{user}/search_history', get_history_request),
+    Scenario('GET', '/cache_stats', cache_stats_request),
+    Scenario('GET', '/metrics', metrics_request),
+]
+
+
+def app_routes():
+    """Method and path of every route of the app, HEAD ones are implicit."""
+    app = web.Application()
+    setup_routes(app)
+    return {
+        (route.method, route.resource.canonical)
+        for route in app.router.routes() if route.method != 'HEAD'
+    }
+
+
+def check_coverage(scenarios):
+    covered = {(s.method, s.route) for s in scenarios}
+    missing = app_routes() - covered
+    if missing:
+        raise RuntimeError('no scenarios for routes: {}'.format(
+            ', '.join('{} {}'.format(*route) for route in sorted(missing))))
+
+
+async def prepare_deletes(session, url, data, count, rnd):
+    """Create leaf comments for delete requests in bulk."""
+    leaves = []
+    while len(leaves) < count:
+        post_id = _post(data, rnd)['post_id']
+        user = _user(data, rnd)
+        comments = [
+            {'text': 'to delete', 'entity_type': 'post', 'entity_id': post_id}
+            for _ in range(min(100, count - len(leaves)))
+        ]
+        async with session.post(
+                '{}/{}/create_comments'.format(url, user),
+                json={'comments': comments}) as resp:
+            resp.raise_for_status()
+            leaves.extend((user, i) for i in (await resp.json())['ids'])
+    data['leaves'] = leaves
+
+
+def percentile(latencies, p):
+    """Nearest-rank percentile of sorted latencies."""
+    if not latencies:
+        return None
+    return latencies[max(0, math.ceil(p / 100 * len(latencies)) - 1)]
+
+
+async def run_scenario(session, url, scenario, data, requests, concurrency, rnd):
+    """Send `requests` requests by `concurrency` workers, return latencies and errors."""
+    latencies = []
+    sizes = []
+    errors = {}
+    remaining = iter(range(requests))
+
+    async def worker():
+        for _ in remaining:
+            path, kwargs = scenario.request(data, rnd)
+            stream = kwargs.pop('stream', False)
+            start = time.perf_counter()
+            try:
+                async with session.request(scenario.method, url + path, **kwargs) as resp:
+                    body = b'' if stream else await resp.read()
+                    status = resp.status
+                    # bytes on the wire, bodies are decompressed by the client
+                    sizes.append(resp.content_length or len(body))
+            except aiohttp.ClientError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(latencies) / elapsed, 1),
+        'mean': sum(latencies) / len(latencies),
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'bytes': sum(sizes) / len(sizes) if sizes else None,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(endpoints, previous=None):
+    print('{:<36}{:>10}{:>8}{:>10}{:>10}{:>10}{:>10}'.format(
+        'endpoint', 'req/s', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'KB'))
+    for name, result in endpoints.items():
+        line = '{:<36}{:>10.1f}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}'.format(
+            name, result['throughput'], sum(result['errors'].values()),
+            result['p50'] * 1000, result['p95'] * 1000, result['p99'] * 1000,
+            (result.get('bytes') or 0) / 1024)
+        old = (previous or {}).get(name)
+        if old:
+            line += '  req/s {:+.0%} p95 {:+.0%}'.format(
+                result['throughput'] / old['throughput'] - 1, result['p95'] / old['p95'] - 1)
+        print(line)
+
+
+async def main(args):
+    check_coverage(SCENARIOS)
+    with open(args.dataset) as f:
+        data = json.load(f)
+    rnd = random.Random(args.seed)
+    scenarios = [
+        s for s in SCENARIOS
+        if not args.only or any(pattern in s.route for pattern in args.only)
+    ]
+    endpoints = {}
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        requests = [s.request for s in scenarios]
+        if delete_comment_request in requests or restore_comment_request in requests:
+            await prepare_deletes(session, args.url, data, args.requests, rnd)
+        for scenario in scenarios:
+            name = '{} {}'.format(scenario.method, scenario.route)
+            endpoints[name] = await run_scenario(
+                session, args.url, scenario, data, args.requests, args.concurrency, rnd)
+    results = {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': _git_commit(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'url': args.url,
+        'dataset': os.path.basename(args.dataset),
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'endpoints': endpoints,
+    }
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['endpoints']
+    print_results(endpoints, previous)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8080')
+    parser.add_argument('--dataset', default='benchmarks/dataset.json')
+    parser.add_argument('--requests', type=int, default=1000, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--only', nargs='*', help='run endpoints which routes contain these')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file to save results to')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(parser.parse_args()))
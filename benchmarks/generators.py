@@ -0,0 +1,82 @@
+"""
+Synthetic comment tree generators.
+
+A tree is generated as parent indexes of its comments in insertion order:
+`parents[i]` is the index of the parent comment or None for a first level
+comment of the post. Parents always go before their children, so trees
+of any size are loaded batch by batch(see `load_tree`).
+"""
+
+import random
+
+from db import db_create_comments_bulk
+
+
+def balanced(size, branching=5):
+    """Complete tree, every comment has `branching` children."""
+    return [None if i < branching else i // branching - 1 for i in range(size)]
+
+
+def wide_flat(size):
+    """First level comments only."""
+    return [None] * size
+
+
+def deep_chain(size):
+    """Every comment answers the previous one, worst case of the closure table."""
+    return [None] + list(range(size - 1))
+
+
+def random_tree(size, fanout=100, rnd=random):
+    """`fanout` first level comments, others answer a random earlier one."""
+    return [None if i < fanout else rnd.randrange(i) for i in range(size)]
+
+
+def zipf_sizes(total, posts, s=1.1):
+    """Split `total` comments over posts by Zipf law, the first posts are hot."""
+    weights = [1 / (k ** s) for k in range(1, posts + 1)]
+    norm = sum(weights)
+    sizes = [int(total * w / norm) for w in weights]
+    sizes[0] += total - sum(sizes)
+    return sizes
+
+
+SHAPES = {
+    'balanced': balanced,
+    'wide_flat': wide_flat,
+    'deep_chain': deep_chain,
+    'random': random_tree,
+}
+
+
+async def create_post(conn, user, text='benchmark post'):
+    """Create a post for generated trees, return its ID."""
+    result = await conn.execute(
+        "INSERT INTO posts(type, creator, user_last_modified, text) "
+        "VALUES('post', %s, %s, %s) RETURNING id",
+        (user, user, text)
+    )
+    return await result.scalar()
+
+
+async def load_tree(conn, user, post_id, parents, batch_size=10000):
+    """
+    Load a generated tree under the post, return IDs of the comments.
+
+    Parents of earlier batches are referred by ID, of the same batch by ref.
+    """
+    ids = []
+    for start in range(0, len(parents), batch_size):
+        comments = []
+        for i in range(start, min(start + batch_size, len(parents))):
+            comment = {'ref': i, 'text': 'benchmark comment {}'.format(i)}
+            parent = parents[i]
+            if parent is None:
+                comment.update(entity_type='post', entity_id=post_id)
+            elif parent < start:
+                comment.update(entity_type='comment', entity_id=ids[parent])
+            else:
+                comment['parent_ref'] = parent
+            comments.append(comment)
+        ids.extend(await db_create_comments_bulk(conn, user, comments))
+    return ids
@@ -0,0 +1,78 @@
+"""
+Benchmark of hierarchy strategies: closure table vs materialized paths.
+
+The same dataset(a random tree and a deep chain) is loaded under a new post
+with closure maintenance on and off, then `db_get_full_tree` and
+`db_get_child_comments` are timed with the matching strategy.
+The data is loaded into the database of the given env, so use the test one.
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+from benchmarks.drivers import timeit
+from benchmarks.generators import create_post, deep_chain, load_tree, random_tree
+from db import close_pg, db_get_child_comments, db_get_full_tree, init_pg
+from settings import config
+
+
+def compose_dataset(size, depth, fanout, rnd):
+    """Compose a random tree of `size` comments with a chain of `depth` ones."""
+    chain = [None if parent is None else size + parent for parent in deep_chain(depth)]
+    # the chain answers the last comment of the random tree
+    chain[0] = size - 1
+    return random_tree(size, fanout, rnd) + chain
+
+
+async def count_closure_rows(conn):
+    result = await conn.execute('SELECT count(*) FROM entities_closure_table')
+    return await result.scalar()
+
+
+async def bench_hierarchy(conn, args, hierarchy):
+    await conn.execute(
+        "SELECT set_config('comments.hierarchy', %s, false)", (hierarchy,))
+    post_id = await create_post(conn, args.user)
+    dataset = compose_dataset(args.size, args.depth, args.fanout, random.Random(args.seed))
+    closure_rows = await count_closure_rows(conn)
+    start = time.perf_counter()
+    # a single statement, as the closure trigger works per statement
+    ids = await load_tree(conn, args.user, post_id, dataset, batch_size=len(dataset))
+    insert = (time.perf_counter() - start) * 1000
+    closure_rows = await count_closure_rows(conn) - closure_rows
+    tree = await timeit(
+        lambda: db_get_full_tree(conn, 'post', post_id, hierarchy), args.iterations)
+    # the first comment has the largest subtree
+    children = await timeit(
+        lambda: db_get_child_comments(conn, ids[0], hierarchy), args.iterations)
+    return insert, closure_rows, tree, children
+
+
+async def main(args):
+    app = {'config': config}
+    await init_pg(app, args.env)
+    try:
+        async with app['db'].acquire() as conn:
+            print('{:<10}{:>12}{:>16}{:>12}{:>16}'.format(
+                'hierarchy', 'insert, ms', 'closure rows', 'tree, ms', 'children, ms'))
+            for hierarchy in ('closure', 'path'):
+                print('{:<10}{:>12.0f}{:>16}{:>12.2f}{:>16.2f}'.format(
+                    hierarchy, *await bench_hierarchy(conn, args, hierarchy)))
+            await conn.execute("SELECT set_config('comments.hierarchy', '', false)")
+    finally:
+        await close_pg(app)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--env', default='test')
+    parser.add_argument('--user', default='user1')
+    parser.add_argument('--size', type=int, default=5000)
+    parser.add_argument('--depth', type=int, default=500)
+    parser.add_argument('--fanout', type=int, default=100)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(parser.parse_args()))
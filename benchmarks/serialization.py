@@ -0,0 +1,97 @@
+"""
+Benchmark of tree serialization and compression.
+
+Generates rows of a random tree like the tree queries return them, then
+times encoding the nested and flat trees, the way views did before(values
+converted by `to_json_value`, then `json.dumps`) and by `serializers.dumps`
+(orjson when installed), and prints compressed sizes and times of every
+coding. No DB is needed.
+
+    PYTHONPATH=core python -m benchmarks.serialization --size 20000
+"""
+
+import argparse
+from datetime import datetime, timedelta, timezone
+import json
+import random
+import time
+
+from benchmarks.generators import random_tree
+from compression import Compressor, brotli
+import serializers
+from tree import build_tree, flat_tree
+
+
+def tree_rows(size, rnd):
+    """Rows of a post and a random tree of its comments."""
+    start = datetime(2018, 1, 1, tzinfo=timezone.utc)
+    rows = [{
+        'type': 'post', 'id': 1, 'creator': 'user1', 'date_created': start,
+        'date_last_modified': start, 'text': 'benchmark post',
+        'parent_type': None, 'parent_id': None,
+        'direct_reply_count': 0, 'descendant_count': size,
+    }]
+    for i, parent in enumerate(random_tree(size, fanout=100, rnd=rnd)):
+        date = start + timedelta(seconds=i, microseconds=rnd.randrange(10 ** 6))
+        rows.append({
+            'type': 'comment', 'id': i + 1, 'creator': 'user{}'.format(rnd.randrange(100)),
+            'date_created': date, 'date_last_modified': date,
+            'text': 'benchmark comment {}'.format(i),
+            'parent_type': 'post' if parent is None else 'comment',
+            'parent_id': 1 if parent is None else parent + 1,
+            'direct_reply_count': 0, 'descendant_count': 0,
+        })
+    return rows
+
+
+def timeit(func, iterations):
+    """Return the result and mean time of the function in ms."""
+    result = func()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return result, (time.perf_counter() - start) / iterations * 1000
+
+
+def main(args):
+    rows = tree_rows(args.size, random.Random(args.seed))
+    encoders = [
+        ('json', lambda tree: json.dumps(tree(serializers.to_json_value)).encode()),
+        ('dumps' + ('/orjson' if serializers.orjson else '/json'),
+         lambda tree: serializers.dumps(tree(None))),
+    ]
+    trees = [
+        ('nested', lambda convert: build_tree(rows, convert=convert)),
+        ('flat', lambda convert: flat_tree(rows, convert=convert)),
+    ]
+    print('{} rows'.format(len(rows)))
+    print('{:<8}{:<14}{:>10}{:>12}'.format('tree', 'encoder', 'ms', 'KB'))
+    bodies = {}
+    for tree_name, tree in trees:
+        for encoder_name, encode in encoders:
+            body, elapsed = timeit(lambda: encode(tree), args.iterations)
+            bodies[tree_name] = body
+            print('{:<8}{:<14}{:>10.1f}{:>12.1f}'.format(
+                tree_name, encoder_name, elapsed, len(body) / 1024))
+
+    codings = [('gzip', level, Compressor(gzip_level=level)) for level in (1, 6, 9)]
+    if brotli:
+        codings += [('br', quality, Compressor(brotli_quality=quality)) for quality in (1, 4, 6)]
+    print()
+    print('{:<8}{:<14}{:>10}{:>12}{:>8}'.format('tree', 'coding', 'ms', 'KB', 'ratio'))
+    for tree_name, body in sorted(bodies.items()):
+        for coding, level, compressor in codings:
+            compressed, elapsed = timeit(
+                lambda: compressor.compress(body, coding), args.iterations)
+            print('{:<8}{:<14}{:>10.1f}{:>12.1f}{:>8.1f}'.format(
+                tree_name, '{} {}'.format(coding, level), elapsed,
+                len(compressed) / 1024, len(body) / len(compressed)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=20000, help='comments of the tree')
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
@@ -0,0 +1,187 @@
+"""
+Module to admit requests by priority and shed the excess.
+
+Without a limit every request waits for a pooled connection as long as it
+takes, so under overload latency grows until clients time out and nothing
+is served in time. A worker handles at most `concurrency` requests at once,
+the rest wait in a queue of their class:
+ - classes are admitted by priority, writes and first level pages go ahead
+   of tree reads, history exports go last;
+ - a class may be capped below `concurrency`, so exports never take
+   all the slots, and lower classes are capped below the pool size of
+   the worker, so the last connection is left for writes;
+ - a request finding its queue full is answered 503 right away, one waiting
+   longer than the class `timeout` too, both with `Retry-After`;
+ - a request waiting for a pooled connection longer than `acquire_timeout`
+   of the postgres settings is answered 503 as well(see `metrics.AcquireTimeout`).
+So the latency of an admitted request is bounded, overload is seen
+by clients as fast 503s instead.
+Routes are assigned to classes by method and path, long-lived live streams
+and service routes aren't admission-controlled at all, though their pool
+acquire timeouts are answered 503 too.
+"""
+
+import asyncio
+from collections import deque
+import logging
+import time
+
+from aiohttp import web
+
+from metrics import ADMISSION_REJECTED, ADMISSION_WAIT, AcquireTimeout
+
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Request is shed, its queue is full or it waited too long."""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class _Class:
+
+    def __init__(self, name, priority=0, concurrency=None, queue=100, timeout=1):
+        self.name = name
+        self.priority = priority
+        self.concurrency = concurrency
+        self.queue_size = queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiters = deque()
+
+
+class AdmissionController:
+    """
+    Slots for requests, granted by class priority.
+
+    `routes` are classes by method and canonical path, e.g.
+    `'GET /{user}/lvl1'`, other routes are of `default_class`.
+    The None class isn't admission-controlled.
+    With `pool_size` of the worker, classes below the top priority run
+    at most `pool_size - 1` requests, so a long export never takes the last
+    connection from writes. A pool of one connection can't be shared so.
+    """
+
+    def __init__(self, concurrency, classes, routes=None, default_class=None, retry_after=1,
+                 pool_size=None):
+        self.concurrency = concurrency
+        self.active = 0
+        self.classes = {name: _Class(name, **conf) for name, conf in classes.items()}
+        self._by_priority = sorted(self.classes.values(), key=lambda cls: cls.priority)
+        if pool_size is not None and self._by_priority:
+            top = self._by_priority[0].priority
+            limit = max(1, pool_size - 1)
+            for cls in self._by_priority:
+                if cls.priority > top:
+                    cls.concurrency = min(cls.concurrency or limit, limit)
+        self.routes = routes or {}
+        self.default_class = default_class
+        self.retry_after = retry_after
+
+    def route_class(self, method, path):
+        return self.routes.get('{} {}'.format(method, path), self.default_class)
+
+    def _can_run(self, cls):
+        return self.active < self.concurrency and (
+            cls.concurrency is None or cls.active < cls.concurrency)
+
+    def _grant(self, cls):
+        self.active += 1
+        cls.active += 1
+
+    async def acquire(self, name):
+        """Wait for a slot of the class, raise `Overloaded` when it's shed."""
+        cls = self.classes[name]
+        # waiters of other classes can't run, they're granted as soon as they can
+        if not cls.waiters and self._can_run(cls):
+            self._grant(cls)
+            return
+        if len(cls.waiters) >= cls.queue_size:
+            raise Overloaded('queue_full')
+        waiter = asyncio.get_event_loop().create_future()
+        cls.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), cls.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # granted meanwhile, the slot is given to the next one
+                self.release(name)
+            else:
+                waiter.cancel()
+                cls.waiters.remove(waiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise Overloaded('timeout')
+
+    def release(self, name):
+        """Free a slot of the class and grant slots to waiters by priority."""
+        cls = self.classes[name]
+        self.active -= 1
+        cls.active -= 1
+        self._wake()
+
+    def _wake(self):
+        for cls in self._by_priority:
+            while cls.waiters and self._can_run(cls):
+                self._grant(cls)
+                cls.waiters.popleft().set_result(None)
+            if cls.waiters and self.active >= self.concurrency:
+                return
+
+    def stats(self):
+        return {
+            name: {'active': cls.active, 'waiting': len(cls.waiters)}
+            for name, cls in self.classes.items()
+        }
+
+
+def _unavailable(retry_after, reason):
+    return web.HTTPServiceUnavailable(
+        headers={'Retry-After': str(retry_after)},
+        text='Server is overloaded ({}), retry later.'.format(reason))
+
+
+@web.middleware
+async def admission_middleware(request, handler):
+    """Handle requests of the app in admission slots, answer 503 when shed."""
+    controller = request.app.get('admission')
+    route = request.match_info.route
+    if controller is None or route.resource is None:
+        return await handler(request)
+    name = controller.route_class(request.method, route.resource.canonical)
+    if name is None:
+        # not queued, but pool acquire timeouts are answered the same way
+        try:
+            return await handler(request)
+        except AcquireTimeout:
+            raise _unavailable(controller.retry_after, 'acquire_timeout')
+    start = time.perf_counter()
+    try:
+        await controller.acquire(name)
+    except Overloaded as e:
+        ADMISSION_REJECTED.inc(name, e.reason)
+        raise _unavailable(controller.retry_after, e.reason)
+    ADMISSION_WAIT.observe(time.perf_counter() - start, name)
+    try:
+        return await handler(request)
+    except AcquireTimeout:
+        ADMISSION_REJECTED.inc(name, 'acquire_timeout')
+        raise _unavailable(controller.retry_after, 'acquire_timeout')
+    finally:
+        controller.release(name)
+
+
+async def init_admission(app, env='dev'):
+    """Init an app with admission control of its requests."""
+    conf = app['config'][env]['admission']
+    # the primary pool of the worker, see launcher.split_pools
+    pool_size = app['config'][env]['postgres'].get('maxsize')
+    if pool_size is not None and pool_size < 2:
+        logger.warning('A pool of %s connection, exports may starve writes', pool_size)
+    app['admission'] = AdmissionController(
+        conf['concurrency'], conf['classes'], conf['routes'], conf['default_class'],
+        conf['retry_after'], pool_size)
@@ -0,0 +1,118 @@
+"""
+Module with an in-process cache of serialized comment trees.
+
+Entries are keyed by a root entity (type, id), every key holds serialized
+responses of a few variants(endpoint and encoding options).
+Entries are evicted by LRU and TTL and invalidated by notifications
+of the comment triggers, which carry changed comments and all their ancestors
+(see `notify.NotificationListener`). The cache is only used while
+the listener is connected, otherwise invalidations might be missed.
+"""
+
+from collections import OrderedDict
+import logging
+import time
+
+from notify import changed_roots
+
+
+logger = logging.getLogger(__name__)
+
+
+class TreeCache:
+    """Bounded LRU/TTL cache of serialized trees."""
+
+    def __init__(self, maxsize=1000, ttl=60, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.enabled = False
+        self._clock = clock
+        self._entries = OrderedDict()
+        # invalidation counters, to not store a tree read before invalidation.
+        # Generation is bumped whenever counters are dropped.
+        self._versions = OrderedDict()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, variant):
+        """Get a cached value, None if there's no(fresh) one."""
+        entry = self._entries.get(key) if self.enabled else None
+        if entry is not None and entry[0] < self._clock():
+            del self._entries[key]
+            self.evictions += 1
+            entry = None
+        value = entry[1].get(variant) if entry is not None else None
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def version(self, key):
+        """Get a version of the key, it must be passed to `put`."""
+        return self._generation, self._versions.get(key, 0)
+
+    def put(self, key, variant, value, version):
+        """Cache a value unless the key was invalidated since `version`."""
+        if not self.enabled or self.version(key) != version:
+            return
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = (self._clock() + self.ttl, {})
+        entry[1][variant] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """Drop cached values of the key."""
+        self._entries.pop(key, None)
+        self._versions[key] = self._versions.get(key, 0) + 1
+        self._versions.move_to_end(key)
+        if len(self._versions) > self.maxsize * 4:
+            self._versions.popitem(last=False)
+            self._generation += 1
+        self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._versions.clear()
+        self._generation += 1
+
+    def on_notify(self, message):
+        """Invalidate changed comments and all their ancestors."""
+        if message.get('truncated'):
+            logger.info('Truncated notification, clearing tree cache')
+            self.clear()
+            return
+        for root in changed_roots(message):
+            self.invalidate(root)
+
+    def on_listener_reset(self, connected):
+        """Only cache while invalidations are received."""
+        self.clear()
+        self.enabled = connected
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+async def init_tree_cache(app, env='dev'):
+    """Init an app with tree cache, invalidated by the app listener."""
+    conf = app['config'][env]['tree_cache']
+    cache = TreeCache(maxsize=conf['maxsize'], ttl=conf['ttl'])
+    app['listener'].add_handler(cache.on_notify, cache.on_listener_reset)
+    app['tree_cache'] = cache
@@ -0,0 +1,104 @@
+"""
+Module with negotiated compression of responses.
+
+Responses of at least `min_size` bytes are compressed by the best coding
+the client accepts(`Accept-Encoding`): brotli when the brotli package is
+installed, gzip otherwise. Trees are compressed once and cached that way
+(see `views._get_cached_tree`), other responses are compressed by
+`compression_middleware`. Bodies of `offload_size` bytes and more are
+compressed in the default executor, both zlib and brotli release the GIL,
+so big bodies don't block the loop.
+"""
+
+import asyncio
+import zlib
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:  # brotli coding is optional
+    brotli = None
+
+
+# codings by preference, the first accepted one is used
+CODINGS = ('br', 'gzip') if brotli else ('gzip',)
+
+
+def parse_accept_encoding(header):
+    """Parse `Accept-Encoding` into a dict of codings and their q-values."""
+    accepted = {}
+    for item in header.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+class Compressor:
+    """Negotiates and compresses response bodies."""
+
+    def __init__(self, min_size=1024, gzip_level=6, brotli_quality=1, offload_size=256 * 1024):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.offload_size = offload_size
+
+    def negotiate(self, header):
+        """Get the preferred coding of the accepted ones, None for identity."""
+        accepted = parse_accept_encoding(header or '')
+        best, best_q = None, 0
+        for coding in CODINGS:
+            q = accepted.get(coding, accepted.get('*', 0))
+            if q > best_q:
+                best, best_q = coding, q
+        return best
+
+    def compress(self, body, coding):
+        if coding == 'br':
+            return brotli.compress(body, quality=self.brotli_quality)
+        # wbits 31 is the gzip container
+        compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 31)
+        return compressor.compress(body) + compressor.flush()
+
+    async def compress_async(self, body, coding):
+        if len(body) < self.offload_size:
+            return self.compress(body, coding)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.compress, body, coding)
+
+
+@web.middleware
+async def compression_middleware(request, handler):
+    """Compress bodies of big responses, already encoded ones are kept."""
+    response = await handler(request)
+    compressor = request.app.get('compression')
+    body = getattr(response, 'body', None)
+    if compressor is None or not isinstance(body, bytes) or len(body) < compressor.min_size:
+        return response
+    response.headers['Vary'] = 'Accept-Encoding'
+    if 'Content-Encoding' in response.headers:
+        return response
+    coding = compressor.negotiate(request.headers.get('Accept-Encoding'))
+    if coding is not None:
+        response.body = await compressor.compress_async(body, coding)
+        response.headers['Content-Encoding'] = coding
+    return response
+
+
+async def init_compression(app, env='dev'):
+    """Init an app with the response compressor."""
+    conf = app['config'][env]['compression']
+    app['compression'] = Compressor(
+        min_size=conf['min_size'],
+        gzip_level=conf['gzip_level'],
+        brotli_quality=conf['brotli_quality'])
@@ -5,11 +5,16 @@ ORM can be supported by sqlalchemy. Performance is questionable though.
 aiopg SELECT operation returns `list` of results
 https://github.com/aio-libs/aiopg/blob/master/aiopg/sa/result.py#L366
 which might cost much memory, use it carefully.
+Connections are provided by a driver selected in settings, see drivers.py.
 """
 
 from datetime import datetime
 
-import aiopg.sa
+from drivers import DATA_ERRORS, DB_ERRORS, create_pool
+from metrics import InstrumentedPool, observe_db
+
+from pagination import Page, decode_cursor, encode_cursor
+from replicas import ReplicaRouter
 
 # ORM is not implemented but quite possible to be
 # Example below is based on SQLAlchemy ORM
@@ -106,37 +111,87 @@ class ExecuteException(Exception):
     """Custom exception for failed executions."""
 
 
+class InvalidRefs(ExecuteException):
+    """Custom exception for comment refs of a batch which can't form a tree."""
+
+
+# strategies to query trees: the closure table or materialized paths,
+# see dbtools/init/3_hierarchy_path.sql
+HIERARCHIES = ('closure', 'path')
+
+
 async def init_pg(app, env='dev'):
-    """Init an app with aiopg engine."""
+    """
+    Init an app with pools of the configured driver and hierarchy strategy.
+
+    `app['db']` is the primary pool, reads may be routed to replica pools
+    by `app['db_router']`(see `replicas.ReplicaRouter`).
+    """
     conf = app['config'][env]['postgres']
-    engine = await aiopg.sa.create_engine(
-        database=conf['database'],
-        user=conf['user'],
-        password=conf['password'],
-        host=conf['host'],
-        port=conf['port'],
-        minsize=conf['minsize'],
-        maxsize=conf['maxsize'],
-        loop=app.loop)
-    app['db'] = engine
+    hierarchy = conf.get('hierarchy', 'closure')
+    if hierarchy not in HIERARCHIES:
+        raise RuntimeError('unknown hierarchy {}'.format(hierarchy))
+    app['hierarchy'] = hierarchy
+    acquire_timeout = conf.get('acquire_timeout')
+    app['db'] = InstrumentedPool(await create_pool(conf), 'primary', acquire_timeout)
+    # replica settings override the primary ones
+    app['db_replicas'] = [
+        InstrumentedPool(await create_pool(dict(conf, **replica)), 'replica{}'.format(i),
+                         replica.get('acquire_timeout', acquire_timeout))
+        for i, replica in enumerate(conf.get('replicas', ()))
+    ]
+    app['db_router'] = ReplicaRouter(
+        app['db'], app['db_replicas'],
+        balancing=conf.get('balancing', 'round_robin'),
+        sticky_window=conf.get('sticky_window', 5))
 
 
 async def close_pg(app):
-    """Close the aiopg engine for the app."""
-    app['db'].close()
-    await app['db'].wait_closed()
+    """Close the pools for the app."""
+    for pool in [app['db']] + app['db_replicas']:
+        pool.close()
+    for pool in [app['db']] + app['db_replicas']:
+        await pool.wait_closed()
 
 
-async def db_get_comments(conn, username):
-    """Get all the comments for a given user."""
-    result = await conn.execute(
-        """
-        SELECT DISTINCT ON(id) *
-        FROM comments, users 
-        WHERE comments.creator = %s
-        """,
-        (username,)
-    )
+@observe_db
+async def db_get_comments(conn, username, after=None, start_date=None, end_date=None, limit=None):
+    """
+    Get comments for a given user, newest first.
+
+    Uses keyset pagination on (date_created, id), `after` is an opaque
+    cursor of the last comment of the previous page.
+    Dates limit a window of creation dates, end date is exclusive.
+    """
+    sql_values = [username]
+    conditions = []
+    if start_date:
+        conditions.append('AND date_created >= %s::text::timestamptz')
+        sql_values.append(start_date)
+    if end_date:
+        conditions.append('AND date_created < %s::text::timestamptz')
+        sql_values.append(end_date)
+    if after:
+        conditions.append('AND (date_created, id) < (%s::text::timestamptz, %s)')
+        sql_values.extend(decode_cursor(after, 2))
+    if limit:
+        limit_clause = 'LIMIT %s'
+        sql_values.append(limit)
+    else:
+        limit_clause = ''
+    try:
+        result = await conn.execute(
+            """
+            SELECT type, id, creator, date_created, date_last_modified, text, parent_type, parent_id
+            FROM comments
+            WHERE creator = %s AND deleted_at IS NULL {conditions}
+            ORDER BY date_created DESC, id DESC
+            {limit}
+            """.format(conditions=' '.join(conditions), limit=limit_clause),
+            sql_values
+        )
+    except DATA_ERRORS:
+        raise ExecuteException('Failed to get comments, check dates.')
 
     comments_record = await result.fetchall()
     if comments_record:
@@ -145,6 +200,7 @@ async def db_get_comments(conn, username):
         raise RecordNotFound('No comments found for  user {}'.format(username))
 
 
+@observe_db
 async def db_create_comment(conn, username, text, entity_type, entity_id):
     """Create a new comment for a given entity."""
     try:
@@ -166,15 +222,128 @@ async def db_create_comment(conn, username, text, entity_type, entity_id):
         )
 
 
+def _batch_parents(comments):
+    """
+    Return the index of the parent in the batch or None of every comment.
+
+    Unknown and duplicated refs are rejected, cycles are by `_parents_first`,
+    both before anything is run.
+    """
+    refs = {}
+    for i, comment in enumerate(comments):
+        ref = comment.get('ref')
+        if ref is not None:
+            if not isinstance(ref, (str, int)):
+                raise InvalidRefs('Comment refs are strings or numbers')
+            if ref in refs:
+                raise InvalidRefs('Duplicated comment ref {}'.format(ref))
+            refs[ref] = i
+    parents = []
+    for comment in comments:
+        parent_ref = comment.get('parent_ref')
+        if parent_ref is None:
+            parents.append(None)
+        elif not isinstance(parent_ref, (str, int)) or parent_ref not in refs:
+            raise InvalidRefs('Unknown parent ref {}'.format(parent_ref))
+        else:
+            parents.append(refs[parent_ref])
+    return parents
+
+
+def _parents_first(parents):
+    """
+    Order batch indexes so that parents go before their children.
+
+    `parents` holds the index of the parent in the batch or None.
+    """
+    order = []
+    state = [None] * len(parents)  # None - new, False - visiting, True - done
+    for i in range(len(parents)):
+        chain = []
+        while i is not None and state[i] is None:
+            state[i] = False
+            chain.append(i)
+            i = parents[i]
+        if i is not None and state[i] is False:
+            raise InvalidRefs('Comment refs form a cycle')
+        for j in chain:
+            state[j] = True
+        order.extend(reversed(chain))
+    return order
+
+
+@observe_db
+async def db_create_comments_bulk(conn, username, comments):
+    """
+    Create many comments at once, in one transaction.
+
+    Every comment is a dict with a `text` and either `entity_type`/`entity_id`
+    of an existing parent or `parent_ref`, a `ref` of another comment
+    of the same batch. IDs are allocated upfront, so rows are inserted
+    by a single statement and closure/history rows are written per statement.
+    Rows are inserted parents first(see `set_entity_path` trigger).
+    Return IDs of the new comments in the given order.
+    """
+    comments = list(comments)
+    if not comments:
+        return []
+    batch_parents = _batch_parents(comments)
+    order = _parents_first(batch_parents)
+    async with conn.begin():
+        result = await conn.execute(
+            """
+            SELECT nextval(pg_get_serial_sequence('comments', 'id'))
+            FROM generate_series(1, %s)
+            """,
+            (len(comments),)
+        )
+        ids = [row[0] for row in await result.fetchall()]
+        texts, parent_types, parent_ids = [], [], []
+        for comment, parent in zip(comments, batch_parents):
+            texts.append(comment['text'])
+            if parent is not None:
+                parent_types.append('comment')
+                parent_ids.append(ids[parent])
+            else:
+                try:
+                    parent_ids.append(int(comment['entity_id']))
+                except (ValueError, TypeError):
+                    raise ExecuteException('Invalid entity id {}'.format(comment['entity_id']))
+                parent_types.append(comment['entity_type'])
+        try:
+            await conn.execute(
+                """
+                INSERT INTO comments (id, type, creator, user_last_modified, text, parent_type, parent_id)
+                SELECT c.id, 'comment', %s, %s, c.text, c.parent_type, c.parent_id
+                FROM unnest(%s::int[], %s::varchar[], %s::entity_type[], %s::int[])
+                  WITH ORDINALITY as c(id, text, parent_type, parent_id, n)
+                ORDER BY c.n
+                """,
+                (username, username,
+                 [ids[i] for i in order], [texts[i] for i in order],
+                 [parent_types[i] for i in order], [parent_ids[i] for i in order])
+            )
+        except DB_ERRORS as e:
+            raise ExecuteException(
+                'Failed to create the new comments, probably incorrect entity was provided.\n'
+                '{}'.format(e)
+            )
+    return ids
+
+
+@observe_db
 async def db_get_1lvl_comments(conn, entity_type, entity_id, offset=0, limit=5):
     """
     Get all first-level children for the given entity,
 
     Uses pagination, so expects an offset and a limit.
+    Rows carry their reply counters(`direct_reply_count`, `descendant_count`).
     """
     result = await conn.execute(
         """
-        SELECT * FROM comments WHERE parent_type = %s AND parent_id = %s
+        SELECT * FROM comments
+        WHERE parent_type = %s AND parent_id = %s AND deleted_at IS NULL
+        ORDER BY date_created, id
         OFFSET %s LIMIT %s
 
         """,
@@ -187,13 +356,58 @@ async def db_get_1lvl_comments(conn, entity_type, entity_id, offset=0, limit=5):
         raise RecordNotFound('No comments found for entity {}'.format(entity_id))
 
 
+@observe_db
+async def db_get_1lvl_comments_page(conn, entity_type, entity_id, after=None, before=None, limit=5):
+    """
+    Get a page of first-level children for the given entity.
+
+    Uses keyset pagination on (date_created, id), so every page costs
+    the same index range scan no matter how deep it is.
+    `after` and `before` are opaque cursors returned with the previous page.
+    """
+    if after and before:
+        raise ExecuteException('Only one of after/before cursors is expected')
+    cursor = after or before
+    if cursor:
+        keyset_condition = 'AND (date_created, id) {} (%s::text::timestamptz, %s)'.format(
+            '>' if after else '<')
+        sql_values = [entity_type, entity_id] + decode_cursor(cursor, 2) + [limit + 1]
+    else:
+        keyset_condition = ''
+        sql_values = [entity_type, entity_id, limit + 1]
+    result = await conn.execute(
+        """
+        SELECT * FROM comments
+        WHERE parent_type = %s AND parent_id = %s AND deleted_at IS NULL {kc}
+        ORDER BY date_created {order}, id {order}
+        LIMIT %s
+        """.format(kc=keyset_condition, order='DESC' if before else 'ASC'),
+        sql_values
+    )
+    comments_record = await result.fetchall()
+    if not comments_record:
+        raise RecordNotFound('No comments found for entity {}'.format(entity_id))
+    has_more = len(comments_record) > limit
+    comments_record = comments_record[:limit]
+    if before:
+        comments_record.reverse()
+    first, last = comments_record[0], comments_record[-1]
+    has_next, has_prev = (True, has_more) if before else (has_more, bool(after))
+    return Page(
+        comments_record,
+        encode_cursor(last.date_created, last.id) if has_next else None,
+        encode_cursor(first.date_created, first.id) if has_prev else None,
+    )
+
+
+@observe_db
 async def db_change_comment(conn, user, comment_id, text):
     """Change comment for the given id."""
     result = await conn.execute(
         """
         UPDATE comments
         SET text=%s, date_last_modified = %s, user_last_modified=%s
-        WHERE id=%s
+        WHERE id=%s AND deleted_at IS NULL
         RETURNING *
         """,
         (text, datetime.now(), user, comment_id)
@@ -202,42 +416,121 @@ async def db_change_comment(conn, user, comment_id, text):
         raise ExecuteException('Failed to change the comment, check whether it exists.')
 
 
-async def db_delete_comment(conn, user, comment_id):
+def _subtree_condition(hierarchy):
     """
-    Delete comment. Doesn't check permissions.
+    Condition of comments `c` of the subtree of the comment ID parameter.
 
-    Essentially, comment is NOT deleted(allowing further restore.)
-    Thus, text is set to null.
+    Subqueries here and of the root comment in the statements below
+    are uncorrelated, so they run once and the subtree is read
+    by index lookups whatever statistics are, e.g. right after a load.
     """
-    try:
-        result = await conn.execute(
-            """
-            DELETE FROM comments
-            WHERE creator=%s and id=%s
-            RETURNING *
-            """,
-            (user, comment_id)
+    if hierarchy == 'path':
+        return 'c.path @> ARRAY[%s::int]'
+    return """c.id = ANY(ARRAY(
+            SELECT ct.descendant_id FROM entities_closure_table as ct
+            WHERE ct.ancestor_type = 'comment' AND ct.ancestor_id = %s
+              AND ct.descendant_type = 'comment'
+          ))"""
+
+
+@observe_db
+async def db_delete_comment(conn, user, comment_id, hierarchy='closure'):
+    """
+    Delete comment of the user with all its replies.
+
+    Essentially, comments are NOT deleted(allowing further restore),
+    the whole subtree is tombstoned by a single statement: `deleted_at`
+    is set to the same time for all of them, history is written
+    per statement. Replies of other users are deleted too.
+    Return the number of deleted comments.
+    """
+    result = await conn.execute(
+        """
+        UPDATE comments as c
+        SET deleted_at = now(), date_last_modified = now(), user_last_modified = %s
+        WHERE {subtree} AND c.deleted_at IS NULL AND EXISTS (
+          SELECT 1 FROM comments as r
+          WHERE r.id = %s AND r.creator = %s AND r.deleted_at IS NULL
         )
-    except:
-        raise ExecuteException('Failed to delete the comment, check whether it has children.')
+        """.format(subtree=_subtree_condition(hierarchy)),
+        (user, comment_id, comment_id, user)
+    )
     if not result.rowcount:
-        raise ExecuteException('Failed to change the comment, check whether it exists.')
+        raise ExecuteException('Failed to delete the comment, check whether it exists.')
+    return result.rowcount
 
 
-async def db_get_child_comments(conn, entity_id):
+@observe_db
+async def db_restore_comment(conn, user, comment_id, hierarchy='closure'):
     """
-    Get a list of children comments for a given comment.
+    Restore deleted comment of the user with its replies.
 
-    Parent ID is returned to be able to recreate the tree on client.
+    Only replies deleted together with the comment are restored, ones
+    deleted before stay deleted. A reply to a deleted comment can't be
+    restored until its parent is. Return the number of restored comments.
     """
     result = await conn.execute(
         """
-        SELECT S.id, S.creator, S.date_created, S.date_last_modified, S.text, S.parent_id
-        FROM comments as S JOIN entities_closure_table as CT on S.id = CT.descendant_id
-        WHERE CT.ancestor_type='comment' AND CT.ancestor_id=%s AND CT.descendant_id !=%s;
-        """,
-        (entity_id, entity_id)
+        UPDATE comments as c
+        SET deleted_at = NULL, date_last_modified = now(), user_last_modified = %s
+        WHERE {subtree} AND c.deleted_at = (
+          SELECT r.deleted_at FROM comments as r
+          WHERE r.id = %s AND r.creator = %s AND (r.parent_type != 'comment' OR EXISTS (
+            SELECT 1 FROM comments as p WHERE p.id = r.parent_id AND p.deleted_at IS NULL
+          ))
+        )
+        """.format(subtree=_subtree_condition(hierarchy)),
+        (user, comment_id, comment_id, user)
     )
+    if not result.rowcount:
+        raise ExecuteException(
+            'Failed to restore the comment, check whether it is deleted and its parent is not.')
+    return result.rowcount
+
+
+def _depth_condition(hierarchy, root_type, root_id, max_depth):
+    """Condition and values to limit a subtree `S` of the root to `max_depth` levels."""
+    if max_depth is None:
+        return '', []
+    if hierarchy == 'path' and root_type == 'comment':
+        return ('AND array_length(S.path, 1) - array_position(S.path, %s) <= %s',
+                [root_id, max_depth])
+    if hierarchy == 'path':
+        return 'AND coalesce(array_length(S.path, 1), 0) <= %s', [max_depth]
+    return 'AND CT.depth <= %s', [max_depth]
+
+
+@observe_db
+async def db_get_child_comments(conn, entity_id, hierarchy='closure', max_depth=None):
+    """
+    Get a list of children comments for a given comment.
+
+    Parent type and ID are returned to be able to recreate the tree,
+    rows are ordered by creation date(see `tree.build_tree`).
+    Reply counters are maintained by triggers, see 4_reply_counters.sql.
+    Children deeper than `max_depth` levels below the first one aren't read,
+    see 5_closure_depth.sql.
+    """
+    depth_condition, depth_values = _depth_condition(
+        hierarchy, 'comment', entity_id, None if max_depth is None else max_depth + 1)
+    if hierarchy == 'path':
+        query = """
+        SELECT S.type, S.id, S.creator, S.date_created, S.date_last_modified, S.text,
+               S.parent_type, S.parent_id, S.direct_reply_count, S.descendant_count
+        FROM comments as S
+        WHERE S.path @> ARRAY[%s::int] AND S.id != %s AND S.deleted_at IS NULL {}
+        ORDER BY S.date_created, S.id;
+        """
+    else:
+        query = """
+        SELECT S.type, S.id, S.creator, S.date_created, S.date_last_modified, S.text,
+               S.parent_type, S.parent_id, S.direct_reply_count, S.descendant_count
+        FROM comments as S JOIN entities_closure_table as CT on S.id = CT.descendant_id
+        WHERE CT.ancestor_type='comment' AND CT.ancestor_id=%s AND CT.descendant_id !=%s
+          AND S.deleted_at IS NULL {}
+        ORDER BY S.date_created, S.id;
+        """
+    result = await conn.execute(query.format(depth_condition), [entity_id, entity_id] + depth_values)
     comments_record = await result.fetchall()
     if comments_record:
         return comments_record
@@ -245,73 +538,369 @@ async def db_get_child_comments(conn, entity_id):
         raise RecordNotFound('No comments found for entity {}'.format(entity_id))
 
 
-async def db_get_full_tree(conn, root_type, root_id):
+@observe_db
+async def db_get_full_tree(conn, root_type, root_id, hierarchy='closure', max_depth=None):
     """
     Get a full tree of comments for a given root.
 
-    Parent ID is returned to be able to recreate the tree on client.
+    Parent type and ID are returned to be able to recreate the tree,
+    rows are ordered by creation date(see `tree.build_tree`).
+    Reply counters are maintained by triggers, see 4_reply_counters.sql.
+    Comments deeper than `max_depth` levels below the root aren't read,
+    see 5_closure_depth.sql.
     """
-    result = await conn.execute(
+    depth_condition, depth_values = _depth_condition(hierarchy, root_type, root_id, max_depth)
+    sql_values = [root_type, root_id]
+    if hierarchy == 'path' and root_type == 'comment':
+        sql_values = [root_id]
+        query = """
+        SELECT S.type, S.id, S.creator, S.date_created, S.date_last_modified, S.text,
+               S.parent_type, S.parent_id, S.direct_reply_count, S.descendant_count
+        FROM comments as S
+        WHERE S.path @> ARRAY[%s::int] AND S.deleted_at IS NULL {}
+        ORDER BY S.date_created, S.id;
         """
-        SELECT S.id, S.creator, S.date_created, S.date_last_modified, S.text, S.parent_id
+    elif hierarchy == 'path':
+        query = """
+        SELECT S.type, S.id, S.creator, S.date_created, S.date_last_modified, S.text,
+               S.parent_type, S.parent_id, S.direct_reply_count, S.descendant_count
+        FROM entities_metadata as S
+        WHERE S.root_type=%s AND S.root_id=%s AND S.deleted_at IS NULL {}
+        ORDER BY S.date_created, S.id;
+        """
+    else:
+        query = """
+        SELECT S.type, S.id, S.creator, S.date_created, S.date_last_modified, S.text,
+               S.parent_type, S.parent_id, S.direct_reply_count, S.descendant_count
         FROM entities_metadata as S JOIN entities_closure_table as CT on S.id = CT.descendant_id and S.type=CT.descendant_type
-        WHERE CT.ancestor_type=%s AND CT.ancestor_id=%s;
+        WHERE CT.ancestor_type=%s AND CT.ancestor_id=%s AND S.deleted_at IS NULL {}
+        ORDER BY S.date_created, S.id;
+        """
+    result = await conn.execute(query.format(depth_condition), sql_values + depth_values)
+    comments_record = await result.fetchall()
+    if comments_record:
+        return comments_record
+    else:
+        raise RecordNotFound('No tree found for root {}'.format(root_id))
+
+
+# orders of children in tree windows: ORDER BY, keyset condition
+# of the next children and the sort key columns of it
+WINDOW_SORTS = {
+    'oldest': ('c.date_created, c.id',
+               '(c.date_created, c.id) > (%s::text::timestamptz, %s)',
+               ('date_created', 'id')),
+    'newest': ('c.date_created DESC, c.id DESC',
+               '(c.date_created, c.id) < (%s::text::timestamptz, %s)',
+               ('date_created', 'id')),
+    'top': ('c.descendant_count DESC, c.id',
+            '(-c.descendant_count, c.id) > (-%s::int, %s)',
+            ('descendant_count', 'id')),
+}
+
+
+@observe_db
+async def db_get_tree_window(conn, root_type, root_id, max_depth=3, max_children=10, sort='oldest',
+                             after=None):
+    """
+    Get a window of the tree of a given root: `max_depth` levels of children,
+    first `max_children` children of every comment in the `sort` order.
+
+    Children are read level by level, by an index range scan of at most
+    `max_children + 1` rows per shown comment, so it costs as many rows as
+    shown no matter how big the tree is. Rows carry their `depth` and `rank`
+    among siblings, the one ranked `max_children + 1` is not shown, it tells
+    children of its parent are cut(see `tree.build_window`).
+    `after` is a list of sort key values of the last shown first level child.
+    Works for both hierarchies, children are found by their parents.
+    """
+    order, keyset_condition, _ = WINDOW_SORTS[sort]
+    sql_values = [root_type, root_id]
+    if after:
+        keyset_condition = 'AND ' + keyset_condition
+        sql_values.extend(after)
+    else:
+        keyset_condition = ''
+    sql_values.extend([max_children + 1, max_children + 1, max_children, max_depth])
+    query = """
+    WITH RECURSIVE window_tree AS (
+        SELECT * FROM (
+            SELECT {columns}, 1 as depth, row_number() OVER (ORDER BY {order}) as rank
+            FROM comments as c
+            WHERE c.parent_type = %s AND c.parent_id = %s AND c.deleted_at IS NULL {keyset}
+            ORDER BY {order}
+            LIMIT %s
+        ) as first_level
+        UNION ALL
+        SELECT children.*
+        FROM window_tree as t CROSS JOIN LATERAL (
+            SELECT {columns}, t.depth + 1 as depth, row_number() OVER (ORDER BY {order}) as rank
+            FROM comments as c
+            WHERE c.parent_type = 'comment' AND c.parent_id = t.id AND c.deleted_at IS NULL
+            ORDER BY {order}
+            LIMIT %s
+        ) as children
+        WHERE t.rank <= %s AND t.depth < %s
+    )
+    SELECT * FROM window_tree
+    ORDER BY depth, rank;
+    """.format(
+        columns='c.type, c.id, c.creator, c.date_created, c.date_last_modified, c.text, '
+                'c.parent_type, c.parent_id, c.direct_reply_count, c.descendant_count',
+        order=order, keyset=keyset_condition)
+    try:
+        result = await conn.execute(query, sql_values)
+    except DATA_ERRORS as e:
+        raise ExecuteException('Invalid tree window: {}'.format(e))
+    return await result.fetchall()
+
+
+@observe_db
+async def db_get_comments_by_ids(conn, comment_ids):
+    """
+    Get comments by IDs, tombstoned ones too.
+
+    Rows carry roots and paths of the comments to match them with
+    subscribers of their ancestors(see `live.LiveHub`).
+    Missing comments, e.g. already purged ones, are skipped.
+    """
+    # aiopg takes params starting with a list for executemany ones,
+    # so the entity type goes first
+    result = await conn.execute(
+        """
+        SELECT S.type, S.id, S.creator, S.date_created, S.date_last_modified, S.text,
+               S.parent_type, S.parent_id, S.direct_reply_count, S.descendant_count,
+               S.deleted_at, S.root_type, S.root_id, S.path
+        FROM comments as S
+        WHERE S.type = %s AND S.id = ANY(%s::int[])
+        ORDER BY S.date_created, S.id;
         """,
-        (root_type, root_id)
+        ('comment', list(comment_ids))
     )
+    return await result.fetchall()
+
+
+@observe_db
+async def db_get_tree_version(conn, entity_type, entity_id):
+    """
+    Get the version of the tree of the given entity.
+
+    `tree_version` and `tree_modified_at` are bumped whenever the entity
+    or any of its descendants changes(see 4_reply_counters.sql),
+    so a tree is checked for changes by a primary key lookup.
+    """
+    try:
+        result = await conn.execute(
+            """
+            SELECT tree_version, tree_modified_at FROM entities_metadata
+            WHERE type = %s AND id = %s
+            """,
+            (entity_type, entity_id)
+        )
+    except DATA_ERRORS as e:
+        raise ExecuteException('Invalid entity: {}'.format(e))
+    version = await result.first()
+    if version is None:
+        raise RecordNotFound('No entity {} {}'.format(entity_type, entity_id))
+    return version
+
+
+def _search_scope(root_type, root_id, hierarchy):
+    """Condition and values to limit search by comments `c` to a subtree."""
+    if root_id is None:
+        return '', []
+    if hierarchy == 'path' and root_type == 'comment':
+        return 'AND c.path @> ARRAY[%s::int]', [root_id]
+    if hierarchy == 'path':
+        return 'AND c.root_type = %s AND c.root_id = %s', [root_type, root_id]
+    return """AND c.id IN (
+              SELECT ct.descendant_id FROM entities_closure_table as ct
+              WHERE ct.ancestor_type = %s AND ct.ancestor_id = %s
+                AND ct.descendant_type = 'comment'
+            )""", [root_type, root_id]
+
+
+@observe_db
+async def db_search_comments(conn, query, root_type=None, root_id=None, after=None, limit=20,
+                             hierarchy='closure'):
+    """
+    Search live comments by text, best matches first.
+
+    `query` is in web search syntax(quotes, `or`, `-`). Matches are found
+    by the GIN index of `search_vector`, only they are ranked, so the cost
+    depends on the number of matches rather than of comments.
+    Optionally limited to the subtree of the given root.
+    Uses keyset pagination on (rank, id), `after` is an opaque cursor
+    of the last match of the previous page. Ranks are real, they're
+    returned as double to be printed precisely enough for cursors.
+    """
+    scope_condition, sql_values = _search_scope(root_type, root_id, hierarchy)
+    sql_values = [query] + sql_values
+    if after:
+        keyset_condition = 'WHERE (m.rank, m.id) < (%s::real, %s)'
+        sql_values.extend(decode_cursor(after, 2))
+    else:
+        keyset_condition = ''
+    sql_values.append(limit)
+    try:
+        result = await conn.execute(
+            """
+            SELECT m.type, m.id, m.creator, m.date_created, m.date_last_modified, m.text,
+                   m.parent_type, m.parent_id, m.rank::float8 as rank,
+                   ts_headline('pg_catalog.english', m.text, m.query) as headline
+            FROM (
+              SELECT c.type, c.id, c.creator, c.date_created, c.date_last_modified, c.text,
+                     c.parent_type, c.parent_id, ts_rank(c.search_vector, query) as rank, query
+              FROM comments as c, websearch_to_tsquery('pg_catalog.english', %s) as query
+              WHERE c.search_vector @@ query AND c.deleted_at IS NULL {scope}
+            ) as m
+            {kc}
+            ORDER BY m.rank DESC, m.id DESC
+            LIMIT %s
+            """.format(scope=scope_condition, kc=keyset_condition),
+            sql_values
+        )
+    except DATA_ERRORS:
+        raise ExecuteException('Failed to search comments, check the cursor.')
     comments_record = await result.fetchall()
     if comments_record:
         return comments_record
     else:
-        raise RecordNotFound('No tree found for root {}'.format(root_id))
+        raise RecordNotFound('No comments found for query {}'.format(query))
 
 
-async def db_get_history(conn, user, start_date, end_date, root_entity_id):
+def _compose_history_query(user, start_date, end_date, root_entity_id):
     """
-    Fetch a history of comments.
+    Compose history query and its values for the given filters.
 
-    Update search history for the further use.
+    Dates are days, the range is inclusive. The `date` column is compared
+    as is with half-open bounds, so only the partitions of the range
+    are scanned(see `history` table).
     """
     sql_values = [user]
     if start_date:
-        start_date_condition = 'AND date >= %s::date'
+        start_date_condition = 'AND h.date >= %s::text::date'
         sql_values.append(start_date)
     else:
         start_date_condition = ''
     if end_date:
-        end_date_condition = 'AND date <= %s::date'
+        end_date_condition = 'AND h.date < %s::text::date + 1'
         sql_values.append(end_date)
     else:
         end_date_condition = ''
     if root_entity_id:
-        root_comment_condition = 'AND entity_id=%s'
+        root_comment_condition = 'AND h.entity_id=%s'
         sql_values.append(root_entity_id)
     else:
         root_comment_condition = ''
-    result = await conn.execute(
-        """
+    query = """
         SELECT * FROM history as h
-        WHERE h.entity_type='comment' AND h.user=%s {sdc} {edc} {rcc}        
+        WHERE h.user=%s AND h.entity_type='comment' {sdc} {edc} {rcc}
         """.format(
             sdc=start_date_condition,
             edc=end_date_condition,
             rcc=root_comment_condition
-        ),
-        sql_values
-    )
-    records = await result.fetchall()
+        )
+    return query, sql_values
+
+
+async def _save_search(conn, user, start_date, end_date, root_entity_id):
+    """Save a history search for the further use."""
     await conn.execute(
         """INSERT INTO search_history("user", "start_date", "end_date", "root_entity_type", "root_entity_id")
-           VALUES (%s, %s, %s, 'comment', %s)
+           VALUES (%s, %s::text::timestamptz, %s::text::timestamptz, 'comment', %s)
         """,
         (user, start_date, end_date, root_entity_id)
     )
 
+
+@observe_db
+async def db_save_searches(conn, searches):
+    """
+    Save many history searches by a single statement.
+
+    Every search is a tuple of user, start date, end date, search date
+    and root entity ID.
+    """
+    users, start_dates, end_dates, search_dates, root_entity_ids = zip(*searches)
+    # aiopg takes params starting with a list for executemany ones,
+    # so the entity type goes first
+    await conn.execute(
+        """
+        INSERT INTO search_history("root_entity_type", "user", "start_date", "end_date",
+                                   "search_date", "root_entity_id")
+        SELECT %s, s.user, s.start_date::timestamptz, s.end_date::timestamptz,
+               s.search_date, s.root_entity_id
+        FROM unnest(%s::varchar[], %s::text[], %s::text[], %s::timestamptz[], %s::int[])
+          as s("user", start_date, end_date, search_date, root_entity_id)
+        """,
+        ('comment', list(users), list(start_dates), list(end_dates), list(search_dates),
+         list(root_entity_ids))
+    )
+
+
+@observe_db
+async def db_get_history(conn, user, start_date, end_date, root_entity_id, search_history=None):
+    """
+    Fetch a history of comments.
+
+    Update search history for the further use, by `search_history` writer
+    if given(see `search_history.SearchHistoryWriter`) or right away.
+    Whole history is loaded in memory, use `db_stream_history` for exports.
+    """
+    query, sql_values = _compose_history_query(user, start_date, end_date, root_entity_id)
+    result = await conn.execute(query, sql_values)
+    records = await result.fetchall()
+    if search_history is not None:
+        search_history.add(user, start_date, end_date, root_entity_id)
+    else:
+        await _save_search(conn, user, start_date, end_date, root_entity_id)
+
     if not records:
         raise RecordNotFound('No history found for the given parameters')
     return records
 
 
+@observe_db
+async def db_stream_history(conn, user, start_date, end_date, root_entity_id,
+                            batch_size=1000, search_history=None):
+    """
+    Fetch a history of comments batch by batch.
+
+    Records are read through a server-side cursor, so only one batch
+    is held in memory at a time. Cursor lives in a transaction, so
+    the connection is busy until the generator is exhausted or closed.
+    Update search history for the further use, see `db_get_history`.
+    """
+    query, sql_values = _compose_history_query(user, start_date, end_date, root_entity_id)
+    if search_history is None:
+        await _save_search(conn, user, start_date, end_date, root_entity_id)
+    async with conn.begin():
+        await conn.execute('DECLARE history_export NO SCROLL CURSOR FOR ' + query, sql_values)
+        if search_history is not None:
+            search_history.add(user, start_date, end_date, root_entity_id)
+        found = False
+        while True:
+            result = await conn.execute(
+                'FETCH FORWARD {:d} FROM history_export'.format(batch_size))
+            records = await result.fetchall()
+            if not records:
+                break
+            found = True
+            yield records
+    if not found:
+        raise RecordNotFound('No history found for the given parameters')
+
+
+@observe_db
+async def db_create_history_partitions(conn, months_ahead):
+    """Create monthly history partitions ahead, return the number of created ones."""
+    result = await conn.execute(
+        'SELECT create_history_partitions(%s)', (months_ahead,))
+    return await result.scalar()
+
+
+@observe_db
 async def db_get_search_history(conn, user):
     """Get list of comment searches for the given user."""
     result = await conn.execute(
@@ -0,0 +1,218 @@
+"""
+Module with DB drivers.
+
+`db_*` functions are written against a small connection interface,
+which is the one of aiopg.sa:
+ - `await conn.execute(query, params)` with psycopg2-style `%s` placeholders
+   returns a result with `fetchall()`, `fetchone()`, `first()`
+   and `scalar()` coroutines and a `rowcount`;
+ - `async with conn.begin():` runs a transaction.
+Rows support both attribute and key access.
+A pool is acquired by `async with pool.acquire() as conn` and closed by
+`pool.close()` followed by `await pool.wait_closed()`.
+
+aiopg implements it natively. asyncpg is adapted: placeholders are
+rewritten to `$n`, statements are prepared once per connection and rows are
+decoded from the binary protocol. asyncpg is strict about parameter types,
+so values coming from the user are passed as python ints and texts cast
+in SQL(e.g. `%s::text::timestamptz`).
+"""
+
+import asyncio
+from collections import OrderedDict
+from functools import lru_cache
+import re
+
+import aiopg.sa
+import psycopg2
+
+try:
+    import asyncpg
+except ImportError:  # asyncpg driver is optional
+    asyncpg = None
+
+
+# errors raised by any driver on failed executions
+DB_ERRORS = (psycopg2.Error,) + ((asyncpg.PostgresError,) if asyncpg else ())
+# errors raised when input values are malformed, e.g. invalid dates
+DATA_ERRORS = (psycopg2.DataError,) + ((asyncpg.DataError,) if asyncpg else ())
+
+
+async def create_aiopg_pool(conf):
+    """Create aiopg engine, it implements the interface natively."""
+    return await aiopg.sa.create_engine(
+        database=conf['database'],
+        user=conf['user'],
+        password=conf['password'],
+        host=conf['host'],
+        port=conf['port'],
+        minsize=conf['minsize'],
+        maxsize=conf['maxsize'])
+
+
+_PLACEHOLDER_RE = re.compile(r'%(s|%)')
+
+
+@lru_cache(maxsize=1024)
+def convert_placeholders(query):
+    """Convert `%s` placeholders to asyncpg `$n` ones, `%%` to `%`."""
+    counter = iter(range(1, query.count('%s') + 1))
+    return _PLACEHOLDER_RE.sub(
+        lambda m: '${}'.format(next(counter)) if m.group(1) == 's' else '%',
+        query
+    )
+
+
+if asyncpg is not None:
+    class Record(asyncpg.Record):
+        """Record with attribute access, as aiopg rows have."""
+
+        def __getattr__(self, name):
+            try:
+                return self[name]
+            except KeyError:
+                raise AttributeError(name)
+
+    class _Connection(asyncpg.Connection):
+        """Connection which keeps its prepared statements."""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.prepared = OrderedDict()
+
+
+class AsyncpgResult:
+    """Fetched rows of a statement, with aiopg.sa result interface."""
+
+    def __init__(self, rows, status):
+        self._rows = rows
+        self._position = 0
+        # status is like 'SELECT 5', 'UPDATE 1' or 'INSERT 0 1'
+        count = status.rsplit(' ', 1)[-1] if status else ''
+        self.rowcount = int(count) if count.isdigit() else -1
+
+    async def fetchall(self):
+        rows = self._rows[self._position:]
+        self._position = len(self._rows)
+        return rows
+
+    async def fetchone(self):
+        if self._position >= len(self._rows):
+            return None
+        self._position += 1
+        return self._rows[self._position - 1]
+
+    async def first(self):
+        row = await self.fetchone()
+        self._position = len(self._rows)
+        return row
+
+    async def scalar(self):
+        row = await self.first()
+        return row[0] if row is not None else None
+
+
+class AsyncpgConnection:
+    """asyncpg connection with aiopg.sa connection interface."""
+
+    def __init__(self, conn, statements_cache_size):
+        self._conn = conn
+        self._statements_cache_size = statements_cache_size
+
+    async def _prepare(self, query):
+        statements = self._conn.prepared
+        statement = statements.get(query)
+        if statement is None:
+            statement = await self._conn.prepare(
+                convert_placeholders(query), record_class=Record)
+            statements[query] = statement
+            if len(statements) > self._statements_cache_size:
+                statements.popitem(last=False)
+        else:
+            statements.move_to_end(query)
+        return statement
+
+    async def execute(self, query, params=()):
+        statement = await self._prepare(query)
+        rows = await statement.fetch(*params)
+        return AsyncpgResult(rows, statement.get_statusmsg())
+
+    def begin(self):
+        return self._conn.transaction()
+
+
+class _AsyncpgAcquireContext:
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+
+    async def __aenter__(self):
+        self._conn = await self._pool._pool.acquire()
+        return AsyncpgConnection(self._conn, self._pool.statements_cache_size)
+
+    async def __aexit__(self, *exc_info):
+        await self._pool._pool.release(self._conn)
+
+
+class AsyncpgPool:
+    """asyncpg pool with aiopg.sa engine interface."""
+
+    def __init__(self, pool, statements_cache_size=100):
+        self._pool = pool
+        self._closing = None
+        self.statements_cache_size = statements_cache_size
+
+    def acquire(self):
+        return _AsyncpgAcquireContext(self)
+
+    @property
+    def size(self):
+        return self._pool.get_size()
+
+    @property
+    def freesize(self):
+        return self._pool.get_idle_size()
+
+    @property
+    def closed(self):
+        return self._closing is not None and self._closing.done()
+
+    def close(self):
+        self._closing = asyncio.ensure_future(self._pool.close())
+
+    async def wait_closed(self):
+        await self._closing
+
+
+async def create_asyncpg_pool(conf):
+    """Create asyncpg pool adapted to the interface."""
+    if asyncpg is None:
+        raise RuntimeError('asyncpg driver is selected but asyncpg is not installed')
+    pool = await asyncpg.create_pool(
+        database=conf['database'],
+        user=conf['user'],
+        password=conf['password'],
+        host=conf['host'],
+        port=conf['port'],
+        min_size=conf['minsize'],
+        max_size=conf['maxsize'],
+        connection_class=_Connection,
+        record_class=Record)
+    return AsyncpgPool(pool)
+
+
+DRIVERS = {
+    'aiopg': create_aiopg_pool,
+    'asyncpg': create_asyncpg_pool,
+}
+
+
+async def create_pool(conf):
+    """Create a pool of the driver selected by `driver` setting, aiopg by default."""
+    driver = conf.get('driver', 'aiopg')
+    try:
+        factory = DRIVERS[driver]
+    except KeyError:
+        raise RuntimeError('unknown DB driver {}'.format(driver))
+    return await factory(conf)
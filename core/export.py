@@ -0,0 +1,64 @@
+"""
+Module with incremental writers for the history export.
+
+Writers consume batches of history records(see `db_stream_history`)
+and write them to `aiohttp.web.StreamResponse` batch by batch,
+so memory per export stays flat regardless of the history size.
+"""
+
+from collections import namedtuple
+import json
+
+from lxml import etree
+
+
+Action = namedtuple('Action', ('entity_id', 'user', 'action', 'date', 'text'))
+
+
+def compose_action(record):
+    """Compose an ordered dict of the exported fields for the given record."""
+    return Action(
+        record.entity_id,
+        record.user,
+        record.action,
+        record.date.strftime('%Y-%m-%d %H:%M:%S'),
+        record.text
+    )._asdict()
+
+
+async def write_history_json(response, batches):
+    """Write history as a single json array."""
+    separator = '['
+    async for batch in batches:
+        chunk = ','.join(json.dumps(compose_action(record)) for record in batch)
+        await response.write((separator + chunk).encode())
+        separator = ','
+    await response.write(b']' if separator == ',' else b'[]')
+
+
+async def write_history_ndjson(response, batches):
+    """Write history as newline delimited json, one action per line."""
+    async for batch in batches:
+        chunk = ''.join(json.dumps(compose_action(record)) + '\n' for record in batch)
+        await response.write(chunk.encode())
+
+
+async def write_history_xml(response, batches):
+    """Write history as xml using lxml incremental writer."""
+    async with etree.xmlfile(response, encoding='utf-8') as xf:
+        async with xf.element('Actions'):
+            async for batch in batches:
+                for record in batch:
+                    e_action = etree.Element('Action')
+                    for attr, val in compose_action(record).items():
+                        sub = etree.SubElement(e_action, attr)
+                        sub.text = str(val)
+                    await xf.write(e_action)
+                await xf.flush()
+
+
+HISTORY_WRITERS = {
+    'json': write_history_json,
+    'ndjson': write_history_ndjson,
+    'xml': write_history_xml,
+}
@@ -0,0 +1,217 @@
+"""
+Module to serve the app by a few worker processes.
+
+Workers are forked before any event loop or connection is created and
+listen on the same port with SO_REUSEPORT, so the kernel balances
+connections between them. The master only watches the workers:
+a crashed one is started again, SIGTERM or SIGINT is passed to every
+worker as SIGTERM to shut down gracefully.
+
+A worker shuts down gracefully: it stops accepting connections, waits
+for requests in flight(see `drain`) and only then closes its pools.
+Pool sizes of the settings are the budget of the whole server,
+so they're split between the workers(see `split_pools`).
+"""
+
+import asyncio
+import copy
+import logging
+import math
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import signal
+import time
+
+from aiohttp import web
+
+
+log = logging.getLogger(__name__)
+
+# seconds between a worker crash and its restart, not to spin on a broken DB
+RESPAWN_DELAY = 1
+
+
+class InflightRequests:
+    """Counter of requests being handled, `wait` returns when there's none."""
+
+    def __init__(self):
+        self.count = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def __enter__(self):
+        self.count += 1
+        self._idle.clear()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.count -= 1
+        if not self.count:
+            self._idle.set()
+
+    async def wait(self, timeout=None):
+        """Wait for requests in flight, return False on timeout."""
+        if self._idle.is_set():
+            return True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+@web.middleware
+async def drain_middleware(request, handler):
+    """Count requests in flight of the app, see `drain`."""
+    inflight = request.app.get('inflight')
+    if inflight is None:
+        return await handler(request)
+    with inflight:
+        return await handler(request)
+
+
+async def init_drain(app, env='dev'):
+    """Init an app to wait for requests in flight on shutdown."""
+    app['inflight'] = InflightRequests()
+    app['shutdown_timeout'] = app['config'][env]['server']['shutdown_timeout']
+
+
+async def drain(app):
+    """
+    Wait for requests in flight of the app.
+
+    It's an `on_shutdown` hook, aiohttp runs them after listening sockets
+    are closed, but before handlers are cancelled and `on_cleanup` hooks
+    close the pools.
+    """
+    inflight = app['inflight']
+    if inflight.count:
+        log.info('draining %s requests', inflight.count)
+    if not await inflight.wait(app['shutdown_timeout']):
+        log.warning('%s requests are still in flight, cancelling them', inflight.count)
+
+
+def _split_pool(conf, workers):
+    split = {}
+    if 'maxsize' in conf:
+        split['maxsize'] = max(1, conf['maxsize'] // workers)
+    if 'minsize' in conf:
+        split['minsize'] = math.ceil(conf['minsize'] / workers)
+        if 'maxsize' in split:
+            split['minsize'] = min(split['minsize'], split['maxsize'])
+    return split
+
+
+def split_pools(config, env, workers):
+    """
+    Return a copy of the config with pool sizes of the env split between workers.
+
+    Max sizes are rounded down, so the workers never open more connections
+    than configured, but every worker gets one at least.
+    Replicas are split too when they override the primary sizes.
+    """
+    config = copy.deepcopy(config)
+    conf = config[env]['postgres']
+    conf.update(_split_pool(conf, workers))
+    for replica in conf.get('replicas', ()):
+        replica.update(_split_pool(replica, workers))
+    return config
+
+
+def default_workers(config, env):
+    """
+    Return the number of cores, but no more workers than get two connections each.
+
+    A worker needs one connection for writes besides the ones of exports
+    and reads, see `admission.AdmissionController`.
+    """
+    workers = os.cpu_count() or 1
+    maxsize = config[env]['postgres'].get('maxsize')
+    if maxsize is not None:
+        workers = min(workers, max(1, maxsize // 2))
+    return workers
+
+
+def run_worker(create_app, env, config, index, host, port, reuse_port=True):
+    """
+    Serve the app in the current process until SIGTERM or SIGINT.
+
+    Only the first worker does periodic maintenance.
+    """
+    app = create_app(env, config, maintenance=index == 0)
+    web.run_app(
+        app, host=host, port=port, reuse_port=reuse_port,
+        shutdown_timeout=config[env]['server']['shutdown_timeout'])
+
+
+def _worker_main(*args):
+    # handlers of the master are inherited, aiohttp sets its own on start
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    # only the master gets signals of the terminal
+    os.setpgrp()
+    run_worker(*args)
+
+
+def _start_worker(create_app, env, config, index, host, port):
+    # forked, so the app factory doesn't need to be picklable
+    process = multiprocessing.get_context('fork').Process(
+        target=_worker_main, args=(create_app, env, config, index, host, port),
+        name='worker{}'.format(index))
+    process.start()
+    return process
+
+
+def serve(create_app, env, config, workers=None, host=None, port=None):
+    """
+    Serve the app by pre-forked workers, see the module docs.
+
+    `create_app(env, config, maintenance)` creates the app of a worker,
+    the number of workers is taken from the settings, see `default_workers` otherwise.
+    """
+    server = config[env]['server']
+    workers = workers or server.get('workers') or default_workers(config, env)
+    host = host or server['host']
+    port = port or server['port']
+    config = split_pools(config, env, workers)
+    if workers == 1:
+        run_worker(create_app, env, config, 0, host, port, reuse_port=False)
+        return
+
+    processes = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(workers):
+        if stopping:
+            break
+        processes[index] = _start_worker(create_app, env, config, index, host, port)
+
+    while not stopping:
+        sentinels = {process.sentinel: index for index, process in processes.items()}
+        for sentinel in wait(list(sentinels)):
+            index = sentinels[sentinel]
+            processes[index].join()
+            if stopping:
+                break
+            log.error('worker%s exited with %s, restarting it', index, processes[index].exitcode)
+            time.sleep(RESPAWN_DELAY)
+            processes[index] = _start_worker(create_app, env, config, index, host, port)
+
+    # workers wait for requests in flight up to the shutdown timeout
+    deadline = time.monotonic() + server['shutdown_timeout'] + 5
+    for process in processes.values():
+        process.join(max(0, deadline - time.monotonic()))
+        if process.is_alive():
+            log.error('%s is stuck on shutdown, killing it', process.name)
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
@@ -0,0 +1,231 @@
+"""
+Module to push comment changes to live subscribers of trees.
+
+Clients subscribe to a post or a comment by Server-Sent Events
+(see `views.subscribe_comments`) instead of polling its tree.
+Changes come from the app listener(see `notify`), so subscribers cost no
+DB connections: comments changed by a statement are read once by their IDs
+and sent to subscribers of their ancestors, which are found by roots and
+paths of the comments in the dict of subscriptions.
+
+Every subscription has a bounded queue of events. A subscriber which
+doesn't keep up is sent `reset` and disconnected, all of them are when
+notifications may have been lost. Clients fetch the tree again on `reset`.
+"""
+
+import asyncio
+import logging
+
+from db import db_get_comments_by_ids
+from notify import changed_roots
+from serializers import dumps, row_to_dict
+from tree import TREE_COLUMNS
+
+
+LIVE_COLUMNS = TREE_COLUMNS + ('deleted_at',)
+
+logger = logging.getLogger(__name__)
+
+
+def format_event(event, data):
+    """Format a Server-Sent Event out of its name and JSON bytes."""
+    return b'event: ' + event.encode() + b'\ndata: ' + data + b'\n\n'
+
+
+RESET = format_event('reset', b'{}')
+# a comment line, keeps proxies from closing idle streams
+HEARTBEAT = b': ping\n\n'
+
+
+class TooManySubscribers(Exception):
+    """Subscriptions of a worker are capped."""
+
+
+class Subscription:
+    """Queue of events of a subscriber to the tree of the root entity."""
+
+    def __init__(self, root, queue_size=100):
+        self.root = root
+        self.queue_size = queue_size
+        self.closed = False
+        self._queue = asyncio.Queue()
+
+    def push(self, event):
+        """Queue an event, return False if the subscriber doesn't keep up."""
+        if self.closed:
+            return True
+        if self._queue.qsize() >= self.queue_size:
+            return False
+        self._queue.put_nowait(event)
+        return True
+
+    def close(self, event=None):
+        """Drop queued events and end the stream, after the given event if any."""
+        if self.closed:
+            return
+        self.closed = True
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        if event is not None:
+            self._queue.put_nowait(event)
+        self._queue.put_nowait(None)
+
+    async def events(self, heartbeat=15):
+        """Yield events until the subscription is closed, heartbeats while idle."""
+        while True:
+            try:
+                event = await asyncio.wait_for(self._queue.get(), heartbeat)
+            except asyncio.TimeoutError:
+                event = HEARTBEAT
+            if event is None:
+                return
+            yield event
+
+
+class LiveHub:
+    """Subscriptions to trees, fed by notifications of comment changes."""
+
+    def __init__(self, pool, max_subscribers=10000, queue_size=100, heartbeat=15, write_timeout=10):
+        self.pool = pool
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self.heartbeat = heartbeat
+        self.write_timeout = write_timeout
+        self.subscribers = 0
+        self.dropped = 0
+        self._subscriptions = {}
+        self._pending_ids = set()
+        self._pending_roots = set()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def subscribe(self, root):
+        """Subscribe to changes of the tree of the root(type, ID)."""
+        if self.subscribers >= self.max_subscribers:
+            raise TooManySubscribers('Too many subscribers, try again later')
+        subscription = Subscription(root, self.queue_size)
+        self._subscriptions.setdefault(root, set()).add(subscription)
+        self.subscribers += 1
+        return subscription
+
+    def unsubscribe(self, subscription, event=None):
+        """Remove the subscription and end its stream."""
+        subscriptions = self._subscriptions.get(subscription.root)
+        if subscriptions is not None and subscription in subscriptions:
+            subscriptions.remove(subscription)
+            self.subscribers -= 1
+            if not subscriptions:
+                del self._subscriptions[subscription.root]
+        subscription.close(event)
+
+    def _push(self, subscriptions, event):
+        for subscription in list(subscriptions):
+            if not subscription.push(event):
+                self.dropped += 1
+                self.unsubscribe(subscription, RESET)
+
+    def reset(self):
+        """Make every subscriber fetch its tree again."""
+        for subscriptions in list(self._subscriptions.values()):
+            for subscription in list(subscriptions):
+                self.unsubscribe(subscription, RESET)
+
+    def on_notify(self, message):
+        """Queue changed comments of the subscribed trees to be sent."""
+        if message.get('truncated'):
+            logger.info('Truncated notification, resetting subscribers')
+            self.reset()
+            return
+        roots = [root for root in changed_roots(message) if root in self._subscriptions]
+        if not roots:
+            return
+        ids = message.get('ids') or []
+        if message['op'] == 'delete':
+            # purged comments can't be read, their IDs are sent as they are
+            event = format_event('delete', dumps({'ids': ids}))
+            for root in roots:
+                self._push(self._subscriptions.get(root, ()), event)
+            return
+        self._pending_ids.update(ids)
+        self._pending_roots.update(roots)
+        self._wakeup.set()
+
+    def on_listener_reset(self, connected):
+        """Notifications may have been lost, so subscribers are reset."""
+        self.reset()
+
+    def _fan_out(self, rows):
+        """Send every subscribed tree its changed rows, serialized once."""
+        changes = {}
+        for row in rows:
+            data = None
+            ancestors = [(row['root_type'], row['root_id'])]
+            ancestors.extend(('comment', comment_id) for comment_id in row['path'])
+            for ancestor in ancestors:
+                if ancestor in self._subscriptions:
+                    if data is None:
+                        data = dumps(row_to_dict(row, LIVE_COLUMNS, convert=None))
+                    changes.setdefault(ancestor, []).append(data)
+        for root, changed in changes.items():
+            event = format_event('comments', b'[' + b','.join(changed) + b']')
+            self._push(self._subscriptions.get(root, ()), event)
+
+    async def _send_changes(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # changes queued while reading are sent by the next pass
+            ids, roots = self._pending_ids, self._pending_roots
+            self._pending_ids, self._pending_roots = set(), set()
+            try:
+                async with self.pool.acquire() as conn:
+                    rows = await db_get_comments_by_ids(conn, ids)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Failed to read changed comments, resetting their subscribers')
+                for root in roots:
+                    for subscription in list(self._subscriptions.get(root, ())):
+                        self.unsubscribe(subscription, RESET)
+                continue
+            self._fan_out(rows)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._send_changes())
+
+    async def close(self):
+        """Stop sending changes, subscribers are reset to reconnect elsewhere."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self.reset()
+
+    def stats(self):
+        return {
+            'subscribers': self.subscribers,
+            'trees': len(self._subscriptions),
+            'dropped': self.dropped,
+        }
+
+
+async def init_live(app, env='dev'):
+    """Init an app with live subscriptions, fed by the app listener."""
+    conf = app['config'][env]['live']
+    # changes are read from the primary, replicas may lag behind notifications
+    hub = LiveHub(
+        app['db'],
+        max_subscribers=conf['max_subscribers'],
+        queue_size=conf['queue_size'],
+        heartbeat=conf['heartbeat'],
+        write_timeout=conf['write_timeout'])
+    app['listener'].add_handler(hub.on_notify, hub.on_listener_reset)
+    hub.start()
+    app['live'] = hub
+
+
+async def close_live(app):
+    """End live streams of the app, so they don't hold up the shutdown."""
+    await app['live'].close()
@@ -1,24 +1,91 @@
+"""
+Entry point of the app.
+
+`create_app` builds the app for the given env without starting anything,
+so it can be imported, e.g. by tests or `aiohttp.web` runners.
+Serve it by pre-forked workers(see `launcher`):
+
+    python core/main.py --env dev --workers 4
+"""
+
+import argparse
+from functools import partial
+
 from aiohttp import web
 import aiohttp_jinja2
-import asyncio
 import jinja2
 
 from routes import setup_routes
-from settings import config
+from settings import config as default_config
+from admission import admission_middleware, init_admission
+from cache import init_tree_cache
+from compression import compression_middleware, init_compression
 from db import close_pg, init_pg
+from live import close_live, init_live
+from launcher import drain, drain_middleware, init_drain, serve
+from maintenance import close_maintenance, init_maintenance
+from metrics import metrics_middleware
+from notify import close_listener, init_listener
+from replicas import init_replica_routing
+from search_history import close_search_history, init_search_history
+from singleflight import init_single_flight
+
+
+def create_app(env='dev', config=default_config, maintenance=True):
+    """
+    Create the app with settings of the env.
+
+    Periodic maintenance is only needed in one process of a few
+    serving the same DB, see `launcher.serve`.
+    """
+    # metrics see response sizes after compression and requests shed by admission control
+    app = web.Application(middlewares=[
+        drain_middleware, metrics_middleware, admission_middleware, compression_middleware])
+    app['config'] = config
 
+    # setup Jinja2 template renderer
+    # since we're running from core package, just point on templates
+    aiohttp_jinja2.setup(app, loader=jinja2.PackageLoader('templates', ''))
 
-loop = asyncio.get_event_loop()
-app = web.Application(loop=loop)
-app['config'] = config
+    setup_routes(app)
+    # create connection to the database
+    app.on_startup.append(partial(init_pg, env=env))
+    # save history searches in batches
+    app.on_startup.append(partial(init_search_history, env=env))
+    # listen to comment changes to invalidate the tree cache
+    app.on_startup.append(partial(init_listener, env=env))
+    app.on_startup.append(partial(init_tree_cache, env=env))
+    # concurrent misses of a tree share one query
+    app.on_startup.append(partial(init_single_flight, env=env))
+    # push comment changes to subscribers
+    app.on_startup.append(partial(init_live, env=env))
+    app.on_startup.append(partial(init_compression, env=env))
+    app.on_startup.append(partial(init_replica_routing, env=env))
+    # handle requests by priority, shed the excess with 503
+    app.on_startup.append(partial(init_admission, env=env))
+    # wait for requests in flight on shutdown, before the pools are closed
+    app.on_startup.append(partial(init_drain, env=env))
+    # end live streams first, they'd be drained until the timeout otherwise
+    app.on_shutdown.append(close_live)
+    app.on_shutdown.append(drain)
+    if maintenance:
+        # create history partitions ahead
+        app.on_startup.append(partial(init_maintenance, env=env))
+        app.on_cleanup.append(close_maintenance)
+    # drain buffered searches before the pool is closed
+    app.on_cleanup.append(close_search_history)
+    # shutdown db connection on exit
+    app.on_cleanup.append(close_pg)
+    app.on_cleanup.append(close_listener)
+    return app
 
-# setup Jinja2 template renderer
-# since we're running from core package, just point on templates
-aiohttp_jinja2.setup(app, loader=jinja2.PackageLoader('templates', ''))
 
-setup_routes(app)
-# create connection to the database
-app.on_startup.append(init_pg)
-# shutdown db connection on exit
-app.on_cleanup.append(close_pg)
-web.run_app(app, port=8080)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--env', default='dev')
+    parser.add_argument('--workers', type=int, help='worker processes of the env server settings by default')
+    parser.add_argument('--host', help='host of the env server settings by default')
+    parser.add_argument('--port', type=int, help='port of the env server settings by default')
+    args = parser.parse_args()
+    serve(create_app, args.env, default_config, workers=args.workers, host=args.host, port=args.port)
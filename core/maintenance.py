@@ -0,0 +1,65 @@
+"""
+Module with periodic DB maintenance of the app.
+
+History partitions are created months ahead(see `create_history_partitions`),
+so inserts never hit the default partition while the app is running.
+"""
+
+import asyncio
+import logging
+
+from db import db_create_history_partitions
+
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicTask:
+    """Run a coroutine function every `interval` seconds, errors are logged."""
+
+    def __init__(self, func, interval):
+        self.func = func
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            try:
+                await self.func()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Periodic task %s failed', self.func.__name__)
+            await asyncio.sleep(self.interval)
+
+
+async def init_maintenance(app, env='dev'):
+    """Start periodic maintenance tasks of the app."""
+    conf = app['config'][env]['history_partitions']
+
+    async def create_history_partitions():
+        async with app['db'].acquire() as conn:
+            created = await db_create_history_partitions(conn, conf['months_ahead'])
+        if created:
+            logger.info('Created %d history partitions', created)
+
+    app['maintenance'] = [PeriodicTask(create_history_partitions, conf['interval'])]
+    for task in app['maintenance']:
+        task.start()
+
+
+async def close_maintenance(app):
+    """Stop periodic maintenance tasks of the app."""
+    for task in app['maintenance']:
+        await task.stop()
@@ -0,0 +1,348 @@
+"""
+Module with metrics of the app in Prometheus text format.
+
+Metrics are plain counters kept in process, so recording is a dict lookup
+and a few additions, and cheap enough to be always on:
+ - `db_*` functions latency, returned rows and errors(see `observe_db`);
+ - pool acquire wait time, timeouts and connections in use/free(see `InstrumentedPool`);
+ - request latency and response size per route(see `metrics_middleware`);
+ - calls of single flights and calls coalesced with them(see `singleflight`);
+ - admission wait time and shed requests per class(see `admission`).
+Everything is rendered on scrape of `/metrics`.
+"""
+
+import asyncio
+from bisect import bisect_left
+from functools import wraps
+import inspect
+import time
+import weakref
+
+from aiohttp import web
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+BYTES_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(n, _escape(v)) for n, v in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base of metrics, values are kept per label values."""
+
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.type),
+        ]
+        for label_values, value in sorted(self._collect().items()):
+            lines.extend(self._render_value(label_values, value))
+        return lines
+
+    def _collect(self):
+        return self._values
+
+    def _render_value(self, label_values, value):
+        return ['{}{} {}'.format(
+            self.name, _format_labels(self.labels, label_values), _format_value(value))]
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    """Gauge which values are collected on render by `collect` function."""
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), collect=None):
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+
+    def _collect(self):
+        return self.collect() if self.collect is not None else self._values
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        counts = self._values.get(label_values)
+        if counts is None:
+            # bucket counts, +Inf bucket count, sum and count
+            counts = self._values[label_values] = [0] * (len(self.buckets) + 3)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def _render_value(self, label_values, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                self.name,
+                _format_labels(self.labels, label_values, [('le', _format_value(bound))]),
+                cumulative))
+        labels = _format_labels(self.labels, label_values)
+        lines.append('{}_sum{} {}'.format(self.name, labels, _format_value(counts[-2])))
+        lines.append('{}_count{} {}'.format(self.name, labels, counts[-1]))
+        return lines
+
+
+_pools = weakref.WeakSet()
+
+
+def _collect_pools():
+    values = {}
+    for pool in list(_pools):
+        if pool.closed:
+            continue
+        values[(pool.name, 'in_use')] = pool.size - pool.freesize
+        values[(pool.name, 'free')] = pool.freesize
+    return values
+
+
+DB_DURATION = Histogram(
+    'db_query_duration_seconds', 'Duration of db_* functions.', ('function',))
+DB_ROWS = Histogram(
+    'db_query_rows', 'Rows returned by db_* functions.', ('function',), ROWS_BUCKETS)
+DB_FAILURES = Counter(
+    'db_query_errors_total', 'Exceptions raised by db_* functions.', ('function', 'exception'))
+POOL_ACQUIRE = Histogram(
+    'db_pool_acquire_seconds', 'Time waited for a pooled connection.', ('pool',))
+POOL_ACQUIRE_TIMEOUTS = Counter(
+    'db_pool_acquire_timeouts_total', 'Acquires which timed out waiting for a connection.', ('pool',))
+POOL_CONNECTIONS = Gauge(
+    'db_pool_connections', 'Pooled connections by state.', ('pool', 'state'),
+    collect=_collect_pools)
+HTTP_DURATION = Histogram(
+    'http_request_duration_seconds', 'Duration of requests.', ('route', 'method', 'status'))
+HTTP_RESPONSE_BYTES = Histogram(
+    'http_response_bytes', 'Size of response bodies.', ('route', 'method'), BYTES_BUCKETS)
+SINGLE_FLIGHT_CALLS = Counter(
+    'single_flight_calls_total', 'Calls run by single flights.', ('flight',))
+SINGLE_FLIGHT_COALESCED = Counter(
+    'single_flight_coalesced_total', 'Calls which waited for an identical call in flight.', ('flight',))
+ADMISSION_WAIT = Histogram(
+    'admission_wait_seconds', 'Time admitted requests waited in queues.', ('class',))
+ADMISSION_REJECTED = Counter(
+    'admission_rejected_total', 'Requests answered 503 when overloaded.', ('class', 'reason'))
+
+METRICS = [
+    DB_DURATION, DB_ROWS, DB_FAILURES, POOL_ACQUIRE, POOL_ACQUIRE_TIMEOUTS, POOL_CONNECTIONS,
+    HTTP_DURATION, HTTP_RESPONSE_BYTES, SINGLE_FLIGHT_CALLS, SINGLE_FLIGHT_COALESCED,
+    ADMISSION_WAIT, ADMISSION_REJECTED,
+]
+
+
+def render():
+    """Render all the metrics in Prometheus text format."""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def _count_rows(result):
+    rows = getattr(result, 'rows', result)
+    try:
+        return len(rows)
+    except TypeError:
+        return None
+
+
+def observe_db(func):
+    """
+    Record latency, returned rows and errors of a `db_*` function.
+
+    Async generators are observed until they're exhausted or closed,
+    rows of all the yielded batches are counted.
+    """
+    name = func.__name__
+
+    if inspect.isasyncgenfunction(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            rows = 0
+            batches = func(*args, **kwargs)
+            try:
+                async for batch in batches:
+                    rows += len(batch)
+                    yield batch
+            except Exception as e:
+                DB_FAILURES.inc(name, type(e).__name__)
+                raise
+            finally:
+                # close the wrapped generator too, e.g. to end its transaction
+                await batches.aclose()
+                DB_DURATION.observe(time.perf_counter() - start, name)
+                DB_ROWS.observe(rows, name)
+        return wrapper
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            DB_FAILURES.inc(name, type(e).__name__)
+            raise
+        finally:
+            DB_DURATION.observe(time.perf_counter() - start, name)
+        rows = _count_rows(result)
+        if rows is not None:
+            DB_ROWS.observe(rows, name)
+        return result
+    return wrapper
+
+
+class AcquireTimeout(Exception):
+    """No pooled connection was free within the acquire timeout."""
+
+
+class _InstrumentedAcquireContext:
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._context = None
+
+    async def __aenter__(self):
+        start = time.perf_counter()
+        self._context = self._pool.pool.acquire()
+        try:
+            if self._pool.acquire_timeout is None:
+                return await self._context.__aenter__()
+            return await self._acquire(self._pool.acquire_timeout)
+        finally:
+            POOL_ACQUIRE.observe(time.perf_counter() - start, self._pool.name)
+
+    async def _acquire(self, timeout):
+        # not `wait_for`, it may drop a connection acquired just as it times out
+        acquire = asyncio.ensure_future(self._context.__aenter__())
+        try:
+            await asyncio.wait([acquire], timeout=timeout)
+        except asyncio.CancelledError:
+            await self._abandon(acquire)
+            raise
+        if acquire.done():
+            return acquire.result()
+        await self._abandon(acquire)
+        POOL_ACQUIRE_TIMEOUTS.inc(self._pool.name)
+        raise AcquireTimeout('No connection of {} pool in {}s'.format(self._pool.name, timeout))
+
+    async def _abandon(self, acquire):
+        """Cancel the acquire, release its connection if it got one anyway."""
+        acquire.cancel()
+        await asyncio.wait([acquire])
+        if not acquire.cancelled() and acquire.exception() is None:
+            await self._context.__aexit__(None, None, None)
+
+    async def __aexit__(self, *exc_info):
+        return await self._context.__aexit__(*exc_info)
+
+
+class InstrumentedPool:
+    """
+    Pool wrapper which records acquire wait time and connections.
+
+    Acquires waiting longer than `acquire_timeout` seconds
+    raise `AcquireTimeout`, they wait for as long as it takes by default.
+    """
+
+    def __init__(self, pool, name, acquire_timeout=None):
+        self.pool = pool
+        self.name = name
+        self.acquire_timeout = acquire_timeout
+        _pools.add(self)
+
+    def acquire(self):
+        return _InstrumentedAcquireContext(self)
+
+    @property
+    def size(self):
+        return self.pool.size
+
+    @property
+    def freesize(self):
+        return self.pool.freesize
+
+    @property
+    def closed(self):
+        return self.pool.closed
+
+    def close(self):
+        self.pool.close()
+
+    async def wait_closed(self):
+        await self.pool.wait_closed()
+
+
+def _route_name(request):
+    route = request.match_info.route
+    if route.resource is None:
+        # unmatched paths are not labeled to keep the number of series bounded
+        return 'unmatched'
+    return route.resource.canonical
+
+
+def _body_size(response):
+    if response.prepared:
+        return response.body_length
+    body = getattr(response, 'body', None)
+    return len(body) if isinstance(body, (bytes, bytearray)) else 0
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """Record latency and response size of requests per route."""
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        route = _route_name(request)
+        HTTP_DURATION.observe(time.perf_counter() - start, route, request.method, str(status))
+    HTTP_RESPONSE_BYTES.observe(_body_size(response), route, request.method)
+    return response
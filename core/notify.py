@@ -0,0 +1,117 @@
+"""
+Module to receive Postgres notifications.
+
+A single dedicated connection LISTENs to the channel and dispatches
+decoded payloads to the registered handlers, so the number of listeners
+doesn't cost any pooled connections.
+Notifications sent while the connection is down are lost, so handlers are
+reset on every(re)connect and must drop any state which relies on them.
+"""
+
+import asyncio
+import json
+import logging
+
+import aiopg
+
+
+CHANNEL = 'comment_changes'
+
+logger = logging.getLogger(__name__)
+
+
+def changed_roots(message):
+    """
+    Return roots(type, ID) changed by a comment change notification.
+
+    Changed comments are sent as `ids`, their other ancestors as `roots`,
+    see notify_comments of dbtools/init/3_hierarchy_path.sql.
+    """
+    roots = [tuple(root) for root in message.get('roots') or ()]
+    roots.extend(('comment', comment_id) for comment_id in message.get('ids') or ())
+    return roots
+
+
+class NotificationListener:
+    """Dispatch notifications of a channel to handlers."""
+
+    def __init__(self, dsn, channel=CHANNEL, reconnect_delay=1):
+        self.dsn = dsn
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self.connected = False
+        self._handlers = []
+        self._task = None
+
+    def add_handler(self, on_notify, on_reset=None):
+        """
+        Register a handler.
+
+        `on_notify` is called with a decoded payload,
+        `on_reset` is called with connected flag right away
+        and whenever it changes.
+        """
+        self._handlers.append((on_notify, on_reset))
+        if on_reset is not None:
+            on_reset(self.connected)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._listen())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._set_connected(False)
+
+    def _set_connected(self, connected):
+        self.connected = connected
+        for _, on_reset in self._handlers:
+            if on_reset is not None:
+                on_reset(connected)
+
+    def _dispatch(self, payload):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            logger.warning('Malformed notification %r', payload)
+            return
+        for on_notify, _ in self._handlers:
+            on_notify(message)
+
+    async def _listen(self):
+        while True:
+            try:
+                async with aiopg.connect(self.dsn) as conn:
+                    async with conn.cursor() as cur:
+                        await cur.execute('LISTEN {}'.format(self.channel))
+                    self._set_connected(True)
+                    while True:
+                        notification = await conn.notifies.get()
+                        self._dispatch(notification.payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Listener of %s failed, reconnecting', self.channel)
+            self._set_connected(False)
+            await asyncio.sleep(self.reconnect_delay)
+
+
+def compose_dsn(conf):
+    """Compose libpq connection string out of postgres settings."""
+    return 'dbname={database} user={user} password={password} host={host} port={port}'.format(**conf)
+
+
+async def init_listener(app, env='dev'):
+    """Start the notifications listener for the app."""
+    listener = NotificationListener(compose_dsn(app['config'][env]['postgres']))
+    app['listener'] = listener
+    listener.start()
+
+
+async def close_listener(app):
+    """Stop the notifications listener for the app."""
+    await app['listener'].stop()
@@ -0,0 +1,46 @@
+"""
+Module with helpers for keyset(cursor) pagination.
+
+A cursor is an opaque token which holds the sort key values
+of the last(or first) row of the page, so the next page is fetched with
+`WHERE (key1, key2) > (%s, %s)` and costs the same regardless of depth.
+Clients must not rely on the token format.
+"""
+
+import base64
+import json
+from collections import namedtuple
+from datetime import datetime
+
+
+Page = namedtuple('Page', ('rows', 'next_cursor', 'prev_cursor'))
+
+
+class InvalidCursor(ValueError):
+    """Custom exception for malformed cursors."""
+
+
+def encode_cursor(*values):
+    """Encode sort key values into an opaque url-safe token."""
+    payload = json.dumps(
+        [v.isoformat() if isinstance(v, datetime) else v for v in values],
+        separators=(',', ':')
+    )
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, size):
+    """
+    Decode a token produced by `encode_cursor`.
+
+    Datetimes are returned as iso strings, they're cast in SQL.
+    """
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (ValueError, TypeError):
+        raise InvalidCursor('Malformed cursor {}'.format(token))
+    if not isinstance(values, list) or len(values) != size:
+        raise InvalidCursor('Malformed cursor {}'.format(token))
+    return values
+
@@ -0,0 +1,79 @@
+"""
+Module to route read-only queries to replicas.
+
+Reads are balanced over replica pools round-robin or to the least busy one.
+Replicas lag behind the primary, so reads stay on the primary for
+`sticky_window` seconds after a write of the same key:
+ - a user, so the user reads its own writes;
+ - a tree root, changed by anyone(see comment change notifications),
+   so the tree cache isn't refilled with a stale tree.
+"""
+
+from collections import OrderedDict
+import time
+
+from notify import changed_roots
+
+
+BALANCING = ('round_robin', 'least_busy')
+
+
+class ReplicaRouter:
+    """Choose a pool for reads, the primary one is used for writes."""
+
+    def __init__(self, primary, replicas=(), balancing='round_robin', sticky_window=5,
+                 clock=time.monotonic):
+        if balancing not in BALANCING:
+            raise RuntimeError('unknown balancing {}'.format(balancing))
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.balancing = balancing
+        self.sticky_window = sticky_window
+        self.clock = clock
+        self._next = 0
+        # key -> deadline, ordered by deadline
+        self._sticky = OrderedDict()
+        self._sticky_all = 0
+
+    def mark_write(self, *keys):
+        """Keep reads of the given keys on the primary for the sticky window."""
+        now = self.clock()
+        deadline = now + self.sticky_window
+        for key in keys:
+            self._sticky.pop(key, None)
+            self._sticky[key] = deadline
+        while self._sticky:
+            key, key_deadline = next(iter(self._sticky.items()))
+            if key_deadline > now:
+                break
+            del self._sticky[key]
+
+    def mark_write_all(self):
+        """Keep all reads on the primary for the sticky window."""
+        self._sticky_all = self.clock() + self.sticky_window
+
+    def on_notify(self, message):
+        """Handle a comment change notification, see `notify` module."""
+        if message.get('truncated'):
+            self.mark_write_all()
+        else:
+            self.mark_write(*changed_roots(message))
+
+    def read_pool(self, *keys):
+        """Choose a pool to read the given keys."""
+        if not self.replicas:
+            return self.primary
+        now = self.clock()
+        if now < self._sticky_all or any(self._sticky.get(key, 0) > now for key in keys):
+            return self.primary
+        self._next = (self._next + 1) % len(self.replicas)
+        if self.balancing == 'least_busy':
+            # rotated, so idle replicas share the load too
+            replicas = self.replicas[self._next:] + self.replicas[:self._next]
+            return min(replicas, key=lambda pool: pool.size - pool.freesize)
+        return self.replicas[self._next]
+
+
+async def init_replica_routing(app, env='dev'):
+    """Keep reads of changed trees on the primary, the app listener must be set up."""
+    app['listener'].add_handler(app['db_router'].on_notify)
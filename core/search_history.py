@@ -0,0 +1,97 @@
+"""
+Module with write-behind of history searches.
+
+History requests only append their searches to an in-memory buffer,
+which is flushed by a single multi-row INSERT(see `db_save_searches`)
+once `max_batch` searches are buffered or every `flush_interval` seconds.
+So requests neither wait for the insert nor hold a pooled connection for it.
+The buffer is drained on app cleanup, but a crash loses the buffered
+searches: at most `max_batch` of them, made within `flush_interval` seconds.
+Searches of a failed flush are logged and dropped.
+"""
+
+import asyncio
+from datetime import datetime, timezone
+import logging
+
+from db import db_save_searches
+
+
+logger = logging.getLogger(__name__)
+
+
+class SearchHistoryWriter:
+    """Buffer history searches and save them in batches."""
+
+    def __init__(self, pool, max_batch=100, flush_interval=1):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self._buffer = []
+        self._flushes = set()
+        self._task = None
+
+    def add(self, user, start_date, end_date, root_entity_id):
+        """Buffer a search, search date is the current time."""
+        self._buffer.append(
+            (user, start_date, end_date, datetime.now(timezone.utc), root_entity_id))
+        if len(self._buffer) >= self.max_batch:
+            self._spawn_flush()
+
+    def _spawn_flush(self):
+        # flushes are tracked, so they're awaited on close
+        flush = asyncio.ensure_future(self.flush())
+        self._flushes.add(flush)
+        flush.add_done_callback(self._flushes.discard)
+        return flush
+
+    async def flush(self):
+        """Save all the buffered searches, return the number of saved ones."""
+        searches, self._buffer = self._buffer, []
+        if not searches:
+            return 0
+        try:
+            async with self.pool.acquire() as conn:
+                await db_save_searches(conn, searches)
+        except Exception:
+            logger.exception('Failed to save %d searches', len(searches))
+            self.dropped += len(searches)
+            return 0
+        self.written += len(searches)
+        return len(searches)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        """Stop periodic flushes and drain the buffer."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._flushes:
+            await asyncio.gather(*self._flushes)
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await asyncio.shield(self._spawn_flush())
+
+
+async def init_search_history(app, env='dev'):
+    """Init an app with search history writer, the app DB pool must be set up."""
+    conf = app['config'][env]['search_history']
+    writer = SearchHistoryWriter(
+        app['db'], max_batch=conf['max_batch'], flush_interval=conf['flush_interval'])
+    app['search_history'] = writer
+    writer.start()
+
+
+async def close_search_history(app):
+    """Drain search history writer of the app, before the DB pool is closed."""
+    await app['search_history'].close()
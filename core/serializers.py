@@ -0,0 +1,58 @@
+"""
+Module to serialize DB rows into json friendly structures and json bytes.
+
+Rows are converted column by column without going through `__repr__`,
+datetimes are represented as ISO 8601 strings.
+`dumps` writes compact json bytes and encodes datetimes itself,
+so rows headed for it may skip value conversion(`convert=None`).
+It's backed by orjson when it's installed, by the json module otherwise.
+"""
+
+from datetime import date
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson backend is optional
+    orjson = None
+
+
+def to_json_value(value):
+    """Convert a single column value into a json friendly one."""
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def row_to_dict(row, columns=None, convert=to_json_value):
+    """Convert a DB row into a dict, optionally only for the given columns."""
+    if convert is None:
+        if columns is None:
+            return dict(row.items())
+        return {column: row[column] for column in columns}
+    if columns is None:
+        return {column: convert(value) for column, value in row.items()}
+    return {column: convert(row[column]) for column in columns}
+
+
+def rows_to_lists(rows, columns, convert=to_json_value):
+    """Convert DB rows into a compact list of lists for the given columns."""
+    if convert is None:
+        return [[row[column] for column in columns] for row in rows]
+    return [[convert(row[column]) for column in columns] for row in rows]
+
+
+def _default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError('{!r} is not JSON serializable'.format(type(value)))
+
+
+_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False, default=_default)
+
+
+def dumps(value):
+    """Serialize a value into compact json bytes."""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return _encoder.encode(value).encode()
@@ -1,3 +1,6 @@
+import copy
+
+
 config = {
     'dev': {
         'postgres': {
@@ -8,9 +11,85 @@ config = {
             'port': 5432,
             'minsize': 1,
             'maxsize': 5,
+            # 'aiopg' or 'asyncpg'
+            'driver': 'aiopg',
+            # 'closure' or 'path', see dbtools/init/3_hierarchy_path.sql
+            'hierarchy': 'closure',
+            # reads are routed to replicas, their settings override the primary ones,
+            # e.g. [{'port': 5434}] of docker-compose, see the 'compose' env
+            'replicas': [],
+            # 'round_robin' or 'least_busy'
+            'balancing': 'round_robin',
+            # seconds to read from the primary after a write
+            'sticky_window': 5,
+            # seconds to wait for a pooled connection, see core/admission.py
+            'acquire_timeout': 2,
+        },
+        'history_partitions': {
+            'months_ahead': 3,
+            # seconds
+            'interval': 24 * 60 * 60,
+        },
+        'search_history': {
+            'max_batch': 100,
+            # seconds
+            'flush_interval': 1,
+        },
+        'tree_cache': {
+            'maxsize': 1000,
+            'ttl': 60,
+        },
+        # see core/live.py, `queue_size` is in events, timeouts are in seconds
+        'live': {
+            'max_subscribers': 10000,
+            'queue_size': 100,
+            'heartbeat': 15,
+            'write_timeout': 10,
+        },
+        # responses of `min_size` bytes and more are compressed, see core/compression.py.
+        # Brotli 1 is faster than gzip 6 and about as small for trees,
+        # see benchmarks/serialization.py
+        'compression': {
+            'min_size': 1024,
+            'gzip_level': 6,
+            'brotli_quality': 1,
+        },
+        # see core/admission.py, limits are per worker, timeouts are in seconds.
+        # Classes by priority(lower first): writes and lvl1 pages, reads, exports
+        'admission': {
+            'concurrency': 20,
+            'classes': {
+                'critical': {'priority': 0, 'concurrency': None, 'queue': 200, 'timeout': 2},
+                'read': {'priority': 1, 'concurrency': 16, 'queue': 200, 'timeout': 1},
+                'export': {'priority': 2, 'concurrency': 2, 'queue': 10, 'timeout': 5},
+            },
+            # classes of routes by method and canonical path, None is not limited
+            'routes': {
+                'POST /{user}/create_comment': 'critical',
+                'POST /{user}/create_comments': 'critical',
+                'POST /{user}/change_comment': 'critical',
+                'POST /{user}/delete_comment': 'critical',
+                'POST /{user}/restore_comment': 'critical',
+                'GET /{user}/lvl1': 'critical',
+                'POST /{user}/get_history': 'export',
+                'POST /{user}/search_history': 'export',
+                'GET /{user}/subscribe': None,
+                'GET /cache_stats': None,
+                'GET /metrics': None,
+            },
+            'default_class': 'read',
+            # seconds sent in Retry-After of 503 responses
+            'retry_after': 1,
+        },
+        # see core/launcher.py, by default there are workers as many as cores,
+        # but no more than get two connections of the pool each
+        'server': {
+            'host': '0.0.0.0',
+            'port': 8080,
+            'workers': None,
+            # seconds to wait for requests in flight on shutdown
+            'shutdown_timeout': 30,
         },
-        'host': '127.0.0.1',
-        'port': 8080,
     },
     'test': {
         'postgres': {
@@ -21,8 +100,84 @@ config = {
             'port': 5433,
             'minsize': 1,
             'maxsize': 5,
+            # 'aiopg' or 'asyncpg'
+            'driver': 'aiopg',
+            # 'closure' or 'path', see dbtools/init/3_hierarchy_path.sql
+            'hierarchy': 'closure',
+            # e.g. [{'port': 5435}] with test_db_replica of tests/docker-compose.test.yml
+            'replicas': [],
+            'balancing': 'round_robin',
+            'sticky_window': 5,
+            'acquire_timeout': 2,
+        },
+        'history_partitions': {
+            'months_ahead': 3,
+            # seconds
+            'interval': 24 * 60 * 60,
+        },
+        'search_history': {
+            'max_batch': 100,
+            # seconds
+            'flush_interval': 1,
+        },
+        'tree_cache': {
+            'maxsize': 1000,
+            'ttl': 60,
+        },
+        # see core/live.py, `queue_size` is in events, timeouts are in seconds
+        'live': {
+            'max_subscribers': 10000,
+            'queue_size': 100,
+            'heartbeat': 15,
+            'write_timeout': 10,
+        },
+        # responses of `min_size` bytes and more are compressed, see core/compression.py.
+        # Brotli 1 is faster than gzip 6 and about as small for trees,
+        # see benchmarks/serialization.py
+        'compression': {
+            'min_size': 1024,
+            'gzip_level': 6,
+            'brotli_quality': 1,
+        },
+        # see core/admission.py, limits are per worker, timeouts are in seconds.
+        # Classes by priority(lower first): writes and lvl1 pages, reads, exports
+        'admission': {
+            'concurrency': 20,
+            'classes': {
+                'critical': {'priority': 0, 'concurrency': None, 'queue': 200, 'timeout': 2},
+                'read': {'priority': 1, 'concurrency': 16, 'queue': 200, 'timeout': 1},
+                'export': {'priority': 2, 'concurrency': 2, 'queue': 10, 'timeout': 5},
+            },
+            # classes of routes by method and canonical path, None is not limited
+            'routes': {
+                'POST /{user}/create_comment': 'critical',
+                'POST /{user}/create_comments': 'critical',
+                'POST /{user}/change_comment': 'critical',
+                'POST /{user}/delete_comment': 'critical',
+                'POST /{user}/restore_comment': 'critical',
+                'GET /{user}/lvl1': 'critical',
+                'POST /{user}/get_history': 'export',
+                'POST /{user}/search_history': 'export',
+                'GET /{user}/subscribe': None,
+                'GET /cache_stats': None,
+                'GET /metrics': None,
+            },
+            'default_class': 'read',
+            # seconds sent in Retry-After of 503 responses
+            'retry_after': 1,
+        },
+        # see core/launcher.py, by default there are workers as many as cores,
+        # but no more than get two connections of the pool each
+        'server': {
+            'host': '127.0.0.1',
+            'port': 8080,
+            'workers': 2,
+            # seconds to wait for requests in flight on shutdown
+            'shutdown_timeout': 30,
         },
-        'host': '127.0.0.1',
-        'port': 8080,
     }
 }
+
+# docker-compose runs a streaming replica of the DB too, see docker-compose.yml
+config['compose'] = copy.deepcopy(config['dev'])
+config['compose']['postgres']['replicas'] = [{'port': 5434}]
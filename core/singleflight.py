@@ -0,0 +1,72 @@
+"""
+Module to coalesce identical concurrent calls.
+
+When a tree goes viral, many requests miss the cache at once and would run
+the same query on a pooled connection each. A `SingleFlight` runs the first
+call only, concurrent calls with the same key wait for it and share its
+result or exception, so a spike costs a single connection per tree.
+"""
+
+import asyncio
+
+from metrics import SINGLE_FLIGHT_CALLS, SINGLE_FLIGHT_COALESCED
+
+
+class _Call:
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Share calls in flight by key."""
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key, func):
+        """
+        Return the result of `func()`, shared by concurrent calls with the key.
+
+        The call runs in its own task, so a cancelled caller doesn't cancel
+        the others waiting for it. It's cancelled when every caller is.
+        Results aren't kept after the call, it's not a cache.
+        """
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(func()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda task: self._done(key, call))
+            SINGLE_FLIGHT_CALLS.inc(self.name)
+        else:
+            SINGLE_FLIGHT_COALESCED.inc(self.name)
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if not call.waiters and not call.task.done():
+                # callers coming later don't join the cancelled call
+                self._forget(key, call)
+                call.task.cancel()
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def _done(self, key, call):
+        self._forget(key, call)
+        # every caller may have left, the exception is retrieved anyway
+        if not call.task.cancelled():
+            call.task.exception()
+
+
+async def init_single_flight(app, env='dev'):
+    """Init an app with coalescing of tree reads, see `views._get_cached_tree`."""
+    app['tree_flights'] = SingleFlight('tree')
+    app['version_flights'] = SingleFlight('tree_version')
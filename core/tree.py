@@ -0,0 +1,104 @@
+"""
+Module to assemble comment trees on the server side.
+
+Tree queries return rows of a subtree ordered by creation date,
+each row carries its parent type and ID. The tree is assembled in a single
+O(n) pass, children keep the order of the rows, i.e. by `date_created`.
+"""
+
+from serializers import row_to_dict, rows_to_lists, to_json_value
+
+
+TREE_COLUMNS = (
+    'type', 'id', 'creator', 'date_created', 'date_last_modified', 'text',
+    'parent_type', 'parent_id', 'direct_reply_count', 'descendant_count',
+)
+
+
+def build_tree(rows, max_depth=None, max_children=None, columns=TREE_COLUMNS,
+               convert=to_json_value):
+    """
+    Build a nested tree out of flat rows.
+
+    Rows which parent is not among the rows become roots, so it works
+    for a full tree(a single root) as well as for a list of children.
+    Nodes deeper than `max_depth`(roots have depth 0) and children
+    beyond the first `max_children` of every node are cut off,
+    a number of cut children is reported in `more_children`.
+    Values are converted by `convert`(see `serializers.row_to_dict`).
+    """
+    nodes = {}
+    ordered = []
+    for row in rows:
+        node = row_to_dict(row, columns, convert)
+        node['children'] = []
+        nodes[(row['type'], row['id'])] = node
+        ordered.append(node)
+
+    roots = []
+    for node in ordered:
+        parent = nodes.get((node['parent_type'], node['parent_id']))
+        if parent is None:
+            roots.append(node)
+        else:
+            parent['children'].append(node)
+
+    if max_depth is not None or max_children is not None:
+        _cut_tree(roots, max_depth, max_children)
+    return roots
+
+
+def _cut_tree(roots, max_depth, max_children):
+    """Cut the tree in place, walking every kept node once."""
+    stack = [(root, 0) for root in roots]
+    while stack:
+        node, depth = stack.pop()
+        children = node['children']
+        if max_depth is not None and depth >= max_depth:
+            kept = []
+        elif max_children is not None:
+            kept = children[:max_children]
+        else:
+            kept = children
+        if len(kept) < len(children):
+            node['children'] = kept
+            node['more_children'] = len(children) - len(kept)
+        stack.extend((child, depth + 1) for child in kept)
+
+
+def build_window(rows, max_depth, max_children, more, columns=TREE_COLUMNS,
+                 convert=to_json_value):
+    """
+    Build a nested tree out of rows of a tree window(see `db.db_get_tree_window`).
+
+    Rows are ordered by depth and rank among siblings, a row ranked past
+    `max_children` isn't shown, it only tells that children of its parent
+    are cut. Such parents, and comments with replies at `max_depth`,
+    get a continuation token `more(parent_type, parent_id, last_row)`,
+    `last_row` is the last shown child or None when none is shown.
+    Returns first level nodes and the token of the rest of them.
+    """
+    nodes = {}
+    last_rows = {}
+    roots = []
+    result = {'comments': roots, 'more': None}
+    for row in rows:
+        parent_key = (row['parent_type'], row['parent_id'])
+        parent = nodes.get(parent_key, result)
+        if row['rank'] > max_children:
+            parent['more'] = more(row['parent_type'], row['parent_id'], last_rows[parent_key])
+            continue
+        node = row_to_dict(row, columns, convert)
+        node['children'] = []
+        node['more'] = None
+        if row['depth'] >= max_depth and row['direct_reply_count']:
+            node['more'] = more(row['type'], row['id'], None)
+        nodes[(row['type'], row['id'])] = node
+        last_rows[parent_key] = row
+        (roots if parent is result else parent['children']).append(node)
+    return result
+
+
+def flat_tree(rows, columns=TREE_COLUMNS, convert=to_json_value):
+    """Encode rows as a compact array of rows, the tree is rebuilt by parents."""
+    return {'columns': list(columns), 'rows': rows_to_lists(rows, columns, convert)}
@@ -1,18 +1,30 @@
 """Module to represent a list if views."""
 
+import asyncio
 from collections import namedtuple
 from math import ceil
-import json
 
-from lxml import etree
 from aiohttp import web
 import aiohttp_jinja2
 
 from db import *
+from export import HISTORY_WRITERS
+from live import TooManySubscribers
+import metrics
+from pagination import InvalidCursor, decode_cursor, encode_cursor
+from serializers import dumps, row_to_dict
+from tree import build_tree, build_window, flat_tree
 
 
 Search = namedtuple('Search', ('search_date', 'start_date', 'end_date', 'root_entity_id'))
-Action = namedtuple('Action', ('entity_id', 'user', 'action', 'date', 'text'))
+
+BULK_CREATE_LIMIT = 10000
+FEED_PAGE_SIZE = 20
+FEED_MAX_PAGE_SIZE = 100
+WINDOW_DEPTH = 3
+WINDOW_MAX_DEPTH = 10
+WINDOW_CHILDREN = 10
+WINDOW_MAX_CHILDREN = 100
 
 
 @aiohttp_jinja2.template('index.html')
@@ -46,66 +58,250 @@ def get_history_form(request):
     pass
 
 
+def _json_response(data):
+    """Json response serialized by `serializers.dumps`."""
+    return web.Response(body=dumps(data), content_type='application/json')
+
+
+def _read_pool(request, *keys):
+    """Choose a pool to read the given keys for the request user."""
+    return request.app['db_router'].read_pool(('user', request.match_info['user']), *keys)
+
+
+def _mark_write(request):
+    """Keep reads of the request user on the primary for a while."""
+    request.app['db_router'].mark_write(('user', request.match_info['user']))
+
+
+def _etag(version):
+    """Weak ETag of a tree version, representations differ by content coding."""
+    return 'W/"{}-{}"'.format(version.tree_version, int(version.tree_modified_at.timestamp()))
+
+
+def _not_modified(request, version):
+    """
+    Check conditional headers of the request against a tree version.
+
+    `If-None-Match` takes precedence over `If-Modified-Since`,
+    ETags are compared weakly.
+    """
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        etag = _etag(version)[2:]
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or any(
+            (tag[2:] if tag.startswith('W/') else tag) == etag for tag in tags)
+    since = request.if_modified_since
+    return since is not None and version.tree_modified_at.replace(microsecond=0) <= since
+
+
+def _set_version(response, version):
+    response.headers['ETag'] = _etag(version)
+    response.last_modified = version.tree_modified_at
+    return response
+
+
+async def _check_version(request, conn, entity_type, entity_id):
+    """Get the tree version of the entity, 400/404 for wrong ones."""
+    try:
+        return await db_get_tree_version(conn, entity_type, entity_id)
+    except ExecuteException as e:
+        raise web.HTTPBadRequest(text=str(e))
+    except RecordNotFound as e:
+        raise web.HTTPNotFound(text=str(e))
+
+
 async def create_comment(request):
     """Create comment for the given entity."""
     data = await request.post()
     text = data['text']
     entity_type = data['entity_type']
-    entity_id = data['entity_id']
+    entity_id = _parse_int(data['entity_id'], 'entity_id')
     user = request.match_info['user']
     async with request.app['db'].acquire() as conn:
         try:
             await db_create_comment(conn, user, text, entity_type, entity_id)
         except ExecuteException as e:
             raise web.HTTPInternalServerError(text=str(e))
+        _mark_write(request)
         return web.Response(text='added a comment: {}!'.format(text))
 
 
+async def create_comments(request):
+    """
+    Create many comments for the given entities at once.
+
+    Expects json `{"comments": [{"text": ..., "entity_type": ..., "entity_id": ...}, ...]}`,
+    a comment may refer a parent of the same batch by `parent_ref`
+    instead of entity type/ID, see `db_create_comments_bulk`.
+    """
+    try:
+        data = await request.json()
+        comments = data['comments']
+    except (ValueError, KeyError, TypeError):
+        raise web.HTTPBadRequest(text='json with a list of comments is expected')
+    if not isinstance(comments, list) or len(comments) > BULK_CREATE_LIMIT:
+        raise web.HTTPBadRequest(
+            text='up to {} comments are expected'.format(BULK_CREATE_LIMIT))
+    for comment in comments:
+        if not isinstance(comment, dict) or not comment.get('text') or not (
+                comment.get('parent_ref') is not None or
+                comment.get('entity_type') and comment.get('entity_id')):
+            raise web.HTTPBadRequest(
+                text='every comment needs text and either entity_type/entity_id or parent_ref')
+    user = request.match_info['user']
+    async with request.app['db'].acquire() as conn:
+        try:
+            ids = await db_create_comments_bulk(conn, user, comments)
+        except InvalidRefs as e:
+            raise web.HTTPBadRequest(text=str(e))
+        except ExecuteException as e:
+            raise web.HTTPInternalServerError(text=str(e))
+    _mark_write(request)
+    return _json_response({
+        'ids': ids,
+        'refs': {c['ref']: i for c, i in zip(comments, ids) if c.get('ref') is not None},
+    })
+
+
 async def get_comments(request):
-    """Get comments for the given user."""
+    """
+    Get a feed of comments for the given user, newest first.
+
+    Paginated by an opaque `after` cursor, optionally limited
+    by `start_date`/`end_date` window.
+    """
     username = request.match_info['user']
+    query = request.rel_url.query
+    limit = min(_parse_int(query.get('limit', FEED_PAGE_SIZE), 'limit'), FEED_MAX_PAGE_SIZE)
+    if limit < 1:
+        raise web.HTTPBadRequest(text='limit must be positive')
     async with request.app['db'].acquire() as conn:
         try:
-            comments = await db_get_comments(conn, username)
+            comments = await db_get_comments(
+                conn, username,
+                after=query.get('after'),
+                start_date=query.get('start_date'),
+                end_date=query.get('end_date'),
+                limit=limit + 1)
+        except (InvalidCursor, ExecuteException) as e:
+            raise web.HTTPBadRequest(text=str(e))
         except RecordNotFound as e:
             raise web.HTTPNotFound(text=str(e))
-        return web.json_response(data=comments.__repr__())
+    has_more = len(comments) > limit
+    comments = comments[:limit]
+    last = comments[-1]
+    return _json_response({
+        'comments': [row_to_dict(comment, convert=None) for comment in comments],
+        'next_cursor': encode_cursor(last.date_created, last.id) if has_more else None,
+    })
+
+
+async def search_comments(request):
+    """
+    Search comments by text, best matches first.
+
+    `q` is in web search syntax, `root_type`/`root_id` limit the search
+    to a subtree. Paginated by an opaque `after` cursor.
+    """
+    query = request.rel_url.query
+    text = query.get('q')
+    if not text:
+        raise web.HTTPBadRequest(text='q is missing')
+    limit = min(_parse_int(query.get('limit', FEED_PAGE_SIZE), 'limit'), FEED_MAX_PAGE_SIZE)
+    if limit < 1:
+        raise web.HTTPBadRequest(text='limit must be positive')
+    root_type = query.get('root_type', 'post')
+    root_id = query.get('root_id')
+    if root_id is not None:
+        root_id = _parse_int(root_id, 'root_id')
+    key = (root_type, root_id) if root_id is not None else ()
+    async with _read_pool(request, *key).acquire() as conn:
+        try:
+            comments = await db_search_comments(
+                conn, text,
+                root_type=root_type,
+                root_id=root_id,
+                after=query.get('after'),
+                limit=limit + 1,
+                hierarchy=request.app['hierarchy'])
+        except (InvalidCursor, ExecuteException) as e:
+            raise web.HTTPBadRequest(text=str(e))
+        except RecordNotFound as e:
+            raise web.HTTPNotFound(text=str(e))
+    has_more = len(comments) > limit
+    comments = comments[:limit]
+    last = comments[-1]
+    return _json_response({
+        'comments': [row_to_dict(comment, convert=None) for comment in comments],
+        'next_cursor': encode_cursor(last.rank, last.id) if has_more else None,
+    })
 
 
-@aiohttp_jinja2.template('lvl1_children.html')
 async def get_1lvl_comments(request):
     """
     Get first level comments for the given entity.
 
     Paginate 5 comments/page by default(for demo purposes).
-    Show links to 2 previous and 2 next pages.
+    By default pages are addressed by opaque `after`/`before` cursors,
+    legacy `page` numbers are still supported and show links
+    to 2 previous and 2 next pages.
+    Pages carry the tree version of the entity, conditional requests
+    are answered by 304 after the version lookup only.
     """
     pagination = 5
     entity_type = request.rel_url.query.get('entity_type')
     entity_id = request.rel_url.query.get('entity_id')
     if not entity_id:
         raise web.HTTPBadRequest(text='entity_id is missing')
-    page_num = int(request.rel_url.query.get('page') or 1)
-    offset = max(0, (page_num - 3) * pagination)
-    limit = min(25, (3 + page_num - 1) * pagination)
-    async with request.app['db'].acquire() as conn:
-        try:
-            comments = await db_get_1lvl_comments(
-                conn, entity_type, entity_id, offset=offset, limit=limit)
-        except RecordNotFound as e:
-            raise web.HTTPNotFound(text=str(e))
-        chunks = int(ceil(len(comments) / pagination))
-        data = {
-            max(0, page_num - 3) + i + 1: comments[i * pagination:(i + 1) * pagination]
-            for i in range(chunks)
-        }
-        return {
-            'entity_type': entity_type,
-            'entity_id': entity_id,
-            'page': page_num,
-            'user': request.match_info['user'],
-            'data': data
-        }
+    entity_id = _parse_int(entity_id, 'entity_id')
+    context = {
+        'entity_type': entity_type,
+        'entity_id': entity_id,
+        'user': request.match_info['user'],
+    }
+    async with _read_pool(request, (entity_type, entity_id)).acquire() as conn:
+        version = await _check_version(request, conn, entity_type, entity_id)
+        if _not_modified(request, version):
+            return _set_version(web.Response(status=304), version)
+        if 'page' not in request.rel_url.query:
+            try:
+                page = await db_get_1lvl_comments_page(
+                    conn, entity_type, entity_id,
+                    after=request.rel_url.query.get('after'),
+                    before=request.rel_url.query.get('before'),
+                    limit=pagination)
+            except InvalidCursor as e:
+                raise web.HTTPBadRequest(text=str(e))
+            except ExecuteException as e:
+                raise web.HTTPBadRequest(text=str(e))
+            except RecordNotFound as e:
+                raise web.HTTPNotFound(text=str(e))
+            context.update({
+                'comments': page.rows,
+                'next_cursor': page.next_cursor,
+                'prev_cursor': page.prev_cursor,
+            })
+        else:
+            page_num = _parse_int(request.rel_url.query.get('page') or 1, 'page')
+            offset = max(0, (page_num - 3) * pagination)
+            limit = min(25, (3 + page_num - 1) * pagination)
+            try:
+                comments = await db_get_1lvl_comments(
+                    conn, entity_type, entity_id, offset=offset, limit=limit)
+            except RecordNotFound as e:
+                raise web.HTTPNotFound(text=str(e))
+            chunks = int(ceil(len(comments) / pagination))
+            data = {
+                max(0, page_num - 3) + i + 1: comments[i * pagination:(i + 1) * pagination]
+                for i in range(chunks)
+            }
+            context.update({
+                'page': page_num,
+                'data': data
+            })
+    response = aiohttp_jinja2.render_template('lvl1_children.html', request, context)
+    return _set_version(response, version)
 
 
 async def change_comment(request):
@@ -119,6 +315,7 @@ async def change_comment(request):
     user = request.match_info['user']
     if not comment_id:
         raise web.HTTPBadRequest(text='comment id is missing')
+    comment_id = _parse_int(comment_id, 'comment_id')
     text = data.get('text')
     if not text:
         raise web.HTTPBadRequest(text='text is missing')
@@ -127,6 +324,7 @@ async def change_comment(request):
             await db_change_comment(conn, user, comment_id, text)
         except ExecuteException as e:
             raise web.HTTPInternalServerError(text=str(e))
+        _mark_write(request)
         return web.Response(
             text='new comment with id={id} was set to "{text}"'.format(
                 id=comment_id, text=text)
@@ -134,36 +332,176 @@ async def change_comment(request):
 
 
 async def delete_comment(request):
-    """Delete comment for the given comment ID."""
+    """Delete comment for the given comment ID with all its replies."""
     data = await request.post()
     comment_id = data.get('comment_id')
     user = request.match_info['user']
     if not comment_id:
         raise web.HTTPBadRequest(text='comment id is missing')
+    comment_id = _parse_int(comment_id, 'comment_id')
     async with request.app['db'].acquire() as conn:
         try:
-            await db_delete_comment(conn, user, comment_id)
+            deleted = await db_delete_comment(
+                conn, user, comment_id, request.app['hierarchy'])
         except ExecuteException as e:
             raise web.HTTPInternalServerError(text=str(e))
+        _mark_write(request)
         return web.Response(
-            text='comment[id={id}] was deleted"'.format(id=comment_id)
+            text='comment[id={id}] was deleted with {replies} replies'.format(
+                id=comment_id, replies=deleted - 1)
         )
 
 
-async def get_child_comments(request):
-    """Get child comments tree for the given comment ID."""
-    entity_id = request.rel_url.query.get('entity_id')
-    if not entity_id:
-        raise web.HTTPBadRequest(text='ancestor entity id is missing')
+async def restore_comment(request):
+    """Restore deleted comment for the given comment ID with its replies."""
+    data = await request.post()
+    comment_id = data.get('comment_id')
+    user = request.match_info['user']
+    if not comment_id:
+        raise web.HTTPBadRequest(text='comment id is missing')
+    comment_id = _parse_int(comment_id, 'comment_id')
     async with request.app['db'].acquire() as conn:
         try:
-            comments = await db_get_child_comments(conn, entity_id)
+            restored = await db_restore_comment(
+                conn, user, comment_id, request.app['hierarchy'])
         except ExecuteException as e:
             raise web.HTTPInternalServerError(text=str(e))
+        _mark_write(request)
+        return web.Response(
+            text='comment[id={id}] was restored with {replies} replies'.format(
+                id=comment_id, replies=restored - 1)
+        )
+
+
+def _parse_tree_options(request):
+    """
+    Parse tree encoding options from the query.
+
+    `format` is either `nested`(default) or `flat` array of rows,
+    `max_depth` and `max_children` limit the nested tree.
+    """
+    query = request.rel_url.query
+    tree_format = query.get('format', 'nested')
+    if tree_format not in ('nested', 'flat'):
+        raise web.HTTPBadRequest(text='unsupported format {}'.format(tree_format))
+    options = {'format': tree_format}
+    for option in ('max_depth', 'max_children'):
+        value = query.get(option)
+        if value is None:
+            options[option] = None
+            continue
+        try:
+            options[option] = int(value)
+        except ValueError:
+            raise web.HTTPBadRequest(text='{} must be an integer'.format(option))
+        if options[option] < 0:
+            raise web.HTTPBadRequest(text='{} must not be negative'.format(option))
+    return options
+
+
+def _compose_tree(comments, options):
+    """Compose a tree for the given rows, values are encoded by `serializers.dumps`."""
+    if options['format'] == 'flat':
+        return flat_tree(comments, convert=None)
+    return build_tree(
+        comments, max_depth=options['max_depth'], max_children=options['max_children'],
+        convert=None)
+
+
+def _query_depth(options):
+    """Depth to cut nested trees in the DB, flat ones are returned as a whole."""
+    return options['max_depth'] if options['format'] == 'nested' else None
+
+
+def _parse_int(value, name):
+    """Parse an integer query parameter."""
+    try:
+        return int(value)
+    except ValueError:
+        raise web.HTTPBadRequest(text='{} must be an integer'.format(name))
+
+
+async def _read_version(pool, key):
+    async with pool.acquire() as conn:
+        return await db_get_tree_version(conn, *key)
+
+
+async def _load_tree(cache, pool, key, variant, query, compose, compressor, coding):
+    """Read, serialize and cache a tree with the version of its root."""
+    cache_version = cache.version(key)
+    async with pool.acquire() as conn:
+        version = await db_get_tree_version(conn, *key)
+        comments = await query(conn)
+    body = dumps(compose(comments))
+    if coding is not None and len(body) >= compressor.min_size:
+        cached = (await compressor.compress_async(body, coding), coding, version)
+    else:
+        cached = (body, None, version)
+    cache.put(key, variant, cached, cache_version)
+    return cached
+
+
+async def _get_cached_tree(request, key, variant, query, compose):
+    """
+    Get serialized tree from the cache or query and cache it.
+
+    `query` is called with a connection, cache hits don't touch the DB,
+    `compose` makes the tree to serialize out of the rows.
+    Trees are cached compressed by the coding negotiated for the request
+    (see `compression`), so hits aren't compressed again.
+    Trees are cached with the version of the root `key`, conditional
+    requests are answered by 304 after the version lookup only.
+    Concurrent misses of the same tree share a single query and its
+    serialized body(see `singleflight`), as long as they read the same
+    kind of pool, so users reading their writes from the primary still do.
+    """
+    cache = request.app['tree_cache']
+    compressor = request.app.get('compression')
+    coding = None
+    if compressor is not None:
+        coding = compressor.negotiate(request.headers.get('Accept-Encoding'))
+    variant = variant + (coding,)
+    cached = cache.get(key, variant)
+    if cached is None:
+        pool = _read_pool(request, key)
+        source = 'primary' if pool is request.app['db'] else 'replica'
+        try:
+            if 'If-None-Match' in request.headers or 'If-Modified-Since' in request.headers:
+                version = await request.app['version_flights'].do(
+                    (key, source), lambda: _read_version(pool, key))
+                if _not_modified(request, version):
+                    return _set_version(web.Response(status=304), version)
+            cached = await request.app['tree_flights'].do(
+                (key, variant, source),
+                lambda: _load_tree(cache, pool, key, variant, query, compose, compressor, coding))
+        except ExecuteException as e:
+            raise web.HTTPBadRequest(text=str(e))
         except RecordNotFound as e:
             raise web.HTTPNotFound(text=str(e))
+    body, coding, version = cached
+    if _not_modified(request, version):
+        return _set_version(web.Response(status=304), version)
+    response = web.Response(body=body, content_type='application/json')
+    if coding is not None:
+        response.headers['Content-Encoding'] = coding
+    return _set_version(response, version)
 
-        return web.json_response(text=json.dumps(comments.__repr__()))
+
+async def get_child_comments(request):
+    """Get child comments tree for the given comment ID."""
+    entity_id = request.rel_url.query.get('entity_id')
+    if not entity_id:
+        raise web.HTTPBadRequest(text='ancestor entity id is missing')
+    entity_id = _parse_int(entity_id, 'entity_id')
+    options = _parse_tree_options(request)
+    return await _get_cached_tree(
+        request,
+        ('comment', entity_id),
+        ('children',) + tuple(sorted(options.items())),
+        lambda conn: db_get_child_comments(
+            conn, entity_id, request.app['hierarchy'], _query_depth(options)),
+        lambda comments: _compose_tree(comments, options)
+    )
 
 
 async def get_full_tree(request):
@@ -172,76 +510,179 @@ async def get_full_tree(request):
     root_id = request.rel_url.query.get('root_id')
     if not root_id:
         raise web.HTTPBadRequest(text='root_id is missing')
-    async with request.app['db'].acquire() as conn:
+    root_id = _parse_int(root_id, 'root_id')
+    options = _parse_tree_options(request)
+    return await _get_cached_tree(
+        request,
+        (root_type, root_id),
+        ('full_tree',) + tuple(sorted(options.items())),
+        lambda conn: db_get_full_tree(
+            conn, root_type, root_id, request.app['hierarchy'], _query_depth(options)),
+        lambda comments: _compose_tree(comments, options)
+    )
+
+
+def _parse_window_option(query, name, default, maximum):
+    value = query.get(name)
+    if value is None:
+        return default
+    value = _parse_int(value, name)
+    if not 1 <= value <= maximum:
+        raise web.HTTPBadRequest(text='{} must be from 1 to {}'.format(name, maximum))
+    return value
+
+
+async def get_tree_window(request):
+    """
+    Get a window of the tree of the given root, for "load more replies".
+
+    `max_depth` levels of comments are returned with `max_children` children
+    of every comment at most, children are ordered by `sort`: `oldest`,
+    `newest` or `top`(by replies). Cut branches come with `more` tokens,
+    passed as `more` they return the next window of the branch.
+    """
+    query = request.rel_url.query
+    token = query.get('more')
+    if token:
         try:
-            comments = await db_get_full_tree(conn, root_type, root_id)
-        except ExecuteException as e:
-            raise web.HTTPInternalServerError(text=str(e))
-        except RecordNotFound as e:
-            raise web.HTTPNotFound(text=str(e))
+            root_type, root_id, sort, *after = decode_cursor(token, 5)
+        except InvalidCursor as e:
+            raise web.HTTPBadRequest(text=str(e))
+        if after[-1] is None:
+            after = None
+    else:
+        root_type = query.get('root_type')
+        root_id = query.get('root_id')
+        if not root_id:
+            raise web.HTTPBadRequest(text='root_id is missing')
+        root_id = _parse_int(root_id, 'root_id')
+        sort = query.get('sort', 'oldest')
+        after = None
+    if sort not in WINDOW_SORTS:
+        raise web.HTTPBadRequest(text='unsupported sort {}'.format(sort))
+    max_depth = _parse_window_option(query, 'max_depth', WINDOW_DEPTH, WINDOW_MAX_DEPTH)
+    max_children = _parse_window_option(query, 'max_children', WINDOW_CHILDREN, WINDOW_MAX_CHILDREN)
+    keys = WINDOW_SORTS[sort][2]
+
+    def more(parent_type, parent_id, last_row):
+        keyset = [None] * len(keys) if last_row is None else [last_row[key] for key in keys]
+        return encode_cursor(parent_type, parent_id, sort, *keyset)
+
+    return await _get_cached_tree(
+        request,
+        (root_type, root_id),
+        ('window', max_depth, max_children, sort, tuple(after or ())),
+        lambda conn: db_get_tree_window(
+            conn, root_type, root_id, max_depth, max_children, sort, after),
+        lambda comments: build_window(comments, max_depth, max_children, more, convert=None)
+    )
 
-        return web.json_response(text=json.dumps(comments.__repr__()))
 
+async def subscribe_comments(request):
+    """
+    Stream changes of the tree of the given entity as Server-Sent Events.
 
-def compose_history_in_xml(actions):
-    """Compose xml output for the given history."""
-    root = etree.Element('Actions')
-    for action in actions:
-        e_action = etree.SubElement(root, 'Action')
-        for attr, val in action.items():
-            sub = etree.SubElement(e_action, attr)
-            sub.text = str(val)
-    return etree.tostring(root, encoding='unicode')
+    `comments` events carry changed comments of the tree, `delete` ones
+    IDs of purged comments. The tree must be fetched again after `reset`,
+    or if its ETag differs from the one of the stream.
+    """
+    root_type = request.rel_url.query.get('root_type')
+    root_id = request.rel_url.query.get('root_id')
+    if not root_id:
+        raise web.HTTPBadRequest(text='root_id is missing')
+    root_id = _parse_int(root_id, 'root_id')
+    hub = request.app['live']
+    try:
+        # subscribed before the version is read, so no change is missed in between
+        subscription = hub.subscribe((root_type, root_id))
+    except TooManySubscribers as e:
+        raise web.HTTPServiceUnavailable(text=str(e))
+    try:
+        async with request.app['db'].acquire() as conn:
+            version = await _check_version(request, conn, root_type, root_id)
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'ETag': _etag(version),
+        })
+        await response.prepare(request)
+        async for event in subscription.events(hub.heartbeat):
+            try:
+                await asyncio.wait_for(response.write(event), hub.write_timeout)
+            except asyncio.TimeoutError:
+                # the client doesn't read, don't buffer for it any longer
+                request.transport.close()
+                break
+        return response
+    finally:
+        hub.unsubscribe(subscription)
+
+
+async def get_cache_stats(request):
+    """Get tree cache counters for tuning."""
+    return _json_response(request.app['tree_cache'].stats())
+
+
+async def get_metrics(request):
+    """Get metrics of the app in Prometheus text format."""
+    return web.Response(
+        body=metrics.render().encode(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+async def _prepend_batch(batch, batches):
+    """Yield an already fetched batch followed by the rest of them."""
+    yield batch
+    async for batch in batches:
+        yield batch
 
 
 async def get_history(request):
     """
-    Return xml file with the history of comments.
+    Return xml/json file with the history of comments.
 
     User has an option to specify comment UD and date range,
     default is all comments get returned.
+    History is streamed in chunks as it's read from the DB.
     """
     data = await request.post()
     user = request.match_info['user']
     root_entity_id = data.get('comment_id') or None
+    if root_entity_id is not None:
+        root_entity_id = _parse_int(root_entity_id, 'comment_id')
     download_format = data['download_format']
+    if download_format not in HISTORY_WRITERS:
+        raise web.HTTPBadRequest(text='unsupported format {}'.format(download_format))
     start_date = data.get('start_date')
     if start_date in ('', 'None'):
         start_date = None
     end_date = data.get('end_date')
     if end_date in ('', 'None'):
         end_date = None
-    try:
-        async with request.app['db'].acquire() as conn:
-            result = await db_get_history(conn, user, start_date, end_date, root_entity_id)
-    except RecordNotFound as e:
-        return web.Response(text=str(e))
-    actions = [
-        Action(
-            a.entity_id,
-            a.user,
-            a.action,
-            a.date.strftime('%Y-%m-%d %H:%M:%S'),
-            a.text
-        )._asdict() for a in result
-    ]
-    if download_format == 'json':
-        output = json.dumps(actions)
-    elif download_format == 'xml':
-        output = compose_history_in_xml(actions)
-    else:
-        raise Exception('unsupported format {}'.format(download_format))
     filename = '{}_history.{}'.format(user, download_format)
 
-    res = web.Response(
-        text=output,
-        headers={
-            'Content-Type': 'application/octet-stream',
-            'Content-Disposition': 'attachment; filename={}'.format(filename),
-        }
-    )
-    await res.prepare(request)
-    return res
+    async with request.app['db'].acquire() as conn:
+        batches = db_stream_history(
+            conn, user, start_date, end_date, root_entity_id,
+            search_history=request.app['search_history'])
+        # the search is saved, so search history is read from the primary for a while
+        _mark_write(request)
+        try:
+            try:
+                first_batch = await batches.__anext__()
+            except RecordNotFound as e:
+                return web.Response(text=str(e))
+            res = web.StreamResponse(
+                headers={
+                    'Content-Type': 'application/octet-stream',
+                    'Content-Disposition': 'attachment; filename={}'.format(filename),
+                }
+            )
+            await res.prepare(request)
+            await HISTORY_WRITERS[download_format](res, _prepend_batch(first_batch, batches))
+            await res.write_eof()
+            return res
+        finally:
+            await batches.aclose()
 
 
 @aiohttp_jinja2.template('history.html')
@@ -252,7 +693,7 @@ async def get_search_history(request):
     Allow to re-download one.
     """
     user = request.match_info['user']
-    async with request.app['db'].acquire() as conn:
+    async with _read_pool(request).acquire() as conn:
         try:
             result = await db_get_search_history(conn, user)
         except RecordNotFound as e:
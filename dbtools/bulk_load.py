@@ -0,0 +1,360 @@
+"""
+Bulk load users, posts, comments and history through COPY.
+
+Inputs are CSV files with a header or NDJSON files(`.ndjson`/`.jsonl`),
+with the columns listed in `TABLES`, empty CSV fields and missing JSON keys
+are NULLs. Posts and comments keep their IDs, parents are referred by
+`parent_type`/`parent_id` and may be either loaded or existing ones.
+Rows are streamed, inputs are never held in memory.
+
+The load is a single transaction:
+ - users, posts and comments are copied into temp staging tables;
+ - user triggers of posts/comments are suspended, their foreign keys
+   and secondary indexes are dropped(history indexes are kept, it's partitioned);
+ - entities, roots/paths, search documents and closure rows are computed set-based
+   in one pass(closure rows are skipped when `comments.hierarchy` is 'path'),
+   loaded comments are added to reply counters and tree versions of their ancestors;
+ - history is copied as is, or 'create' rows are added as triggers would;
+ - foreign keys are re-added, which validates them by a single join,
+   indexes are rebuilt, serial sequences are moved past the loaded IDs
+   and tree caches are told to drop everything.
+Any error rolls everything back. History rows out of the existing partitions
+land in `history_default`.
+
+aiopg doesn't support COPY, so the loader is a plain psycopg2 client.
+
+    PYTHONPATH=core python dbtools/bulk_load.py --env dev \\
+        --users users.csv --posts posts.csv --comments comments.ndjson
+"""
+
+import argparse
+import csv
+import json
+import time
+
+import psycopg2
+
+from notify import compose_dsn
+from settings import config
+
+
+TABLES = {
+    'users': ('username', 'first_name', 'second_name'),
+    'posts': (
+        'id', 'creator', 'date_created', 'date_last_modified', 'user_last_modified', 'text',
+    ),
+    'comments': (
+        'id', 'creator', 'date_created', 'date_last_modified', 'user_last_modified', 'text',
+        'parent_type', 'parent_id',
+    ),
+    'history': (
+        'entity_type', 'entity_id', 'user', 'action', 'date', 'text',
+        'parent_type', 'parent_id',
+    ),
+}
+
+# tables which triggers are suspended and indexes rebuilt
+LOADED_TABLES = ('posts', 'comments', 'entities_closure_table', 'history')
+
+CREATE_STAGING = """
+    CREATE TEMP TABLE stage_users (
+      username varchar(100), first_name varchar(100), second_name varchar(100)
+    ) ON COMMIT DROP;
+    CREATE TEMP TABLE stage_posts (
+      id integer, creator varchar(100), date_created timestamptz,
+      date_last_modified timestamptz, user_last_modified varchar(100), text varchar
+    ) ON COMMIT DROP;
+    CREATE TEMP TABLE stage_comments (
+      id integer, creator varchar(100), date_created timestamptz,
+      date_last_modified timestamptz, user_last_modified varchar(100), text varchar,
+      parent_type entity_type, parent_id integer
+    ) ON COMMIT DROP;
+"""
+
+INSERT_USERS = """
+    INSERT INTO users (username, first_name, second_name)
+    SELECT username, first_name, second_name FROM stage_users
+    ON CONFLICT DO NOTHING
+"""
+
+INSERT_ENTITIES = """
+    INSERT INTO entities (type, id)
+    SELECT 'post'::entity_type, id FROM stage_posts
+    UNION ALL
+    SELECT 'comment', id FROM stage_comments
+"""
+
+# paths are walked down from comments of posts and of existing comments,
+# comments which aren't reached(e.g. cycles or missing parents) are not loaded
+COMPUTE_PATHS = """
+    CREATE INDEX ON stage_comments (parent_id);
+    ANALYZE stage_comments;
+    CREATE TEMP TABLE stage_paths ON COMMIT DROP AS
+    WITH RECURSIVE tree (id, root_type, root_id, path) AS (
+      SELECT s.id, s.parent_type, s.parent_id, ARRAY[s.id]
+      FROM stage_comments as s
+      WHERE s.parent_type != 'comment'
+      UNION ALL
+      SELECT s.id, c.root_type, c.root_id, c.path || s.id
+      FROM stage_comments as s JOIN comments as c ON c.id = s.parent_id
+      WHERE s.parent_type = 'comment' AND c.deleted_at IS NULL
+      UNION ALL
+      SELECT s.id, tree.root_type, tree.root_id, tree.path || s.id
+      FROM tree JOIN stage_comments as s ON s.parent_type = 'comment' and s.parent_id = tree.id
+    )
+    SELECT * FROM tree
+"""
+
+# loaded comments are counted in all their ancestors, loaded or existing ones,
+# as 4_reply_counters.sql triggers would
+COMPUTE_REPLY_COUNTS = """
+    CREATE TEMP TABLE stage_counts ON COMMIT DROP AS
+    SELECT r.type, r.id, sum(r.replies)::integer as replies, count(*)::integer as descendants
+    FROM (
+      SELECT p.root_type as type, p.root_id as id,
+             CASE WHEN array_length(p.path, 1) = 1 THEN 1 ELSE 0 END as replies
+      FROM stage_paths as p
+      UNION ALL
+      SELECT 'comment', a.id, CASE WHEN a.n = array_length(p.path, 1) - 1 THEN 1 ELSE 0 END
+      FROM stage_paths as p,
+           unnest(p.path[1:array_length(p.path, 1) - 1]) WITH ORDINALITY as a(id, n)
+    ) as r
+    GROUP BY r.type, r.id
+"""
+
+INSERT_POSTS = """
+    INSERT INTO posts (
+      id, type, creator, date_created, date_last_modified, user_last_modified, text,
+      root_type, root_id, path, direct_reply_count, descendant_count
+    )
+    SELECT s.id, 'post', s.creator, coalesce(s.date_created, now()),
+           coalesce(s.date_last_modified, s.date_created, now()),
+           coalesce(s.user_last_modified, s.creator), s.text, 'post', s.id, '{}',
+           coalesce(k.replies, 0), coalesce(k.descendants, 0)
+    FROM stage_posts as s LEFT JOIN stage_counts as k ON k.type = 'post' AND k.id = s.id
+"""
+
+INSERT_COMMENTS = """
+    INSERT INTO comments (
+      id, type, creator, date_created, date_last_modified, user_last_modified, text,
+      parent_type, parent_id, root_type, root_id, path, search_vector,
+      direct_reply_count, descendant_count
+    )
+    SELECT s.id, 'comment', s.creator, coalesce(s.date_created, now()),
+           coalesce(s.date_last_modified, s.date_created, now()),
+           coalesce(s.user_last_modified, s.creator), s.text,
+           s.parent_type, s.parent_id, p.root_type, p.root_id, p.path,
+           to_tsvector('pg_catalog.english', s.text),
+           coalesce(k.replies, 0), coalesce(k.descendants, 0)
+    FROM stage_comments as s JOIN stage_paths as p ON p.id = s.id
+      LEFT JOIN stage_counts as k ON k.type = 'comment' AND k.id = s.id
+"""
+
+# loaded entities got their counters on insert, existing ancestors are updated
+# and their trees are bumped
+ADD_REPLY_COUNTS = """
+    WITH counted_posts AS (
+      UPDATE posts as p
+      SET direct_reply_count = p.direct_reply_count + k.replies,
+          descendant_count = p.descendant_count + k.descendants,
+          tree_version = p.tree_version + 1, tree_modified_at = now()
+      FROM stage_counts as k
+      WHERE k.type = 'post' AND p.id = k.id
+        AND NOT EXISTS (SELECT 1 FROM stage_posts as s WHERE s.id = k.id)
+    )
+    UPDATE comments as c
+    SET direct_reply_count = c.direct_reply_count + k.replies,
+        descendant_count = c.descendant_count + k.descendants,
+        tree_version = c.tree_version + 1, tree_modified_at = now()
+    FROM stage_counts as k
+    WHERE k.type = 'comment' AND c.id = k.id
+      AND NOT EXISTS (SELECT 1 FROM stage_comments as s WHERE s.id = k.id)
+"""
+
+# every comment is a descendant of itself, its ancestor comments and the root,
+# depths are counted along the path(see 5_closure_depth.sql)
+INSERT_CLOSURE = """
+    INSERT INTO entities_closure_table (ancestor_type, ancestor_id, descendant_type, descendant_id, depth)
+    SELECT 'post'::entity_type, id, 'post'::entity_type, id, 0 FROM stage_posts
+    UNION ALL
+    SELECT root_type, root_id, 'comment', id, array_length(path, 1) FROM stage_paths
+    UNION ALL
+    SELECT 'comment', a.id, 'comment', p.id, array_length(p.path, 1) - a.n::integer
+    FROM stage_paths as p, unnest(p.path) WITH ORDINALITY as a(id, n)
+"""
+
+INSERT_CREATE_HISTORY = """
+    INSERT INTO history (entity_id, "user", action, date, text)
+    SELECT id, coalesce(user_last_modified, creator), 'create',
+           coalesce(date_created, now()), text
+    FROM stage_comments
+"""
+
+FOREIGN_KEYS = """
+    SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid)
+    FROM pg_constraint
+    WHERE contype = 'f' AND conrelid IN ('posts'::regclass, 'comments'::regclass)
+"""
+
+# indexes of partitioned tables(history) are kept: dropping one drops the ones
+# of the partitions, and its definition re-creates it `ON ONLY` the parent
+SECONDARY_INDEXES = """
+    SELECT i.indexrelid::regclass::text, pg_get_indexdef(i.indexrelid)
+    FROM pg_index as i JOIN pg_class as t ON t.oid = i.indrelid
+    WHERE i.indrelid = ANY(%s::regclass[]) AND NOT i.indisprimary AND NOT i.indisunique
+      AND t.relkind != 'p'
+"""
+
+
+def _copy_value(value):
+    """Encode a value for COPY text format."""
+    if value is None:
+        return '\\N'
+    if not isinstance(value, str):
+        value = json.dumps(value) if isinstance(value, (list, dict)) else str(value)
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def read_rows(path, columns):
+    """Yield rows of the input file as tuples of the columns."""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith(('.ndjson', '.jsonl')):
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    yield tuple(row.get(column) for column in columns)
+        else:
+            for row in csv.DictReader(f):
+                yield tuple(row.get(column) or None for column in columns)
+
+
+class CopyStream:
+    """File-like object which encodes rows for COPY on read."""
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = ''
+        self.count = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self._buffer += '\t'.join(_copy_value(value) for value in row) + '\n'
+            self.count += 1
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def copy_rows(cur, table, columns, path):
+    """COPY the input file into the table, return the number of rows."""
+    stream = CopyStream(read_rows(path, columns))
+    cur.copy_expert(
+        'COPY {} ({}) FROM STDIN'.format(table, ', '.join('"{}"'.format(c) for c in columns)),
+        stream, size=65536)
+    return stream.count
+
+
+def _scalar(cur, query, params=None):
+    cur.execute(query, params)
+    return cur.fetchone()[0]
+
+
+def suspend(cur, rebuild_indexes):
+    """Suspend triggers, drop foreign keys and indexes, return what to restore."""
+    for table in ('posts', 'comments'):
+        cur.execute('ALTER TABLE {} DISABLE TRIGGER USER'.format(table))
+    cur.execute(FOREIGN_KEYS)
+    foreign_keys = cur.fetchall()
+    for table, name, _ in foreign_keys:
+        cur.execute('ALTER TABLE {} DROP CONSTRAINT {}'.format(table, name))
+    indexes = []
+    if rebuild_indexes:
+        cur.execute(SECONDARY_INDEXES, (list(LOADED_TABLES),))
+        indexes = cur.fetchall()
+        for name, _ in indexes:
+            cur.execute('DROP INDEX {}'.format(name))
+    return foreign_keys, indexes
+
+
+def restore(cur, foreign_keys, indexes):
+    """Rebuild indexes, validate foreign keys and resume triggers."""
+    for name, definition in indexes:
+        cur.execute(definition)
+    for table, name, definition in foreign_keys:
+        cur.execute('ALTER TABLE {} ADD CONSTRAINT {} {}'.format(table, name, definition))
+    for table in ('posts', 'comments'):
+        cur.execute('ALTER TABLE {} ENABLE TRIGGER USER'.format(table))
+
+
+def load(conf, users=None, posts=None, comments=None, history=None,
+         rebuild_indexes=True, maintenance_work_mem='512MB'):
+    """Load the given inputs in a single transaction, return loaded rows per table."""
+    counts = {}
+    conn = psycopg2.connect(compose_dsn(conf))
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute('SET LOCAL synchronous_commit = off')
+            cur.execute('SET LOCAL maintenance_work_mem = %s', (maintenance_work_mem,))
+            cur.execute(CREATE_STAGING)
+            for table, path in (('users', users), ('posts', posts), ('comments', comments)):
+                if path:
+                    counts[table] = copy_rows(cur, 'stage_' + table, TABLES[table], path)
+
+            foreign_keys, indexes = suspend(cur, rebuild_indexes)
+            cur.execute(INSERT_USERS)
+            cur.execute(INSERT_ENTITIES)
+            cur.execute(COMPUTE_PATHS)
+            cur.execute(COMPUTE_REPLY_COUNTS)
+            cur.execute(INSERT_POSTS)
+            cur.execute(INSERT_COMMENTS)
+            if cur.rowcount != counts.get('comments', 0):
+                raise ValueError(
+                    '{} comments have missing parents or cycles'.format(
+                        counts['comments'] - cur.rowcount))
+            if _scalar(cur, "SELECT current_setting('comments.hierarchy', true)") != 'path':
+                cur.execute(INSERT_CLOSURE)
+                counts['entities_closure_table'] = cur.rowcount
+            cur.execute(ADD_REPLY_COUNTS)
+            if history:
+                counts['history'] = copy_rows(cur, 'history', TABLES['history'], history)
+            else:
+                cur.execute(INSERT_CREATE_HISTORY)
+            restore(cur, foreign_keys, indexes)
+
+            for table in ('posts', 'comments', 'history'):
+                cur.execute(
+                    "SELECT setval(pg_get_serial_sequence(%s, 'id'), max(id)) FROM {}"
+                    .format(table), (table,))
+            cur.execute(
+                "SELECT pg_notify('comment_changes', %s)",
+                (json.dumps({'op': 'insert', 'truncated': True}),))
+            cur.execute('ANALYZE users, posts, comments, entities, entities_closure_table, history')
+    finally:
+        conn.close()
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--env', default='dev')
+    for table in ('users', 'posts', 'comments', 'history'):
+        parser.add_argument('--' + table, help='CSV/NDJSON file with {}'.format(table))
+    parser.add_argument('--keep-indexes', action='store_true',
+                        help="don't rebuild indexes, e.g. for small loads into a big DB")
+    parser.add_argument('--maintenance-work-mem', default='512MB')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    counts = load(
+        config[args.env]['postgres'],
+        users=args.users, posts=args.posts, comments=args.comments, history=args.history,
+        rebuild_indexes=not args.keep_indexes,
+        maintenance_work_mem=args.maintenance_work_mem)
+    for table, count in sorted(counts.items()):
+        print('{:<24}{:>12}'.format(table, count))
+    print('loaded in {:.1f}s'.format(time.perf_counter() - start))
@@ -0,0 +1,3 @@
+#!/bin/bash
+# allow streaming replication to replicas, see dbtools/replica
+echo "host replication all all md5" >> "$PGDATA/pg_hba.conf"
@@ -10,3 +10,4 @@ DROP TABLE IF EXISTS search_history CASCADE;
 DROP TABLE IF EXISTS entities_closure_table CASCADE;
 DROP TRIGGER IF EXISTS create_comment_to_closure ON entities CASCADE;
 DROP TRIGGER IF EXISTS delete_comment_to_closure ON entities CASCADE;
+DROP TABLE IF EXISTS schema_migrations CASCADE;
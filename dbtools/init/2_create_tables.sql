@@ -16,6 +16,10 @@
 
 --SET ROLE 'dmishin';
 
+-- the schema is created from scratch, migrations are applied to it
+-- again, see dbtools/migrate.py
+DROP TABLE IF EXISTS schema_migrations;
+
 DROP TYPE IF EXISTS entity_type CASCADE;
 CREATE TYPE entity_type AS ENUM('post', 'comment', 'page');
 DROP TYPE IF EXISTS action_type CASCADE;
@@ -47,22 +51,29 @@ CREATE TABLE "entities_metadata" (
     "type" entity_type NOT NULL,
     "parent_type" entity_type,
     "parent_id" INTEGER,
+    -- tombstone: deleted entities keep their rows and closure rows, so
+    -- a deleted subtree is restored as a whole, see db_delete_comment
+    "deleted_at" TIMESTAMP WITH TIME ZONE,
     FOREIGN KEY ("type", "id") REFERENCES entities("type", "id"),
     FOREIGN KEY ("parent_type", "parent_id") REFERENCES entities("type", "id")
 );
 
 
+-- closure rows are derived from entities and maintained by triggers only,
+-- so there're no foreign keys: row-by-row checks of O(depth) rows
+-- per comment would cost more than the inserts themselves.
 DROP TABLE IF EXISTS entities_closure_table CASCADE;
 CREATE TABLE "entities_closure_table" (
     "id" serial PRIMARY KEY,
     "ancestor_type" entity_type NOT NULL,
     "ancestor_id" INTEGER,
     "descendant_type" entity_type NOT NULL,
-    "descendant_id" INTEGER,
-    FOREIGN KEY (ancestor_type, ancestor_id) REFERENCES entities(type, id),
-    FOREIGN KEY (descendant_type, descendant_id) REFERENCES entities(type, id)
+    "descendant_id" INTEGER
 );
 
+-- subtrees of an entity, e.g. tombstoning a thread
+CREATE INDEX entities_closure_ancestor_idx ON entities_closure_table (ancestor_type, ancestor_id);
+
 
 DROP TABLE IF EXISTS "comments" CASCADE;
 CREATE TABLE "comments" (
@@ -70,10 +81,29 @@ CREATE TABLE "comments" (
     "type" entity_type CHECK("type"='comment'),
     "parent_type" entity_type,
     "parent_id" INTEGER,
+    -- full-text search document of the text, see tr_comments_search_vector
+    "search_vector" tsvector,
     FOREIGN KEY ("type", "id") REFERENCES entities("type", "id"),
     FOREIGN KEY ("parent_type", "parent_id") REFERENCES entities("type", "id")
 ) INHERITS (entities_metadata);
 
+-- reads skip tombstones, so indexes of live comments only are partial.
+-- keyset pagination of first-level children, see db_get_1lvl_comments_page
+CREATE INDEX comments_parent_created_idx ON comments (parent_type, parent_id, date_created, id)
+  WHERE deleted_at IS NULL;
+-- per-user feed, see db_get_comments
+CREATE INDEX comments_creator_created_idx ON comments (creator, date_created DESC, id DESC)
+  WHERE deleted_at IS NULL;
+-- full-text search, see db_search_comments
+CREATE INDEX comments_search_idx ON comments USING GIN (search_vector)
+  WHERE deleted_at IS NULL;
+
+-- the search document is kept in a column, so matches are ranked
+-- without parsing their texts again
+DROP TRIGGER IF EXISTS tr_comments_search_vector ON comments;
+CREATE TRIGGER tr_comments_search_vector BEFORE INSERT OR UPDATE OF text ON comments
+  FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(search_vector, 'pg_catalog.english', text);
+
 
 DROP TABLE IF EXISTS "posts" CASCADE;
 CREATE TABLE "posts" (
@@ -85,21 +115,67 @@ CREATE TABLE "posts" (
 ) INHERITS (entities_metadata);
 
 
+-- history is append-only and grows forever, so it's partitioned by month:
+-- date-bounded queries scan only the relevant partitions.
+-- Partitions are created ahead by create_history_partitions, rows which
+-- don't fit any partition land in history_default.
 DROP TABLE IF EXISTS history CASCADE;
 CREATE TABLE "history" (
-    "id" SERIAL PRIMARY KEY,
+    "id" SERIAL,
     "entity_type" entity_type NOT NULL DEFAULT 'comment',
     "entity_id" INTEGER NOT NULL,
     "user"   VARCHAR(100),
     "action" action_type NOT NULL,
-    "date" TIMESTAMP WITH TIME ZONE,
+    "date" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
     "text" varchar,
     "parent_type" entity_type,
-    "parent_id" INTEGER
-);
+    "parent_id" INTEGER,
+    PRIMARY KEY ("id", "date")
+) PARTITION BY RANGE ("date");
+
+CREATE TABLE history_default PARTITION OF history DEFAULT;
+
+-- rows are appended in date order, so BRIN is tiny and good for ranges
+CREATE INDEX history_date_brin_idx ON history USING BRIN ("date");
+-- per-user history, see db_get_history
+CREATE INDEX history_user_type_date_idx ON history ("user", entity_type, "date");
+
+
+-- create monthly history partitions from the current month
+-- up to `_months_ahead` months ahead, return the number of created ones.
+-- Rows of a new partition which have landed in history_default are moved.
+
+CREATE OR REPLACE function create_history_partitions(_months_ahead integer) RETURNS integer
+  AS $$
+    DECLARE
+      _start date;
+      _end date;
+      _name text;
+      _created integer = 0;
+    BEGIN
+      FOR i IN 0.._months_ahead LOOP
+        _start = date_trunc('month', CURRENT_DATE) + make_interval(months => i);
+        _end = _start + interval '1 month';
+        _name = 'history_' || to_char(_start, 'YYYY_MM');
+        CONTINUE WHEN to_regclass(_name) IS NOT NULL;
+        EXECUTE 'CREATE TABLE ' || quote_ident(_name)
+          || ' (LIKE history INCLUDING DEFAULTS INCLUDING CONSTRAINTS)';
+        EXECUTE 'WITH moved AS (DELETE FROM history_default WHERE "date" >= $1 AND "date" < $2 RETURNING *) '
+          || 'INSERT INTO ' || quote_ident(_name) || ' SELECT * FROM moved'
+          USING _start, _end;
+        EXECUTE 'ALTER TABLE history ATTACH PARTITION ' || quote_ident(_name)
+          || ' FOR VALUES FROM (' || quote_literal(_start) || ') TO (' || quote_literal(_end) || ')';
+        _created = _created + 1;
+      END LOOP;
+      RETURN _created;
+    END
+  $$ LANGUAGE plpgsql;
+
+SELECT create_history_partitions(3);
 
 
 -- add post/comment to entities.
+-- Closure rows of comments are added per statement, see create_comments_closure.
 
 CREATE OR REPLACE function create_entity() RETURNS TRIGGER
   AS $$
@@ -110,13 +186,6 @@ CREATE OR REPLACE function create_entity() RETURNS TRIGGER
       IF NEW.type = 'post' THEN
         INSERT INTO entities_closure_table ("ancestor_type", "ancestor_id", "descendant_type", "descendant_id")
         VALUES(NEW.type, NEW.id, NEW.type, NEW.id);
-      ELSIF NEW.type = 'comment' THEN
-        INSERT INTO entities_closure_table ("ancestor_type", "ancestor_id", "descendant_type", "descendant_id")
-        SELECT ancestor_type, ancestor_id, NEW.type, NEW.id
-        FROM entities_closure_table as ect
-        WHERE ect.descendant_type = NEW.parent_type and ect.descendant_id = NEW.parent_id
-        UNION ALL
-        SELECT NEW.type, NEW.id, NEW.type, NEW.id;
       END IF;
       RETURN NEW;
     END
@@ -131,54 +200,130 @@ CREATE TRIGGER tr_create_comment_to_entity BEFORE INSERT ON comments
   FOR EACH ROW EXECUTE PROCEDURE create_entity();
 
 
--- delete post/comment from entities. Only possible to remove when there's no children
+-- add closure rows of all the comments inserted by a statement at once.
+-- A parent might be inserted by the same statement, so ancestors are
+-- walked up through the new rows until an existing parent is met,
+-- then the closure rows of that parent are copied.
+-- Skipped when `comments.hierarchy` setting is 'path', see 3_hierarchy_path.sql.
+
+CREATE OR REPLACE function create_comments_closure() RETURNS TRIGGER
+  AS $$
+    BEGIN
+      IF current_setting('comments.hierarchy', true) = 'path' THEN
+        RETURN NULL;
+      END IF;
+      WITH RECURSIVE chain ("descendant_id", "ancestor_type", "ancestor_id") AS (
+        SELECT n.id, n.parent_type, n.parent_id
+        FROM new_rows as n
+        UNION ALL
+        SELECT chain.descendant_id, n.parent_type, n.parent_id
+        FROM chain JOIN new_rows as n ON n.type = chain.ancestor_type and n.id = chain.ancestor_id
+      )
+      INSERT INTO entities_closure_table ("ancestor_type", "ancestor_id", "descendant_type", "descendant_id")
+      SELECT n.type, n.id, n.type, n.id
+      FROM new_rows as n
+      UNION ALL
+      SELECT chain.ancestor_type, chain.ancestor_id, 'comment', chain.descendant_id
+      FROM chain JOIN new_rows as n ON n.type = chain.ancestor_type and n.id = chain.ancestor_id
+      UNION ALL
+      SELECT ect.ancestor_type, ect.ancestor_id, 'comment', chain.descendant_id
+      FROM chain JOIN entities_closure_table as ect
+        ON ect.descendant_type = chain.ancestor_type and ect.descendant_id = chain.ancestor_id;
+      RETURN NULL;
+    END
+  $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS tr_create_comments_closure ON comments;
+CREATE TRIGGER tr_create_comments_closure AFTER INSERT ON comments
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE create_comments_closure();
+
+
+-- delete posts/comments from entities, all the rows of a statement at once.
+-- Only possible to remove when there's no children left.
+-- Comments are tombstoned by the app(see `deleted_at`), so this is for purges.
 
 CREATE OR REPLACE function delete_entity() RETURNS TRIGGER
   AS $$
     BEGIN
-      DELETE FROM entities_closure_table
-      WHERE descendant_type = OLD.type and descendant_id = OLD.id;
+      DELETE FROM entities_closure_table as ect
+      USING old_rows as o
+      WHERE ect.descendant_type = o.type and ect.descendant_id = o.id;
 
-      DELETE FROM entities
-      WHERE type = OLD.type and id=OLD.id;
+      DELETE FROM entities as e
+      USING old_rows as o
+      WHERE e.type = o.type and e.id = o.id;
 
-      RETURN NEW;
+      RETURN NULL;
     END
   $$ LANGUAGE plpgsql;
 
 DROP TRIGGER IF EXISTS tr_delete_post_to_entity ON posts;
 CREATE TRIGGER tr_delete_post_to_entity AFTER DELETE ON posts
-  FOR EACH ROW EXECUTE PROCEDURE delete_entity();
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE delete_entity();
 
 DROP TRIGGER IF EXISTS tr_delete_comment_to_entity ON comments;
 CREATE TRIGGER tr_delete_post_to_entity AFTER DELETE ON comments
-  FOR EACH ROW EXECUTE PROCEDURE delete_entity();
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE delete_entity();
 
 
 -- create_comment_to_history  - triggers create_comment_to_history
+-- history is written per statement, see create_comments_history.
+-- Updates which set or clear a tombstone are logged as 'delete'/'restore',
+-- ones which change reply counters only(see 4_reply_counters.sql) aren't logged.
 
 CREATE OR REPLACE function update_history() RETURNS TRIGGER
   AS $$
-    DECLARE
-      _id integer;
-      _user_last_modified varchar(100);
-      _action action_type;
-      _text varchar;
-
     BEGIN
-      IF TG_OP = 'INSERT' THEN _id=NEW.id; _user_last_modified=NEW.user_last_modified; _action = 'create'; _text=NEW.text;
-      ELSIF TG_OP = 'UPDATE' THEN _id=NEW.id; _user_last_modified=NEW.user_last_modified; _action = 'update'; _text=NEW.text;
-      ELSIF TG_OP = 'DELETE' THEN _id=OLD.id; _user_last_modified=OLD.user_last_modified; _action = 'delete'; _text=OLD.text;
+      IF TG_OP = 'DELETE' THEN
+        INSERT INTO history ("entity_id", "user", "action", "date", "text")
+        SELECT o.id, o.user_last_modified, 'delete', CURRENT_TIMESTAMP, o.text
+        FROM old_rows as o;
+      ELSE
+        INSERT INTO history ("entity_id", "user", "action", "date", "text")
+        SELECT n.id, n.user_last_modified,
+               CASE
+                 WHEN o.deleted_at IS NULL AND n.deleted_at IS NOT NULL THEN 'delete'
+                 WHEN o.deleted_at IS NOT NULL AND n.deleted_at IS NULL THEN 'restore'
+                 ELSE 'update'
+               END::action_type,
+               CURRENT_TIMESTAMP, n.text
+        FROM new_rows as n JOIN old_rows as o ON o.id = n.id
+        WHERE (n.text, n.deleted_at, n.date_last_modified, n.user_last_modified)
+          IS DISTINCT FROM (o.text, o.deleted_at, o.date_last_modified, o.user_last_modified);
       END IF;
-      INSERT INTO history ("entity_id", "user", "action", "date", "text")
-      VALUES(_id, _user_last_modified, _action, CURRENT_TIMESTAMP, _text);
-      RETURN NEW;
+      RETURN NULL;
     END
   $$ LANGUAGE plpgsql;
 
+-- transition tables can't be shared by triggers of several events
 DROP TRIGGER IF EXISTS tr_update_history ON comments;
-CREATE TRIGGER tr_update_history AFTER INSERT OR UPDATE OR DELETE ON comments
-  FOR EACH ROW EXECUTE PROCEDURE update_history();
+CREATE TRIGGER tr_update_history AFTER UPDATE ON comments
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE update_history();
+
+DROP TRIGGER IF EXISTS tr_delete_history ON comments;
+CREATE TRIGGER tr_delete_history AFTER DELETE ON comments
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE update_history();
+
+
+CREATE OR REPLACE function create_comments_history() RETURNS TRIGGER
+  AS $$
+    BEGIN
+      INSERT INTO history ("entity_id", "user", "action", "date", "text")
+      SELECT n.id, n.user_last_modified, 'create', CURRENT_TIMESTAMP, n.text
+      FROM new_rows as n;
+      RETURN NULL;
+    END
+  $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS tr_create_comments_history ON comments;
+CREATE TRIGGER tr_create_comments_history AFTER INSERT ON comments
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE create_comments_history();
 
 
 DROP TABLE IF EXISTS search_history;
@@ -0,0 +1,161 @@
+-- Materialized path hierarchy.
+--
+-- Every entity keeps its root(a post) and `path` - IDs of the comments
+-- from the first level one down to the entity itself, so a comment costs
+-- one row no matter how deep it is, while the closure table costs O(depth).
+-- Subtree of a comment is `path @> ARRAY[id]`(GIN index), full tree of a post
+-- is `root_type/root_id`(btree index).
+--
+-- Paths are always maintained, closure rows are skipped when
+-- `comments.hierarchy` is set to 'path':
+--   ALTER DATABASE comments_db SET comments.hierarchy = 'path';
+-- then the app must be switched to 'path' hierarchy too(see settings).
+--
+-- The script is idempotent, dbtools/migrate_hierarchy.py applies it
+-- to an existing DB and fills paths from the closure table.
+
+ALTER TABLE entities_metadata ADD COLUMN IF NOT EXISTS "root_type" entity_type;
+ALTER TABLE entities_metadata ADD COLUMN IF NOT EXISTS "root_id" INTEGER;
+ALTER TABLE entities_metadata ADD COLUMN IF NOT EXISTS "path" INTEGER[];
+
+CREATE INDEX IF NOT EXISTS comments_root_idx ON comments (root_type, root_id)
+  WHERE deleted_at IS NULL;
+CREATE INDEX IF NOT EXISTS comments_path_idx ON comments USING GIN (path);
+CREATE INDEX IF NOT EXISTS posts_root_idx ON posts (root_type, root_id);
+
+
+-- set root and path of a new post/comment from its parent.
+-- Parents inserted by the same statement must go before their children,
+-- see db_create_comments_bulk. Deleted comments can't be answered.
+
+CREATE OR REPLACE function set_entity_path() RETURNS TRIGGER
+  AS $$
+    BEGIN
+      IF NEW.parent_type IS NULL THEN
+        NEW.root_type = NEW.type;
+        NEW.root_id = NEW.id;
+        NEW.path = '{}';
+      ELSIF NEW.parent_type = 'comment' THEN
+        SELECT c.root_type, c.root_id, c.path || NEW.id
+        INTO NEW.root_type, NEW.root_id, NEW.path
+        FROM comments as c WHERE c.id = NEW.parent_id AND c.deleted_at IS NULL;
+        IF NOT FOUND THEN
+          RAISE EXCEPTION USING ERRCODE = 'foreign_key_violation',
+            MESSAGE = 'parent comment does not exist: ' || NEW.parent_id;
+        END IF;
+      ELSE
+        NEW.root_type = NEW.parent_type;
+        NEW.root_id = NEW.parent_id;
+        NEW.path = ARRAY[NEW.id];
+      END IF;
+      RETURN NEW;
+    END
+  $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS tr_set_post_path ON posts;
+CREATE TRIGGER tr_set_post_path BEFORE INSERT ON posts
+  FOR EACH ROW EXECUTE PROCEDURE set_entity_path();
+
+DROP TRIGGER IF EXISTS tr_set_comment_path ON comments;
+CREATE TRIGGER tr_set_comment_path BEFORE INSERT ON comments
+  FOR EACH ROW EXECUTE PROCEDURE set_entity_path();
+
+
+-- notify listeners(e.g. tree caches and live subscriptions) about changed comments.
+-- Payload carries IDs of the changed comments as `ids` and their other
+-- ancestors as `roots`, so an ID isn't sent twice(see notify.changed_roots),
+-- if it doesn't fit into NOTIFY limit listeners are told to drop everything.
+-- Ancestors are taken from paths. Changes are notified per statement.
+
+DROP FUNCTION IF EXISTS notify_comments(text, json);
+CREATE OR REPLACE function notify_comments(_op text, _roots json, _ids json) RETURNS void
+  AS $$
+    DECLARE
+      _payload text;
+    BEGIN
+      _payload = json_build_object('op', _op, 'roots', _roots, 'ids', _ids)::text;
+      IF octet_length(_payload) > 7900 THEN
+        _payload = json_build_object('op', _op, 'truncated', true)::text;
+      END IF;
+      PERFORM pg_notify('comment_changes', _payload);
+    END
+  $$ LANGUAGE plpgsql;
+
+-- rows of updates are taken from new_rows, of deletes from old_rows,
+-- statements which changed nothing aren't notified. Reply counters of
+-- ancestors are changed with the comments, which notify them already,
+-- so counter-only updates(see 4_reply_counters.sql) are skipped.
+
+CREATE OR REPLACE function notify_comment_change() RETURNS TRIGGER
+  AS $$
+    DECLARE
+      _roots json;
+      _ids json;
+    BEGIN
+      IF TG_OP = 'DELETE' THEN
+        SELECT json_agg(json_build_array(r.type, r.id)) INTO _roots
+        FROM (
+          SELECT o.root_type as type, o.root_id as id FROM old_rows as o
+          UNION
+          SELECT 'comment', unnest(o.path) FROM old_rows as o
+          EXCEPT
+          SELECT 'comment', o.id FROM old_rows as o
+        ) as r;
+        SELECT json_agg(o.id) INTO _ids FROM old_rows as o;
+      ELSE
+        WITH changed AS (
+          SELECT n.root_type, n.root_id, n.path, n.id
+          FROM new_rows as n JOIN old_rows as o ON o.id = n.id
+          WHERE (n.text, n.deleted_at, n.date_last_modified, n.user_last_modified)
+            IS DISTINCT FROM (o.text, o.deleted_at, o.date_last_modified, o.user_last_modified)
+        )
+        SELECT
+          (SELECT json_agg(json_build_array(r.type, r.id))
+           FROM (
+             SELECT c.root_type as type, c.root_id as id FROM changed as c
+             UNION
+             SELECT 'comment', unnest(c.path) FROM changed as c
+             EXCEPT
+             SELECT 'comment', c.id FROM changed as c
+           ) as r),
+          (SELECT json_agg(c.id) FROM changed as c)
+        INTO _roots, _ids;
+      END IF;
+      IF _roots IS NOT NULL THEN
+        PERFORM notify_comments(lower(TG_OP), _roots, _ids);
+      END IF;
+      RETURN NULL;
+    END
+  $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS tr_notify_comment_change ON comments;
+CREATE TRIGGER tr_notify_comment_change AFTER UPDATE ON comments
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE notify_comment_change();
+
+DROP TRIGGER IF EXISTS tr_notify_comment_delete ON comments;
+CREATE TRIGGER tr_notify_comment_delete AFTER DELETE ON comments
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE notify_comment_change();
+
+CREATE OR REPLACE function notify_comments_insert() RETURNS TRIGGER
+  AS $$
+    BEGIN
+      PERFORM notify_comments('insert', (
+        SELECT json_agg(json_build_array(r.type, r.id))
+        FROM (
+          SELECT n.root_type as type, n.root_id as id FROM new_rows as n
+          UNION
+          SELECT 'comment', unnest(n.path) FROM new_rows as n
+          EXCEPT
+          SELECT 'comment', n.id FROM new_rows as n
+        ) as r
+      ), (SELECT json_agg(n.id) FROM new_rows as n));
+      RETURN NULL;
+    END
+  $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS tr_notify_comments_insert ON comments;
+CREATE TRIGGER tr_notify_comments_insert AFTER INSERT ON comments
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE notify_comments_insert();
@@ -0,0 +1,208 @@
+-- Reply counters and tree versions.
+--
+-- Every entity keeps the number of its live direct replies and of all its
+-- live descendants, so thread listings show them without scanning subtrees.
+-- It also keeps a version of its tree, `tree_version` and `tree_modified_at`
+-- are bumped whenever the entity or any of its descendants is changed,
+-- so conditional requests of trees are answered by a primary key lookup.
+-- Counters are changed per statement along the ancestors of the changed
+-- comments, which are their root and path(see 3_hierarchy_path.sql),
+-- so they're maintained in both hierarchies: creating a comment adds it to
+-- all its ancestors, tombstoning or purging subtracts it, restoring adds it back.
+-- Counters of tombstoned entities are kept the same way, so a restored
+-- subtree has the right counters again.
+--
+-- The script is idempotent and fills the counters of existing entities,
+-- comments created concurrently with the fill may be missed, so apply it
+-- to a running DB when there's no writes.
+
+ALTER TABLE entities_metadata ADD COLUMN IF NOT EXISTS "direct_reply_count" INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE entities_metadata ADD COLUMN IF NOT EXISTS "descendant_count" INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE entities_metadata ADD COLUMN IF NOT EXISTS "tree_version" BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE entities_metadata ADD COLUMN IF NOT EXISTS "tree_modified_at" TIMESTAMP WITH TIME ZONE
+  NOT NULL DEFAULT CURRENT_TIMESTAMP;
+
+-- a changed comment which is counted(+1), uncounted(-1) or
+-- just changed(0) in its ancestors
+DROP TYPE IF EXISTS reply_count_change CASCADE;
+CREATE TYPE reply_count_change AS (
+    "root_type" entity_type,
+    "root_id" INTEGER,
+    "path" INTEGER[],
+    "delta" INTEGER
+);
+
+
+-- add changes to the counters of the ancestors and bump their tree versions,
+-- the root is the parent of first level comments, path is the chain of
+-- comments down to the comment.
+-- Ancestors are locked in the same order(posts, then comments by ID),
+-- so concurrent statements over the same thread wait instead of deadlocking.
+
+CREATE OR REPLACE function add_reply_counts(_changes reply_count_change[]) RETURNS void
+  AS $$
+    DECLARE
+      _types entity_type[];
+      _ids integer[];
+      _replies integer[];
+      _descendants integer[];
+    BEGIN
+      SELECT array_agg(a.type), array_agg(a.id), array_agg(a.replies), array_agg(a.descendants)
+      INTO _types, _ids, _replies, _descendants
+      FROM (
+        SELECT r.type, r.id, sum(r.replies)::integer as replies, sum(r.descendants)::integer as descendants
+        FROM (
+          SELECT c.root_type as type, c.root_id as id,
+                 CASE WHEN array_length(c.path, 1) = 1 THEN c.delta ELSE 0 END as replies,
+                 c.delta as descendants
+          FROM unnest(_changes) as c
+          UNION ALL
+          SELECT 'comment', a.id,
+                 CASE WHEN a.n = array_length(c.path, 1) - 1 THEN c.delta ELSE 0 END,
+                 c.delta
+          FROM unnest(_changes) as c,
+               unnest(c.path[1:array_length(c.path, 1) - 1]) WITH ORDINALITY as a(id, n)
+        ) as r
+        GROUP BY r.type, r.id
+      ) as a;
+
+      IF _ids IS NULL THEN
+        RETURN;
+      END IF;
+
+      PERFORM 1 FROM posts as p
+      WHERE p.id = ANY(ARRAY(SELECT a.id FROM unnest(_types, _ids) as a(type, id) WHERE a.type = 'post'))
+      ORDER BY p.id FOR UPDATE;
+      PERFORM 1 FROM comments as c
+      WHERE c.id = ANY(ARRAY(SELECT a.id FROM unnest(_types, _ids) as a(type, id) WHERE a.type = 'comment'))
+      ORDER BY c.id FOR UPDATE;
+
+      UPDATE posts as p
+      SET direct_reply_count = p.direct_reply_count + a.replies,
+          descendant_count = p.descendant_count + a.descendants,
+          tree_version = p.tree_version + 1, tree_modified_at = now()
+      FROM unnest(_types, _ids, _replies, _descendants) as a(type, id, replies, descendants)
+      WHERE a.type = 'post' AND p.id = a.id;
+
+      UPDATE comments as c
+      SET direct_reply_count = c.direct_reply_count + a.replies,
+          descendant_count = c.descendant_count + a.descendants,
+          tree_version = c.tree_version + 1, tree_modified_at = now()
+      FROM unnest(_types, _ids, _replies, _descendants) as a(type, id, replies, descendants)
+      WHERE a.type = 'comment' AND c.id = a.id;
+    END
+  $$ LANGUAGE plpgsql;
+
+
+-- new comments are counted, updated ones only when they're tombstoned
+-- or restored, purged ones unless they've been tombstoned before.
+-- Ancestors of all of them are bumped. Counter updates of ancestors
+-- fire this trigger too, they aren't changes of the ancestors themselves.
+
+CREATE OR REPLACE function count_replies() RETURNS TRIGGER
+  AS $$
+    DECLARE
+      _changes reply_count_change[];
+    BEGIN
+      IF TG_OP = 'INSERT' THEN
+        SELECT array_agg((n.root_type, n.root_id, n.path,
+                          CASE WHEN n.deleted_at IS NULL THEN 1 ELSE 0 END)::reply_count_change)
+        INTO _changes
+        FROM new_rows as n;
+      ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg((o.root_type, o.root_id, o.path,
+                          CASE WHEN o.deleted_at IS NULL THEN -1 ELSE 0 END)::reply_count_change)
+        INTO _changes
+        FROM old_rows as o;
+      ELSE
+        SELECT array_agg((n.root_type, n.root_id, n.path,
+                          CASE
+                            WHEN o.deleted_at IS NOT NULL AND n.deleted_at IS NULL THEN 1
+                            WHEN o.deleted_at IS NULL AND n.deleted_at IS NOT NULL THEN -1
+                            ELSE 0
+                          END)::reply_count_change)
+        INTO _changes
+        FROM new_rows as n JOIN old_rows as o ON o.id = n.id
+        WHERE (n.text, n.deleted_at, n.date_last_modified, n.user_last_modified)
+          IS DISTINCT FROM (o.text, o.deleted_at, o.date_last_modified, o.user_last_modified);
+      END IF;
+      IF _changes IS NOT NULL THEN
+        PERFORM add_reply_counts(_changes);
+      END IF;
+      RETURN NULL;
+    END
+  $$ LANGUAGE plpgsql;
+
+-- transition tables can't be shared by triggers of several events
+DROP TRIGGER IF EXISTS tr_count_replies_insert ON comments;
+CREATE TRIGGER tr_count_replies_insert AFTER INSERT ON comments
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE count_replies();
+
+DROP TRIGGER IF EXISTS tr_count_replies_update ON comments;
+CREATE TRIGGER tr_count_replies_update AFTER UPDATE ON comments
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE count_replies();
+
+DROP TRIGGER IF EXISTS tr_count_replies_delete ON comments;
+CREATE TRIGGER tr_count_replies_delete AFTER DELETE ON comments
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE count_replies();
+
+
+-- bump the tree version of a changed entity itself,
+-- in place, so it costs no extra row versions
+
+CREATE OR REPLACE function bump_tree_version() RETURNS TRIGGER
+  AS $$
+    BEGIN
+      NEW.tree_version = OLD.tree_version + 1;
+      NEW.tree_modified_at = now();
+      RETURN NEW;
+    END
+  $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS tr_bump_post_tree_version ON posts;
+CREATE TRIGGER tr_bump_post_tree_version BEFORE UPDATE ON posts
+  FOR EACH ROW
+  WHEN ((NEW.text, NEW.deleted_at, NEW.date_last_modified, NEW.user_last_modified)
+    IS DISTINCT FROM (OLD.text, OLD.deleted_at, OLD.date_last_modified, OLD.user_last_modified))
+  EXECUTE PROCEDURE bump_tree_version();
+
+DROP TRIGGER IF EXISTS tr_bump_comment_tree_version ON comments;
+CREATE TRIGGER tr_bump_comment_tree_version BEFORE UPDATE ON comments
+  FOR EACH ROW
+  WHEN ((NEW.text, NEW.deleted_at, NEW.date_last_modified, NEW.user_last_modified)
+    IS DISTINCT FROM (OLD.text, OLD.deleted_at, OLD.date_last_modified, OLD.user_last_modified))
+  EXECUTE PROCEDURE bump_tree_version();
+
+
+-- fill the counters of existing entities,
+-- rows which already have the right ones aren't touched
+
+WITH counts AS (
+  SELECT r.type, r.id, sum(r.replies)::integer as replies, count(*)::integer as descendants
+  FROM (
+    SELECT c.root_type as type, c.root_id as id,
+           CASE WHEN array_length(c.path, 1) = 1 THEN 1 ELSE 0 END as replies
+    FROM comments as c
+    WHERE c.deleted_at IS NULL
+    UNION ALL
+    SELECT 'comment', a.id, CASE WHEN a.n = array_length(c.path, 1) - 1 THEN 1 ELSE 0 END
+    FROM comments as c,
+         unnest(c.path[1:array_length(c.path, 1) - 1]) WITH ORDINALITY as a(id, n)
+    WHERE c.deleted_at IS NULL
+  ) as r
+  GROUP BY r.type, r.id
+), filled_posts AS (
+  UPDATE posts as p
+  SET direct_reply_count = counts.replies, descendant_count = counts.descendants
+  FROM counts
+  WHERE counts.type = 'post' AND p.id = counts.id
+    AND (p.direct_reply_count, p.descendant_count) != (counts.replies, counts.descendants)
+)
+UPDATE comments as c
+SET direct_reply_count = counts.replies, descendant_count = counts.descendants
+FROM counts
+WHERE counts.type = 'comment' AND c.id = counts.id
+  AND (c.direct_reply_count, c.descendant_count) != (counts.replies, counts.descendants);
@@ -0,0 +1,85 @@
+-- Depth of closure rows.
+--
+-- Every closure row keeps the number of edges between the ancestor and
+-- the descendant(0 for the entity itself), so subtrees are read down to
+-- the displayed depth only: `ancestor = X AND depth <= N` is a range scan
+-- of the ancestor depth index, see db_get_full_tree. Paths give the depth
+-- without the closure table, see 3_hierarchy_path.sql.
+--
+-- The script is idempotent and fills depths of existing closure rows
+-- from paths, apply it when there's no writes.
+
+ALTER TABLE entities_closure_table ADD COLUMN IF NOT EXISTS "depth" INTEGER NOT NULL DEFAULT 0;
+
+DROP INDEX IF EXISTS entities_closure_ancestor_idx;
+CREATE INDEX IF NOT EXISTS entities_closure_ancestor_depth_idx
+  ON entities_closure_table (ancestor_type, ancestor_id, depth);
+
+
+-- add post/comment to entities, a post is its own closure row.
+-- Closure rows of comments are added per statement, see create_comments_closure.
+
+CREATE OR REPLACE function create_entity() RETURNS TRIGGER
+  AS $$
+    BEGIN
+      INSERT INTO entities ("type", "id")
+      VALUES (NEW.type, NEW.id);
+
+      IF NEW.type = 'post' THEN
+        INSERT INTO entities_closure_table ("ancestor_type", "ancestor_id", "descendant_type", "descendant_id", "depth")
+        VALUES(NEW.type, NEW.id, NEW.type, NEW.id, 0);
+      END IF;
+      RETURN NEW;
+    END
+  $$ LANGUAGE plpgsql;
+
+
+-- add closure rows of all the comments inserted by a statement at once,
+-- the chain counts edges up to the ancestor, rows copied from an existing
+-- ancestor add its own depth.
+
+CREATE OR REPLACE function create_comments_closure() RETURNS TRIGGER
+  AS $$
+    BEGIN
+      IF current_setting('comments.hierarchy', true) = 'path' THEN
+        RETURN NULL;
+      END IF;
+      WITH RECURSIVE chain ("descendant_id", "ancestor_type", "ancestor_id", "depth") AS (
+        SELECT n.id, n.parent_type, n.parent_id, 1
+        FROM new_rows as n
+        UNION ALL
+        SELECT chain.descendant_id, n.parent_type, n.parent_id, chain.depth + 1
+        FROM chain JOIN new_rows as n ON n.type = chain.ancestor_type and n.id = chain.ancestor_id
+      )
+      INSERT INTO entities_closure_table ("ancestor_type", "ancestor_id", "descendant_type", "descendant_id", "depth")
+      SELECT n.type, n.id, n.type, n.id, 0
+      FROM new_rows as n
+      UNION ALL
+      SELECT chain.ancestor_type, chain.ancestor_id, 'comment', chain.descendant_id, chain.depth
+      FROM chain JOIN new_rows as n ON n.type = chain.ancestor_type and n.id = chain.ancestor_id
+      UNION ALL
+      SELECT ect.ancestor_type, ect.ancestor_id, 'comment', chain.descendant_id, chain.depth + ect.depth
+      FROM chain JOIN entities_closure_table as ect
+        ON ect.descendant_type = chain.ancestor_type and ect.descendant_id = chain.ancestor_id;
+      RETURN NULL;
+    END
+  $$ LANGUAGE plpgsql;
+
+
+-- fill depths of existing rows: a comment is as deep under its root as
+-- its path is long, under an ancestor comment by the rest of the path.
+-- Rows which already have the right depth aren't touched.
+
+UPDATE entities_closure_table as ect
+SET depth = d.depth
+FROM (
+  SELECT c.root_type as ancestor_type, c.root_id as ancestor_id, c.id,
+         array_length(c.path, 1) as depth
+  FROM comments as c
+  UNION ALL
+  SELECT 'comment', a.id, c.id, array_length(c.path, 1) - a.n::integer
+  FROM comments as c, unnest(c.path) WITH ORDINALITY as a(id, n)
+) as d
+WHERE ect.descendant_type = 'comment' AND ect.descendant_id = d.id
+  AND ect.ancestor_type = d.ancestor_type AND ect.ancestor_id = d.ancestor_id
+  AND ect.depth != d.depth;
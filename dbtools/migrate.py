@@ -0,0 +1,177 @@
+"""
+Apply versioned schema migrations to a running DB.
+
+Migrations are `dbtools/migrations/<version>_<name>.sql` files applied in
+version order on top of the schema of dbtools/init, each one once: applied
+ones are recorded in `schema_migrations` with checksums of their files,
+and a changed file of an applied migration is an error.
+
+A migration runs in a transaction, unless its first line is
+`-- migrate: no-transaction`, e.g. the one building indexes CONCURRENTLY,
+which doesn't block writes but can't run in a transaction. Statements of
+such a migration run one by one, so every statement ends with `;` at the
+end of a line, and they're idempotent(`IF NOT EXISTS`): a failed migration
+is run again as a whole. Indexes left invalid by a failed concurrent build
+are dropped before that. Runners of several hosts are serialized by
+an advisory lock.
+
+    PYTHONPATH=core python dbtools/migrate.py --env dev
+"""
+
+import argparse
+import asyncio
+from collections import namedtuple
+import hashlib
+import os
+import re
+
+from drivers import create_aiopg_pool
+from settings import config
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'migrations')
+
+NO_TRANSACTION = '-- migrate: no-transaction'
+
+# key of the advisory lock held while migrations are applied
+LOCK_KEY = 7267531
+
+_FILE_RE = re.compile(r'^(\d+)_(\w+)\.sql$')
+_STATEMENT_END_RE = re.compile(r';[ \t]*$', re.MULTILINE)
+_CONCURRENT_INDEX_RE = re.compile(
+    r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', re.IGNORECASE)
+
+CREATE_MIGRATIONS_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+      "version" INTEGER PRIMARY KEY,
+      "name" varchar NOT NULL,
+      "checksum" varchar NOT NULL,
+      "applied_at" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+INVALID_INDEXES = """
+    SELECT c.relname FROM pg_index as i JOIN pg_class as c ON c.oid = i.indexrelid
+    WHERE NOT i.indisvalid AND c.relkind = %s AND c.relname = ANY(%s::text[])
+"""
+
+
+class MigrationError(Exception):
+    """Migrations can't be applied, e.g. an applied one was changed."""
+
+
+Migration = namedtuple('Migration', 'version name sql checksum transactional')
+
+
+def load_migrations(directory=MIGRATIONS_DIR):
+    """Read migrations of the directory, ordered by version."""
+    migrations = {}
+    for filename in os.listdir(directory):
+        match = _FILE_RE.match(filename)
+        if not match:
+            continue
+        version = int(match.group(1))
+        if version in migrations:
+            raise MigrationError('Duplicate migration version {}'.format(version))
+        with open(os.path.join(directory, filename)) as f:
+            sql = f.read().replace('\r\n', '\n')
+        migrations[version] = Migration(
+            version, match.group(2), sql, hashlib.sha256(sql.encode()).hexdigest(),
+            not sql.startswith(NO_TRANSACTION))
+    return [migrations[version] for version in sorted(migrations)]
+
+
+def split_statements(sql):
+    """Split SQL of a non-transactional migration into statements."""
+    statements = (s.strip() for s in _STATEMENT_END_RE.split(sql))
+    return [s for s in statements
+            if any(line.strip() and not line.strip().startswith('--') for line in s.splitlines())]
+
+
+async def applied_migrations(conn):
+    """Return checksums of applied migrations by version."""
+    await conn.execute(CREATE_MIGRATIONS_TABLE)
+    result = await conn.execute('SELECT version, checksum FROM schema_migrations')
+    return {row.version: row.checksum for row in await result.fetchall()}
+
+
+async def drop_invalid_indexes(conn, sql):
+    """Drop indexes of the migration left invalid by a failed concurrent build."""
+    names = _CONCURRENT_INDEX_RE.findall(sql)
+    if not names:
+        return
+    # aiopg takes params starting with a list for executemany ones,
+    # so the relation kind goes first
+    result = await conn.execute(INVALID_INDEXES, ('i', names))
+    for row in await result.fetchall():
+        await conn.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(row.relname))
+
+
+async def apply_migration(conn, migration):
+    """Apply the migration and record it."""
+    record = (
+        'INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)',
+        (migration.version, migration.name, migration.checksum)
+    )
+    if migration.transactional:
+        async with conn.begin():
+            await conn.execute(migration.sql)
+            await conn.execute(*record)
+        return
+    await drop_invalid_indexes(conn, migration.sql)
+    for statement in split_statements(migration.sql):
+        await conn.execute(statement)
+    await conn.execute(*record)
+
+
+async def migrate(conn, migrations=None, target=None):
+    """
+    Apply pending migrations up to the `target` version, all by default.
+
+    Return versions of the applied ones.
+    """
+    if migrations is None:
+        migrations = load_migrations()
+    await conn.execute('SELECT pg_advisory_lock(%s)', (LOCK_KEY,))
+    try:
+        applied = await applied_migrations(conn)
+        for migration in migrations:
+            checksum = applied.get(migration.version)
+            if checksum is not None and checksum != migration.checksum:
+                raise MigrationError(
+                    'Migration {} was changed after it had been applied'.format(migration.version))
+        pending = [m for m in migrations
+                   if m.version not in applied and (target is None or m.version <= target)]
+        for migration in pending:
+            await apply_migration(conn, migration)
+        return [m.version for m in pending]
+    finally:
+        await conn.execute('SELECT pg_advisory_unlock(%s)', (LOCK_KEY,))
+
+
+async def main(conf, target=None, status=False):
+    pool = await create_aiopg_pool(conf)
+    try:
+        async with pool.acquire() as conn:
+            if status:
+                applied = await applied_migrations(conn)
+                for migration in load_migrations():
+                    print('{:04d} {:<40}{}'.format(
+                        migration.version, migration.name,
+                        'applied' if migration.version in applied else 'pending'))
+                return
+            versions = await migrate(conn, target=target)
+            print('applied {} migrations {}'.format(len(versions), versions))
+    finally:
+        pool.close()
+        await pool.wait_closed()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--env', default='dev')
+    parser.add_argument('--target', type=int, help='the last version to apply')
+    parser.add_argument('--status', action='store_true', help='list migrations and exit')
+    args = parser.parse_args()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(config[args.env]['postgres'], args.target, args.status))
@@ -0,0 +1,89 @@
+"""
+Migrate an existing DB to the materialized path hierarchy.
+
+Applies dbtools/init/3_hierarchy_path.sql and fills roots and paths of
+the existing posts and comments from the closure table. With
+`--disable-closure` closure rows stop being maintained for new sessions,
+switch the app to 'path' hierarchy in settings before that.
+
+    PYTHONPATH=core python dbtools/migrate_hierarchy.py --env dev
+"""
+
+import argparse
+import asyncio
+import os
+
+from drivers import create_aiopg_pool
+from settings import config
+
+
+HIERARCHY_SQL = os.path.join(os.path.dirname(__file__), 'init', '3_hierarchy_path.sql')
+
+# update triggers would log every backfilled row to history and notify it
+UPDATE_TRIGGERS = ('tr_update_history', 'tr_notify_comment_change')
+
+FILL_POSTS = """
+    UPDATE posts SET root_type = type, root_id = id, path = '{}'
+    WHERE path IS NULL
+"""
+
+# ancestors are ordered by their own depth, which is the number
+# of their closure rows
+FILL_COMMENTS = """
+    WITH depths AS (
+      SELECT descendant_id as id, count(*) as depth
+      FROM entities_closure_table
+      WHERE descendant_type = 'comment'
+      GROUP BY descendant_id
+    ), paths AS (
+      SELECT ect.descendant_id as id,
+             array_agg(ect.ancestor_id ORDER BY d.depth)
+               FILTER (WHERE ect.ancestor_type = 'comment') as path,
+             min(ect.ancestor_type) FILTER (WHERE ect.ancestor_type != 'comment') as root_type,
+             min(ect.ancestor_id) FILTER (WHERE ect.ancestor_type != 'comment') as root_id
+      FROM entities_closure_table as ect
+        LEFT JOIN depths as d ON ect.ancestor_type = 'comment' and d.id = ect.ancestor_id
+      WHERE ect.descendant_type = 'comment'
+      GROUP BY ect.descendant_id
+    )
+    UPDATE comments as c
+    SET root_type = p.root_type, root_id = p.root_id, path = p.path
+    FROM paths as p
+    WHERE c.id = p.id AND c.path IS NULL
+"""
+
+
+async def migrate(conf, disable_closure=False):
+    pool = await create_aiopg_pool(conf)
+    try:
+        async with pool.acquire() as conn:
+            async with conn.begin():
+                with open(HIERARCHY_SQL) as f:
+                    await conn.execute(f.read())
+                for trigger in UPDATE_TRIGGERS:
+                    await conn.execute('ALTER TABLE comments DISABLE TRIGGER {}'.format(trigger))
+                await conn.execute(FILL_POSTS)
+                result = await conn.execute(FILL_COMMENTS)
+                print('filled paths of {} comments'.format(result.rowcount))
+                for trigger in UPDATE_TRIGGERS:
+                    await conn.execute('ALTER TABLE comments ENABLE TRIGGER {}'.format(trigger))
+                missing = await (await conn.execute(
+                    'SELECT count(*) FROM comments WHERE path IS NULL')).scalar()
+                if missing:
+                    raise RuntimeError('{} comments have no closure rows'.format(missing))
+            if disable_closure:
+                await conn.execute(
+                    "ALTER DATABASE {} SET comments.hierarchy = 'path'".format(conf['database']))
+                print('closure maintenance is disabled for new sessions')
+    finally:
+        pool.close()
+        await pool.wait_closed()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--env', default='dev')
+    parser.add_argument('--disable-closure', action='store_true')
+    args = parser.parse_args()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(migrate(config[args.env]['postgres'], args.disable_closure))
@@ -0,0 +1,19 @@
+-- migrate: no-transaction
+--
+-- Indexes of the hot paths which the init scripts miss, built CONCURRENTLY
+-- so writes go on while they're built. Every query of core/db.py is an
+-- index scan with them, see tests/core/test_query_plans.py.
+
+-- closure rows of a comment by the comment: copied to its new replies
+-- by create_comments_closure and deleted on purges by delete_entity
+CREATE INDEX CONCURRENTLY IF NOT EXISTS entities_closure_descendant_idx
+  ON entities_closure_table (descendant_type, descendant_id);
+
+-- replies of a purged entity, foreign key checks can't use the partial
+-- comments_parent_created_idx of live comments
+CREATE INDEX CONCURRENTLY IF NOT EXISTS comments_parent_idx
+  ON comments (parent_type, parent_id);
+
+-- searches of a user, see db_get_search_history
+CREATE INDEX CONCURRENTLY IF NOT EXISTS search_history_user_date_idx
+  ON search_history ("user", search_date);
@@ -0,0 +1,18 @@
+#!/bin/bash
+# Streaming replica of $PRIMARY_HOST: the data directory is cloned
+# by pg_basebackup on the first start, then postgres runs as a hot standby.
+set -e
+
+if [ ! -s "$PGDATA/PG_VERSION" ]; then
+  mkdir -p "$PGDATA"
+  chown postgres "$PGDATA"
+  chmod 700 "$PGDATA"
+  until gosu postgres env PGPASSWORD="$POSTGRES_PASSWORD" pg_basebackup \
+      -h "$PRIMARY_HOST" -U "$POSTGRES_USER" -D "$PGDATA" -R -X stream; do
+    echo "waiting for the primary $PRIMARY_HOST"
+    rm -rf "$PGDATA"/*
+    sleep 1
+  done
+fi
+
+exec gosu postgres postgres -c hot_standby=on
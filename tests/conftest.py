@@ -19,7 +19,14 @@ import pytest
 from aiohttp import web
 from aiohttp.test_utils import loop_context
 
+from benchmarks.generators import balanced, create_post, load_tree
+from cache import TreeCache
+from dbtools.migrate import migrate
+from metrics import metrics_middleware
+from replicas import ReplicaRouter
 from routes import setup_routes
+from search_history import SearchHistoryWriter
+from singleflight import SingleFlight
 from settings import config
 
 
@@ -45,7 +52,7 @@ def event_loop(loop):
 @pytest.fixture(scope='session')
 async def comments_app():
     """App fixture, with db engine set up."""
-    _app = web.Application()
+    _app = web.Application(middlewares=[metrics_middleware])
     _app['config'] = config
     # fill route table
     setup_routes(_app)
@@ -63,9 +70,17 @@ async def comments_app():
         maxsize=conf['maxsize'],
         loop=_app.loop)
     _app['db'] = engine
+    _app['hierarchy'] = conf['hierarchy']
+    _app['db_router'] = ReplicaRouter(engine)
+    # no listener in tests, so the cache stays disabled
+    _app['tree_cache'] = TreeCache()
+    _app['tree_flights'] = SingleFlight('tree')
+    _app['version_flights'] = SingleFlight('tree_version')
+    _app['search_history'] = SearchHistoryWriter(engine)
 
     yield _app
 
+    await _app['search_history'].close()
     _app['db'].close()
     await _app['db'].wait_closed()
 
@@ -89,6 +104,26 @@ async def conn(comments_app):
         yield _conn
 
 
+SCHEMA_FILES = (
+    'dbtools/init/2_create_tables.sql', 'dbtools/init/3_hierarchy_path.sql',
+    'dbtools/init/4_reply_counters.sql', 'dbtools/init/5_closure_depth.sql',
+)
+
+
+async def create_schema(conn):
+    """Create the schema of the init scripts and apply migrations to it."""
+    for setup_file in SCHEMA_FILES:
+        async with aiofiles.open(setup_file, 'r') as f:
+            await conn.execute(await f.read())
+    await migrate(conn)
+
+
+async def clean_db(conn):
+    """Drop everything created by the init scripts and migrations."""
+    async with aiofiles.open('dbtools/init/1_clean.sql', 'r') as f:
+        await conn.execute(await f.read())
+
+
 @pytest.fixture
 async def init_a_few_db_entries(request, conn, loop):
     """
@@ -97,11 +132,29 @@ async def init_a_few_db_entries(request, conn, loop):
     Gets entries get cleaned for every test.
     """
     def finalizer():
-        async def finalize():
-            async with aiofiles.open('dbtools/init/1_clean.sql', 'r') as f:
-                await conn.execute(await f.read())
-        loop.run_until_complete(finalize())
+        loop.run_until_complete(clean_db(conn))
     request.addfinalizer(finalizer)
-    for setup_file in ('dbtools/init/2_create_tables.sql', 'dbtools/examples_a_few.sql'):
-        async with aiofiles.open(setup_file, 'r') as f:
-            await conn.execute(await f.read())
\ No newline at end of file
+    await create_schema(conn)
+    async with aiofiles.open('dbtools/examples_a_few.sql', 'r') as f:
+        await conn.execute(await f.read())
+
+
+@pytest.fixture(scope='module')
+async def init_generated_trees(request, conn, loop):
+    """
+    Populate tables with a few entries and generated trees.
+
+    Kept for the whole module, so its tests must not change them.
+    Return IDs of the generated post and of comments with children.
+    """
+    def finalizer():
+        loop.run_until_complete(clean_db(conn))
+    request.addfinalizer(finalizer)
+    await create_schema(conn)
+    async with aiofiles.open('dbtools/examples_a_few.sql', 'r') as f:
+        await conn.execute(await f.read())
+    parents = balanced(2000)
+    post_id = await create_post(conn, 'user1')
+    ids = await load_tree(conn, 'user2', post_id, parents)
+    await conn.execute('ANALYZE')
+    return post_id, [ids[i] for i in sorted(set(parents) - {None})]
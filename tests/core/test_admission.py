@@ -0,0 +1,258 @@
+"""Test module for admission control."""
+
+import asyncio
+
+import pytest
+from aiohttp import web
+from admission import AdmissionController, Overloaded, admission_middleware
+from live import LiveHub
+from metrics import AcquireTimeout, InstrumentedPool, render
+from views import subscribe_comments
+
+
+CLASSES = {
+    'critical': {'priority': 0, 'queue': 10, 'timeout': 1},
+    'read': {'priority': 1, 'queue': 10, 'timeout': 1},
+    'export': {'priority': 2, 'concurrency': 1, 'queue': 1, 'timeout': 0.05},
+}
+
+
+async def _waiting(controller, name):
+    task = asyncio.ensure_future(controller.acquire(name))
+    await asyncio.sleep(0)
+    return task
+
+
+@pytest.mark.asyncio
+async def test_admission_priority():
+    """Test that waiters are granted slots by priority of their classes."""
+    controller = AdmissionController(1, CLASSES)
+    await controller.acquire('read')
+    read = await _waiting(controller, 'read')
+    critical = await _waiting(controller, 'critical')
+    assert controller.stats()['read'] == {'active': 1, 'waiting': 1}
+
+    controller.release('read')
+    await critical
+    assert not read.done()
+    controller.release('critical')
+    await read
+    assert controller.stats()['read'] == {'active': 1, 'waiting': 0}
+
+
+@pytest.mark.asyncio
+async def test_admission_class_concurrency():
+    """Test that a capped class waits while others run."""
+    controller = AdmissionController(3, CLASSES)
+    await controller.acquire('export')
+    export = await _waiting(controller, 'export')
+    await controller.acquire('read')
+    assert controller.active == 2 and not export.done()
+
+    # the queue of one export is full
+    with pytest.raises(Overloaded) as e:
+        await controller.acquire('export')
+    assert e.value.reason == 'queue_full'
+    controller.release('export')
+    await export
+    assert controller.stats()['export'] == {'active': 1, 'waiting': 0}
+
+
+@pytest.mark.asyncio
+async def test_admission_timeout_and_cancel():
+    """Test that waiters leave queues on timeout and cancellation."""
+    controller = AdmissionController(1, CLASSES)
+    await controller.acquire('critical')
+    with pytest.raises(Overloaded) as e:
+        await controller.acquire('export')
+    assert e.value.reason == 'timeout'
+    assert controller.stats()['export'] == {'active': 0, 'waiting': 0}
+
+    read = await _waiting(controller, 'read')
+    read.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await read
+    assert controller.stats()['read'] == {'active': 0, 'waiting': 0}
+
+
+@pytest.mark.asyncio
+async def test_admission_middleware(test_client):
+    """Test that excess requests are answered 503 with Retry-After."""
+    started = asyncio.Event()
+    finish = asyncio.Event()
+
+    async def slow(request):
+        started.set()
+        await finish.wait()
+        return web.Response(text='ok')
+
+    async def timeout(request):
+        raise AcquireTimeout('no connection')
+
+    app = web.Application(middlewares=[admission_middleware])
+    app.router.add_get('/slow', slow)
+    app.router.add_get('/timeout', timeout)
+    app.router.add_get('/free', lambda request: web.Response(text='free'))
+    app['admission'] = AdmissionController(
+        1, {'read': {'queue': 0, 'timeout': 1}}, {'GET /free': None}, 'read', retry_after=3)
+    client = await test_client(app)
+
+    first = asyncio.ensure_future(client.get('/slow'))
+    await started.wait()
+    resp = await client.get('/slow')
+    assert resp.status == 503
+    assert resp.headers['Retry-After'] == '3'
+    resp = await client.get('/free')
+    assert resp.status == 200
+    finish.set()
+    assert (await first).status == 200
+
+    resp = await client.get('/timeout')
+    assert resp.status == 503
+    text = render()
+    assert 'admission_rejected_total{class="read",reason="queue_full"} 1' in text
+    assert 'admission_rejected_total{class="read",reason="acquire_timeout"} 1' in text
+
+
+def test_admission_pool_size():
+    """Test that classes below the top priority leave a connection of the pool."""
+    controller = AdmissionController(20, CLASSES, pool_size=3)
+    assert controller.classes['critical'].concurrency is None
+    assert controller.classes['read'].concurrency == 2
+    assert controller.classes['export'].concurrency == 1
+    assert AdmissionController(20, CLASSES, pool_size=1).classes['read'].concurrency == 1
+
+
+class _Connection:
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    async def __aenter__(self):
+        await self._pool.free.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._pool.free.release()
+
+
+class _SmallPool:
+    closed = True
+
+    def __init__(self, size):
+        self.free = asyncio.Semaphore(size)
+
+    def acquire(self):
+        return _Connection(self)
+
+
+@pytest.mark.asyncio
+async def test_export_leaves_connection_for_writes(test_client):
+    """Test that exports holding connections can't block a create."""
+    started = asyncio.Event()
+    finish = asyncio.Event()
+
+    async def export(request):
+        async with request.app['db'].acquire():
+            started.set()
+            await finish.wait()
+        return web.Response(text='exported')
+
+    async def create(request):
+        async with request.app['db'].acquire():
+            return web.Response(text='created')
+
+    app = web.Application(middlewares=[admission_middleware])
+    app.router.add_post('/export', export)
+    app.router.add_post('/create', create)
+    app['admission'] = AdmissionController(
+        20, {'critical': {'priority': 0}, 'export': {'priority': 2, 'concurrency': 2, 'timeout': 5}},
+        {'POST /create': 'critical'}, 'export', pool_size=2)
+    app['db'] = InstrumentedPool(_SmallPool(2), 'test_small', acquire_timeout=0.1)
+    client = await test_client(app)
+
+    exports = [asyncio.ensure_future(client.post('/export')) for _ in range(2)]
+    await started.wait()
+    resp = await client.post('/create')
+    assert resp.status == 200
+    assert await resp.text() == 'created'
+    finish.set()
+    assert [(await e).status for e in exports] == [200, 200]
+
+
+class _BusyPool:
+    closed = True
+
+    def acquire(self):
+        return self
+
+    async def __aenter__(self):
+        await asyncio.sleep(10)
+
+
+@pytest.mark.asyncio
+async def test_pool_acquire_timeout():
+    """Test that acquires wait for a connection up to the timeout."""
+    pool = InstrumentedPool(_BusyPool(), 'test_busy', acquire_timeout=0.01)
+    with pytest.raises(AcquireTimeout):
+        async with pool.acquire():
+            pass
+    assert 'db_pool_acquire_timeouts_total{pool="test_busy"} 1' in render()
+
+
+class _LatePool:
+    """Pool which hands out a connection just as the acquire is cancelled."""
+    closed = True
+
+    def __init__(self):
+        self.acquired = self.released = 0
+
+    def acquire(self):
+        return self
+
+    async def __aenter__(self):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            self.acquired += 1
+            return 'connection'
+
+    async def __aexit__(self, *exc_info):
+        self.released += 1
+
+
+@pytest.mark.asyncio
+async def test_pool_acquire_timeout_race():
+    """Test that a connection acquired as the acquire ends is released."""
+    late = _LatePool()
+    pool = InstrumentedPool(late, 'test_late', acquire_timeout=0.01)
+    with pytest.raises(AcquireTimeout):
+        async with pool.acquire():
+            pass
+    assert late.acquired == late.released == 1
+
+    pool.acquire_timeout = 10
+    waiting = asyncio.ensure_future(pool.acquire().__aenter__())
+    await asyncio.sleep(0.01)
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    assert late.acquired == late.released == 2
+
+
+@pytest.mark.asyncio
+async def test_subscribe_acquire_timeout(test_client):
+    """Test that routes out of admission answer pool acquire timeouts 503 too."""
+    app = web.Application(middlewares=[admission_middleware])
+    app.router.add_get('/{user}/subscribe', subscribe_comments)
+    app['admission'] = AdmissionController(
+        1, {'read': {'queue': 0, 'timeout': 1}}, {'GET /{user}/subscribe': None}, 'read', retry_after=3)
+    app['db'] = InstrumentedPool(_BusyPool(), 'test_subscribe', acquire_timeout=0.01)
+    app['live'] = hub = LiveHub(None)
+    client = await test_client(app)
+
+    resp = await client.get('/user1/subscribe', params={'root_type': 'post', 'root_id': 1})
+    assert resp.status == 503
+    assert resp.headers['Retry-After'] == '3'
+    assert hub.subscribers == 0
+    assert 'db_pool_acquire_timeouts_total{pool="test_subscribe"} 1' in render()
@@ -0,0 +1,49 @@
+"""Test module for benchmark generators and scenarios."""
+
+import random
+
+import pytest
+from benchmarks.endpoints import SCENARIOS, check_coverage, percentile
+from benchmarks.generators import SHAPES, zipf_sizes
+
+
+@pytest.mark.parametrize('shape', sorted(SHAPES))
+def test_shapes_parents_first(shape):
+    """Test that generated parents go before their children."""
+    parents = SHAPES[shape](100)
+    assert len(parents) == 100
+    assert parents[0] is None
+    assert all(parent is None or parent < i for i, parent in enumerate(parents))
+
+
+def test_shapes():
+    """Test parents of every tree shape on small trees."""
+    assert SHAPES['wide_flat'](3) == [None, None, None]
+    assert SHAPES['deep_chain'](3) == [None, 0, 1]
+    assert SHAPES['balanced'](8, branching=2) == [None, None, 0, 0, 1, 1, 2, 2]
+    parents = SHAPES['random'](50, fanout=10, rnd=random.Random(0))
+    assert parents.count(None) == 10
+
+
+def test_zipf_sizes():
+    """Test that thread sizes add up and follow a long tail."""
+    sizes = zipf_sizes(10000, 100)
+    assert sum(sizes) == 10000
+    assert sizes == sorted(sizes, reverse=True)
+    assert sizes[0] > 10 * sizes[-1]
+
+
+def test_every_route_has_scenario():
+    """Test that a route without a benchmark scenario is an error."""
+    check_coverage(SCENARIOS)
+    with pytest.raises(RuntimeError):
+        check_coverage(SCENARIOS[1:])
+
+
+def test_percentile():
+    """Test nearest-rank percentiles of latencies."""
+    latencies = list(range(1, 101))
+    assert percentile(latencies, 50) == 50
+    assert percentile(latencies, 99) == 99
+    assert percentile([5], 95) == 5
+    assert percentile([], 50) is None
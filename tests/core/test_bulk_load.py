@@ -0,0 +1,186 @@
+"""
+Test module for bulk loading.
+
+Loaded rows are compared with the ones written by triggers for the same
+comments inserted one by one, in a transaction which is rolled back.
+"""
+
+import pytest
+from dbtools.bulk_load import load
+from settings import config
+
+
+USERS_CSV = 'username,first_name,second_name\nuser4,bulk,loader\n'
+POSTS_CSV = 'id,creator,text\n100,user4,bulk post\n'
+# the grandchild goes before its parent, the last one answers an existing comment
+COMMENTS = [
+    '{"id": 103, "creator": "user4", "text": "grandchild", "parent_type": "comment", "parent_id": 102}',
+    '{"id": 101, "creator": "user4", "text": "child", "parent_type": "post", "parent_id": 100}',
+    '{"id": 102, "creator": "user1", "text": "grandchild parent", "parent_type": "comment", '
+    '"parent_id": 101}',
+    '{"id": 104, "creator": "user2", "text": "reply", "parent_type": "comment", "parent_id": 3}',
+]
+# the same comments in the order triggers need, existing parents keep their IDs
+TRIGGER_COMMENTS = [
+    (201, 'user4', 'post', 200),
+    (202, 'user1', 'comment', 201),
+    (203, 'user4', 'comment', 202),
+    (204, 'user2', 'comment', 3),
+]
+
+
+def _map(entity_id):
+    """Map IDs of the trigger written rows to the loaded ones."""
+    return entity_id - 100 if entity_id >= 200 else entity_id
+
+
+async def _fetch(conn, query, *params):
+    result = await conn.execute(query, *params)
+    return [row.as_tuple() for row in await result.fetchall()]
+
+
+async def _closure_and_paths(conn, ids):
+    # aiopg takes params starting with a list for executemany ones,
+    # so the entity type goes first
+    closure = await _fetch(conn, """
+        SELECT ancestor_type, ancestor_id, descendant_id, depth FROM entities_closure_table
+        WHERE descendant_type = %s AND descendant_id = ANY(%s::int[])
+        """, ('comment', list(ids)))
+    paths = await _fetch(conn, """
+        SELECT id, root_type, root_id, path FROM comments WHERE type = %s AND id = ANY(%s::int[])
+        """, ('comment', list(ids)))
+    return closure, paths
+
+
+async def _trigger_written(conn):
+    """Closure rows and paths which triggers write for the loaded comments."""
+    tr = await conn.begin()
+    try:
+        await conn.execute(
+            "INSERT INTO posts(id, type, creator, user_last_modified, text) "
+            "VALUES(200, 'post', 'user1', 'user1', 'trigger post')")
+        for comment_id, user, parent_type, parent_id in TRIGGER_COMMENTS:
+            await conn.execute(
+                "INSERT INTO comments(id, type, creator, user_last_modified, text, parent_type, parent_id) "
+                "VALUES(%s, 'comment', %s, %s, 'trigger comment', %s, %s)",
+                (comment_id, user, user, parent_type, parent_id))
+        closure, paths = await _closure_and_paths(conn, [c[0] for c in TRIGGER_COMMENTS])
+    finally:
+        await tr.rollback()
+    return (
+        {(t, _map(a), _map(d), depth) for t, a, d, depth in closure},
+        {(_map(i), t, _map(r), tuple(map(_map, path))) for i, t, r, path in paths},
+    )
+
+
+async def _counters(conn, entities):
+    counters = {}
+    for entity in entities:
+        rows = await _fetch(conn, """
+            SELECT direct_reply_count, descendant_count, tree_version FROM entities_metadata
+            WHERE type = %s AND id = %s
+            """, entity)
+        counters[entity] = rows[0]
+    return counters
+
+
+async def _schema(conn):
+    """Disabled user triggers, foreign keys and indexes of the loaded tables."""
+    disabled = await _fetch(conn, """
+        SELECT tgname FROM pg_trigger
+        WHERE tgrelid IN ('posts'::regclass, 'comments'::regclass)
+          AND NOT tgisinternal AND tgenabled = 'D'
+        """)
+    foreign_keys = await _fetch(conn, """
+        SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE contype = 'f' AND conrelid IN ('posts'::regclass, 'comments'::regclass)
+        """)
+    # partitions of history keep their own indexes
+    indexes = await _fetch(conn, """
+        SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid), indisvalid FROM pg_index
+        WHERE indrelid IN ('posts'::regclass, 'comments'::regclass,
+                           'entities_closure_table'::regclass, 'history'::regclass)
+           OR indrelid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = 'history'::regclass)
+        """)
+    return disabled, sorted(foreign_keys), sorted(indexes)
+
+
+async def _partitions_without_indexes(conn):
+    return await _fetch(conn, """
+        SELECT inhrelid::regclass::text FROM pg_inherits
+        WHERE inhparent = 'history'::regclass
+          AND (SELECT count(*) FROM pg_index WHERE indrelid = inhrelid AND indisvalid) < 2
+        """)
+
+
+def _write_inputs(tmpdir, comments):
+    tmpdir.join('users.csv').write(USERS_CSV)
+    tmpdir.join('posts.csv').write(POSTS_CSV)
+    tmpdir.join('comments.ndjson').write('\n'.join(comments) + '\n')
+    return {name: str(tmpdir.join(filename)) for name, filename in (
+        ('users', 'users.csv'), ('posts', 'posts.csv'), ('comments', 'comments.ndjson'))}
+
+
+@pytest.mark.asyncio
+async def test_bulk_load(conn, init_a_few_db_entries, tmpdir):
+    """Test that loaded rows are the ones triggers would write."""
+    expected_closure, expected_paths = await _trigger_written(conn)
+    ancestors = [('post', 1), ('comment', 1), ('comment', 3)]
+    counters_before = await _counters(conn, ancestors)
+    schema_before = await _schema(conn)
+
+    counts = load(config['test']['postgres'], **_write_inputs(tmpdir, COMMENTS))
+    assert counts['comments'] == 4
+
+    closure, paths = await _closure_and_paths(conn, [101, 102, 103, 104])
+    assert set(closure) == expected_closure
+    assert ('post', 1, 104, 3) in expected_closure
+    assert {(i, t, r, tuple(path)) for i, t, r, path in paths} == expected_paths
+
+    counters = await _counters(conn, ancestors + [('post', 100), ('comment', 101), ('comment', 103)])
+    for entity, (replies, descendants, version) in counters_before.items():
+        new_replies, new_descendants, new_version = counters[entity]
+        assert new_descendants == descendants + 1
+        assert new_replies == replies + (entity == ('comment', 3))
+        assert new_version > version
+    assert counters[('post', 100)][:2] == (1, 3)
+    assert counters[('comment', 101)][:2] == (1, 2)
+    assert counters[('comment', 103)][:2] == (0, 0)
+
+    history = await _fetch(conn, """
+        SELECT entity_id, "user", action FROM history WHERE entity_id >= 100 ORDER BY entity_id
+        """)
+    assert history == [
+        (101, 'user4', 'create'), (102, 'user1', 'create'),
+        (103, 'user4', 'create'), (104, 'user2', 'create'),
+    ]
+
+    schema = await _schema(conn)
+    assert schema == schema_before
+    assert all(valid for _, _, valid in schema[2])
+    assert not await _partitions_without_indexes(conn)
+    # sequences are past the loaded IDs and triggers work again
+    result = await conn.execute(
+        "INSERT INTO comments(type, creator, user_last_modified, text, parent_type, parent_id) "
+        "VALUES('comment', 'user4', 'user4', 'after load', 'comment', 103) RETURNING id")
+    assert await result.scalar() > 104
+    result = await conn.execute(
+        "INSERT INTO posts(type, creator, user_last_modified, text) "
+        "VALUES('post', 'user4', 'user4', 'after load') RETURNING id")
+    assert await result.scalar() > 100
+    assert (await _counters(conn, [('comment', 103)]))[('comment', 103)][:2] == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_bulk_load_missing_parent(conn, init_a_few_db_entries, tmpdir):
+    """Test that a comment with a missing parent rolls the whole load back."""
+    schema_before = await _schema(conn)
+    orphan = '{"id": 105, "creator": "user4", "text": "orphan", "parent_type": "comment", "parent_id": 9999}'
+    with pytest.raises(ValueError):
+        load(config['test']['postgres'], **_write_inputs(tmpdir, COMMENTS + [orphan]))
+
+    assert not await _fetch(conn, "SELECT 1 FROM users WHERE username = 'user4'")
+    assert not await _fetch(conn, 'SELECT 1 FROM entities_metadata WHERE id >= 100')
+    assert not await _fetch(conn, 'SELECT 1 FROM entities_closure_table WHERE descendant_id >= 100')
+    assert not await _fetch(conn, 'SELECT 1 FROM history WHERE entity_id >= 100')
+    assert await _schema(conn) == schema_before
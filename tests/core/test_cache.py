@@ -0,0 +1,61 @@
+"""Test module for the tree cache."""
+
+from cache import TreeCache
+
+
+def _cache(**kwargs):
+    cache = TreeCache(**kwargs)
+    cache.on_listener_reset(True)
+    return cache
+
+
+def test_tree_cache_hit():
+    """Test that a cached value is returned and counted as a hit."""
+    cache = _cache()
+    cache.put(('post', 1), 'tree', b'[]', cache.version(('post', 1)))
+    assert cache.get(('post', 1), 'tree') == b'[]'
+    assert cache.get(('post', 1), 'flat') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_tree_cache_invalidated_by_notification():
+    """Test that changed comments and all their ancestors are invalidated."""
+    cache = _cache()
+    for key in (('post', 1), ('comment', 1), ('comment', 2)):
+        cache.put(key, 'tree', b'[]', cache.version(key))
+    cache.on_notify({'op': 'insert', 'roots': [['comment', 3], ['post', 1], ['comment', 1]]})
+    assert cache.get(('post', 1), 'tree') is None
+    assert cache.get(('comment', 1), 'tree') is None
+    assert cache.get(('comment', 2), 'tree') == b'[]'
+    cache.on_notify({'op': 'update', 'roots': [['post', 2]], 'ids': [2]})
+    assert cache.get(('comment', 2), 'tree') is None
+
+
+def test_tree_cache_stale_put_ignored():
+    """Test that a tree read before invalidation is not cached."""
+    cache = _cache()
+    version = cache.version(('post', 1))
+    cache.invalidate(('post', 1))
+    cache.put(('post', 1), 'tree', b'[]', version)
+    assert cache.get(('post', 1), 'tree') is None
+
+
+def test_tree_cache_lru_and_ttl_eviction():
+    """Test that least recently used and expired entries are evicted."""
+    now = [0]
+    cache = _cache(maxsize=2, ttl=10, clock=lambda: now[0])
+    for entity_id in (1, 2, 3):
+        cache.put(('post', entity_id), 'tree', b'[]', cache.version(('post', entity_id)))
+    assert cache.get(('post', 1), 'tree') is None
+    now[0] = 11
+    assert cache.get(('post', 3), 'tree') is None
+    assert cache.evictions == 2
+
+
+def test_tree_cache_disabled_without_listener():
+    """Test that nothing is cached while the listener is disconnected."""
+    cache = _cache()
+    cache.on_listener_reset(False)
+    cache.put(('post', 1), 'tree', b'[]', cache.version(('post', 1)))
+    cache.on_listener_reset(True)
+    assert cache.get(('post', 1), 'tree') is None
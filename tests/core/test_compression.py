@@ -0,0 +1,61 @@
+"""Test module for serialization and negotiated compression of responses."""
+
+from datetime import datetime, timezone
+import gzip
+import json
+
+import pytest
+from aiohttp import web
+from compression import CODINGS, Compressor, compression_middleware, parse_accept_encoding
+from serializers import dumps, row_to_dict
+
+
+def test_dumps():
+    """Test that json is compact and datetimes are ISO 8601 strings."""
+    date = datetime(2018, 1, 1, tzinfo=timezone.utc)
+    row = {'id': 1, 'date_created': date, 'text': 'привет'}
+    body = dumps([row_to_dict(row, convert=None)])
+    assert json.loads(body.decode()) == [
+        {'id': 1, 'date_created': '2018-01-01T00:00:00+00:00', 'text': 'привет'}]
+    assert b' ' not in body
+    assert dumps(row_to_dict(row, ['id'])) == b'{"id":1}'
+
+
+def test_parse_accept_encoding():
+    assert parse_accept_encoding('gzip, deflate, br;q=0.5, *;q=0') == {
+        'gzip': 1.0, 'deflate': 1.0, 'br': 0.5, '*': 0.0}
+
+
+@pytest.mark.parametrize('header, coding', [
+    ('', None),
+    ('identity', None),
+    ('gzip, deflate', 'gzip'),
+    ('gzip;q=0, deflate', None),
+    ('*', CODINGS[0]),
+    ('gzip, br', CODINGS[0]),
+    ('gzip;q=1, br;q=0.1', 'gzip'),
+])
+def test_negotiate(header, coding):
+    assert Compressor().negotiate(header) == coding
+
+
+@pytest.mark.asyncio
+async def test_compression_middleware(test_client):
+    """Test that big responses are compressed and small ones are not."""
+    app = web.Application(middlewares=[compression_middleware])
+    app['compression'] = Compressor(min_size=100)
+    app.router.add_get('/big', lambda request: web.Response(body=b'x' * 1000))
+    app.router.add_get('/small', lambda request: web.Response(body=b'x' * 10))
+    client = await test_client(app, auto_decompress=False)
+
+    resp = await client.get('/big', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert resp.headers['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(await resp.read()) == b'x' * 1000
+
+    resp = await client.get('/big', headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in resp.headers
+    assert await resp.read() == b'x' * 1000
+
+    resp = await client.get('/small', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in resp.headers
@@ -7,8 +7,13 @@ so don't use the same docker host for test and dev containers.
 Test database is set up with some values, see examples.sql
 """
 
+import copy
+
 import pytest
 from db import *
+from db import _compose_history_query
+from drivers import convert_placeholders
+from pagination import InvalidCursor, encode_cursor
 
 
 @pytest.mark.asyncio
@@ -20,6 +25,34 @@ async def test_db_connection(app):
     assert app['db'].closed
 
 
+def test_convert_placeholders():
+    """Test that psycopg2 placeholders are converted to asyncpg ones."""
+    query = "SELECT * FROM comments WHERE creator = %s AND text LIKE '%%a' AND id = %s"
+    assert convert_placeholders(query) == (
+        "SELECT * FROM comments WHERE creator = $1 AND text LIKE '%a' AND id = $2"
+    )
+
+
+@pytest.mark.asyncio
+async def test_db_asyncpg_driver(app, init_a_few_db_entries):
+    """Test that db functions work the same through asyncpg driver."""
+    app['config'] = copy.deepcopy(app['config'])
+    app['config']['test']['postgres']['driver'] = 'asyncpg'
+    await init_pg(app, 'test')
+    try:
+        async with app['db'].acquire() as conn:
+            comments = await db_get_comments(conn, 'user1')
+            assert all(comment.creator == 'user1' for comment in comments)
+            await db_change_comment(conn, 'user1', comments[0].id, 'changed')
+            tree = await db_get_full_tree(conn, 'post', 1)
+            assert 'changed' in [row['text'] for row in tree]
+            with pytest.raises(RecordNotFound):
+                await db_get_comments(conn, 'user3')
+    finally:
+        await close_pg(app)
+    assert app['db'].closed
+
+
 @pytest.mark.asyncio
 async def test_db_get_comments(conn, init_a_few_db_entries):
     """Test that an existing comment is returned."""
@@ -34,6 +67,21 @@ async def test_db_get_comments_not_found(conn, init_a_few_db_entries):
         await db_get_comments(conn, 'user3')
 
 
+@pytest.mark.asyncio
+async def test_db_get_comments_paginated(conn, init_a_few_db_entries):
+    """Test that the feed is returned newest first page by page."""
+    for i in range(3):
+        await db_create_comment(conn, 'user1', 'feed {}'.format(i), 'post', 1)
+    first = await db_get_comments(conn, 'user1', limit=2)
+    assert [c.text for c in first] == ['feed 2', 'feed 1']
+    last = first[-1]
+    rest = await db_get_comments(
+        conn, 'user1', after=encode_cursor(last.date_created, last.id))
+    assert [c.text for c in rest] == [
+        'feed 0', 'dima commented some comment', 'new comment by dima'
+    ]
+
+
 @pytest.mark.asyncio
 async def test_db_create_comment(conn, init_a_few_db_entries):
     """Test that a comment is added for an existing user-entity pair."""
@@ -53,6 +101,45 @@ async def test_db_create_comment_parent_not_found(conn, init_a_few_db_entries):
         await db_create_comment(conn, 'user2', 'Fake parent entity', 'post', 3)
 
 
+@pytest.mark.asyncio
+async def test_db_create_comments_bulk(conn, init_a_few_db_entries):
+    """Test that a batch with parents of the same batch builds a correct tree."""
+    ids = await db_create_comments_bulk(conn, 'user3', [
+        {'text': 'bulk child', 'parent_ref': 'root'},
+        {'text': 'bulk root', 'entity_type': 'post', 'entity_id': 2, 'ref': 'root'},
+        {'text': 'bulk grandchild', 'parent_ref': 'child', 'ref': 'grandchild'},
+        {'text': 'bulk child 2', 'parent_ref': 'root', 'ref': 'child'},
+    ])
+    tree = await db_get_full_tree(conn, 'post', 2)
+    assert set(ids) <= {c.id for c in tree if c.type == 'comment'}
+    children = await db_get_child_comments(conn, ids[1])
+    assert sorted(c.text for c in children) == ['bulk child', 'bulk child 2', 'bulk grandchild']
+    history = await db_get_history(conn, 'user3', None, None, None)
+    assert len(history) == 4
+
+
+@pytest.mark.asyncio
+async def test_db_create_comments_bulk_cycle(conn, init_a_few_db_entries):
+    """Test that refs forming a cycle are rejected."""
+    with pytest.raises(ExecuteException):
+        await db_create_comments_bulk(conn, 'user3', [
+            {'text': 'first', 'parent_ref': 'second', 'ref': 'first'},
+            {'text': 'second', 'parent_ref': 'first', 'ref': 'second'},
+        ])
+
+
+@pytest.mark.asyncio
+async def test_db_create_comments_bulk_unknown_parent(conn, init_a_few_db_entries):
+    """Test that nothing is created if any parent is not found."""
+    with pytest.raises(ExecuteException):
+        await db_create_comments_bulk(conn, 'user3', [
+            {'text': 'bulk root', 'entity_type': 'post', 'entity_id': 2},
+            {'text': 'fake parent', 'entity_type': 'post', 'entity_id': 3},
+        ])
+    with pytest.raises(RecordNotFound):
+        await db_get_comments(conn, 'user3')
+
+
 @pytest.mark.asyncio
 async def test_db_get_1lvl_comments(conn, init_a_few_db_entries):
     """ Test that all first-level comments get returned."""
@@ -72,6 +159,29 @@ async def test_db_get_lvl1_comments_not_found(conn, init_a_few_db_entries):
         await db_get_1lvl_comments(conn, 'comment', 3)
 
 
+@pytest.mark.asyncio
+async def test_db_get_1lvl_comments_page(conn, init_a_few_db_entries):
+    """Test that cursors walk through all first-level comments in a stable order."""
+    for i in range(4):
+        await db_create_comment(conn, 'user1', 'lvl1 comment {}'.format(i), 'post', 1)
+    first = await db_get_1lvl_comments_page(conn, 'post', 1, limit=3)
+    second = await db_get_1lvl_comments_page(conn, 'post', 1, after=first.next_cursor, limit=3)
+    assert first.prev_cursor is None and second.next_cursor is None
+    assert [c.text for c in first.rows + second.rows] == [
+        'new comment by dima', 'lvl1 comment 0', 'lvl1 comment 1',
+        'lvl1 comment 2', 'lvl1 comment 3',
+    ]
+    back = await db_get_1lvl_comments_page(conn, 'post', 1, before=second.prev_cursor, limit=3)
+    assert [c.id for c in back.rows] == [c.id for c in first.rows]
+
+
+@pytest.mark.asyncio
+async def test_db_get_1lvl_comments_page_bad_cursor(conn, init_a_few_db_entries):
+    """Test that InvalidCursor is raised for a malformed cursor."""
+    with pytest.raises(InvalidCursor):
+        await db_get_1lvl_comments_page(conn, 'post', 1, after='garbage')
+
+
 @pytest.mark.asyncio
 async def test_db_change_comment(conn, init_a_few_db_entries):
     """Test that comment gets changed properly."""
@@ -109,10 +219,121 @@ async def test_db_delete_comment(conn, init_a_few_db_entries):
 
 
 @pytest.mark.asyncio
-async def test_db_delete_comment_has_children(conn, init_a_few_db_entries):
-    """ Test that ExecutionException is raised if comment has children."""
+@pytest.mark.parametrize('hierarchy', HIERARCHIES)
+async def test_db_delete_comment_subtree(conn, init_a_few_db_entries, hierarchy):
+    """Test that replies are deleted with the comment and logged to history."""
+    assert await db_delete_comment(conn, 'user1', 1, hierarchy) == 2
+    tree = await db_get_full_tree(conn, 'post', 1, hierarchy)
+    assert [(c.type, c.id) for c in tree] == [('post', 1)]
+    with pytest.raises(RecordNotFound):
+        await db_get_1lvl_comments_page(conn, 'post', 1)
+    result = await conn.execute(
+        "SELECT entity_id, \"user\" FROM history WHERE action = 'delete' ORDER BY entity_id")
+    assert [(r.entity_id, r.user) for r in await result.fetchall()] == [(1, 'user1'), (3, 'user1')]
+    # deleted comments can't be changed, deleted or answered
+    with pytest.raises(ExecuteException):
+        await db_change_comment(conn, 'user1', 3, 'changed')
     with pytest.raises(ExecuteException):
-        await db_delete_comment(conn, 'user1', 1)
+        await db_delete_comment(conn, 'user1', 1, hierarchy)
+    with pytest.raises(ExecuteException):
+        await db_create_comment(conn, 'user1', 'reply', 'comment', 3)
+
+
+@pytest.mark.asyncio
+async def test_db_delete_comment_not_creator(conn, init_a_few_db_entries):
+    """Test that only the creator deletes the comment."""
+    with pytest.raises(ExecuteException):
+        await db_delete_comment(conn, 'user2', 1)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('hierarchy', HIERARCHIES)
+async def test_db_restore_comment(conn, init_a_few_db_entries, hierarchy):
+    """Test that replies deleted together with the comment are restored."""
+    reply = (await db_create_comments_bulk(conn, 'user2', [
+        {'text': 'deleted before', 'entity_type': 'comment', 'entity_id': 3},
+    ]))[0]
+    await db_delete_comment(conn, 'user2', reply, hierarchy)
+    await db_delete_comment(conn, 'user1', 1, hierarchy)
+    # parent of the reply is deleted
+    with pytest.raises(ExecuteException):
+        await db_restore_comment(conn, 'user2', reply, hierarchy)
+    with pytest.raises(ExecuteException):
+        await db_restore_comment(conn, 'user1', 3, hierarchy)
+    assert await db_restore_comment(conn, 'user1', 1, hierarchy) == 2
+    tree = await db_get_full_tree(conn, 'post', 1, hierarchy)
+    assert sorted(c.id for c in tree if c.type == 'comment') == [1, 3]
+    result = await conn.execute("SELECT count(*) FROM history WHERE action = 'restore'")
+    assert await result.scalar() == 2
+    with pytest.raises(ExecuteException):
+        await db_restore_comment(conn, 'user1', 1, hierarchy)
+    assert await db_restore_comment(conn, 'user2', reply, hierarchy) == 1
+
+
+async def _reply_counts(conn):
+    result = await conn.execute(
+        'SELECT type, id, direct_reply_count, descendant_count FROM entities_metadata ORDER BY type, id')
+    return {(r.type, r.id): (r.direct_reply_count, r.descendant_count) for r in await result.fetchall()}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('hierarchy', HIERARCHIES)
+async def test_db_reply_counts(conn, init_a_few_db_entries, hierarchy):
+    """Test that ancestors count live replies and descendants."""
+    assert (await _reply_counts(conn))[('post', 1)] == (1, 2)
+    await db_create_comments_bulk(conn, 'user2', [
+        {'ref': 'a', 'text': 'a', 'entity_type': 'comment', 'entity_id': 3},
+        {'text': 'b', 'parent_ref': 'a'},
+        {'text': 'c', 'entity_type': 'comment', 'entity_id': 1},
+    ])
+    counts = await _reply_counts(conn)
+    assert counts[('post', 1)] == (1, 5)
+    assert counts[('comment', 1)] == (2, 4)
+    assert counts[('comment', 3)] == (1, 2)
+    assert counts[('comment', 5)] == (1, 1)
+    assert counts[('post', 2)] == (1, 2)
+    await db_delete_comment(conn, 'user1', 3, hierarchy)
+    counts = await _reply_counts(conn)
+    assert counts[('post', 1)] == (1, 2)
+    assert counts[('comment', 1)] == (1, 1)
+    assert counts[('comment', 3)] == (0, 0)
+    await db_restore_comment(conn, 'user1', 3, hierarchy)
+    counts = await _reply_counts(conn)
+    assert counts[('post', 1)] == (1, 5)
+    assert counts[('comment', 3)] == (1, 2)
+    rows = await db_get_1lvl_comments(conn, 'comment', 1)
+    assert [(r.id, r.direct_reply_count, r.descendant_count) for r in rows] == [(3, 1, 2), (7, 0, 0)]
+    tree = await db_get_full_tree(conn, 'post', 1, hierarchy)
+    counts = {(c.type, c.id): c.descendant_count for c in tree}
+    assert (counts[('post', 1)], counts[('comment', 1)]) == (5, 4)
+
+
+@pytest.mark.asyncio
+async def test_db_get_tree_version(conn, init_a_few_db_entries):
+    """Test that trees of changed comments and their ancestors are bumped once."""
+    versions = {}
+    for key in (('post', 1), ('comment', 1), ('comment', 3), ('post', 2)):
+        versions[key] = (await db_get_tree_version(conn, *key)).tree_version
+    await db_change_comment(conn, 'user1', 3, 'changed')
+    for key, bumped in ((('post', 1), 1), (('comment', 1), 1), (('comment', 3), 1), (('post', 2), 0)):
+        assert (await db_get_tree_version(conn, *key)).tree_version == versions[key] + bumped
+    await db_create_comments_bulk(conn, 'user2', [
+        {'text': 'a', 'entity_type': 'comment', 'entity_id': 3},
+        {'text': 'b', 'entity_type': 'comment', 'entity_id': 3},
+    ])
+    assert (await db_get_tree_version(conn, 'post', 1)).tree_version == versions[('post', 1)] + 2
+    with pytest.raises(RecordNotFound):
+        await db_get_tree_version(conn, 'post', 100)
+    with pytest.raises(ExecuteException):
+        await db_get_tree_version(conn, 'no_such_type', 1)
+
+
+@pytest.mark.asyncio
+async def test_db_reply_counts_not_logged(conn, init_a_few_db_entries):
+    """Test that counter updates of ancestors are not logged as their changes."""
+    await db_create_comment(conn, 'user2', 'reply', 'comment', 3)
+    result = await conn.execute("SELECT count(*) FROM history WHERE action != 'create'")
+    assert await result.scalar() == 0
 
 
 @pytest.mark.asyncio
@@ -157,6 +378,94 @@ async def test_db_get_full_tree_not_found(conn, init_a_few_db_entries):
         await db_get_full_tree(conn, 'comment', 5)
 
 
+@pytest.mark.asyncio
+async def test_db_get_tree_path_hierarchy(conn, init_a_few_db_entries):
+    """Test that materialized paths return the same trees as the closure table."""
+    ids = await db_create_comments_bulk(conn, 'user3', [
+        {'text': 'deep 1', 'entity_type': 'comment', 'entity_id': 3, 'ref': 1},
+        {'text': 'deep 2', 'parent_ref': 1},
+    ])
+    for root in (('post', 1), ('comment', 1), ('comment', ids[0])):
+        closure = await db_get_full_tree(conn, *root)
+        path = await db_get_full_tree(conn, *root, hierarchy='path')
+        assert sorted((c.type, c.id) for c in path) == sorted((c.type, c.id) for c in closure)
+    closure = await db_get_child_comments(conn, 1)
+    path = await db_get_child_comments(conn, 1, hierarchy='path')
+    assert [c.id for c in path] == [c.id for c in closure] == [3] + ids
+    with pytest.raises(RecordNotFound):
+        await db_get_child_comments(conn, ids[1], hierarchy='path')
+
+
+@pytest.mark.asyncio
+async def test_db_closure_disabled(conn, init_a_few_db_entries):
+    """Test that no closure rows are written in 'path' mode, paths still are."""
+    async with conn.begin():
+        await conn.execute("SELECT set_config('comments.hierarchy', 'path', true)")
+        await db_create_comment(conn, 'user3', 'no closure', 'comment', 3)
+    result = await conn.execute(
+        "SELECT count(*) FROM entities_closure_table WHERE descendant_id = 5")
+    assert await result.scalar() == 0
+    children = await db_get_child_comments(conn, 1, hierarchy='path')
+    assert [c.text for c in children][-1] == 'no closure'
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('hierarchy', HIERARCHIES)
+async def test_db_get_tree_max_depth(conn, init_a_few_db_entries, hierarchy):
+    """Test that comments deeper than the max depth aren't read."""
+    ids = await db_create_comments_bulk(conn, 'user3', [
+        {'text': 'deep 1', 'entity_type': 'comment', 'entity_id': 3, 'ref': 1},
+        {'text': 'deep 2', 'parent_ref': 1},
+    ])
+    tree = await db_get_full_tree(conn, 'post', 1, hierarchy, max_depth=2)
+    assert sorted((c.type, c.id) for c in tree) == [('comment', 1), ('comment', 3), ('post', 1)]
+    tree = await db_get_full_tree(conn, 'comment', 3, hierarchy, max_depth=1)
+    assert [c.id for c in tree] == [3, ids[0]]
+    children = await db_get_child_comments(conn, 1, hierarchy, max_depth=1)
+    assert [c.id for c in children] == [3, ids[0]]
+    children = await db_get_child_comments(conn, 1, hierarchy, max_depth=None)
+    assert [c.id for c in children] == [3] + ids
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('sort, order', [
+    ('oldest', ['a', 'b', 'c']),
+    ('newest', ['c', 'b', 'a']),
+    ('top', ['b', 'a', 'c']),
+])
+async def test_db_get_tree_window(conn, init_a_few_db_entries, sort, order):
+    """Test that a window has the first children of every shown comment only."""
+    await db_create_comments_bulk(conn, 'user3', [
+        {'ref': 'a', 'text': 'a', 'entity_type': 'post', 'entity_id': 2},
+        {'ref': 'b', 'text': 'b', 'entity_type': 'post', 'entity_id': 2},
+        {'ref': 'c', 'text': 'c', 'entity_type': 'post', 'entity_id': 2},
+        {'ref': 'a1', 'text': 'a1', 'parent_ref': 'a'},
+        {'ref': 'b1', 'text': 'b1', 'parent_ref': 'b'},
+        {'ref': 'b2', 'text': 'b2', 'parent_ref': 'b'},
+        {'text': 'b11', 'parent_ref': 'b1'},
+    ])
+    # comment 2 of examples goes first or last, it has a reply as well
+    rows = await db_get_tree_window(conn, 'post', 2, max_depth=2, max_children=2, sort=sort)
+    first_level = [r.text for r in rows if r.depth == 1]
+    assert [r.rank for r in rows if r.depth == 1] == [1, 2, 3]
+    assert all(r.depth <= 2 for r in rows)
+    assert 'b11' not in [r.text for r in rows]
+    last = [r for r in rows if r.depth == 1][1]
+    # as the next window is requested, by a cursor
+    keys = [last[key] for key in WINDOW_SORTS[sort][2]]
+    rest = await db_get_tree_window(conn, 'post', 2, max_depth=1, max_children=10, sort=sort,
+                                    after=decode_cursor(encode_cursor(*keys), 2))
+    texts = first_level[:2] + [r.text for r in rest]
+    assert [text for text in texts if text in order] == order
+    assert len(texts) == 4
+
+
+@pytest.mark.asyncio
+async def test_db_get_tree_window_invalid(conn, init_a_few_db_entries):
+    with pytest.raises(ExecuteException):
+        await db_get_tree_window(conn, 'nothing', 1)
+
+
 @pytest.mark.asyncio
 async def test_db_get_history(conn, init_a_few_db_entries):
     """Test that history gets returned correctly."""
@@ -175,6 +484,56 @@ async def test_db_get_history_not_found(conn, init_a_few_db_entries):
         await db_get_history(conn, 'user1', None, None, 2)
 
 
+@pytest.mark.asyncio
+async def test_db_stream_history(conn, init_a_few_db_entries):
+    """Test that history is streamed in batches of the given size."""
+    batches = [
+        [r.text for r in batch]
+        async for batch in db_stream_history(conn, 'user1', None, None, None, batch_size=1)
+    ]
+    assert sorted(batches) == [
+        ['dima commented some comment'], ['new comment by dima']
+    ]
+
+
+@pytest.mark.asyncio
+async def test_db_stream_history_not_found(conn, init_a_few_db_entries):
+    """Test that RecordNotFound is raised when no history were found."""
+    with pytest.raises(RecordNotFound):
+        async for _ in db_stream_history(conn, 'user1', None, None, 2):
+            pass
+
+
+@pytest.mark.asyncio
+async def test_db_get_history_date_range(conn, init_a_few_db_entries):
+    """Test that the end date is inclusive and only its partitions are scanned."""
+    today = (await (await conn.execute('SELECT CURRENT_DATE')).scalar()).isoformat()
+    results = await db_get_history(conn, 'user1', today, today, None)
+    assert len(results) == 2
+    query, sql_values = _compose_history_query('user1', today, today, None)
+    result = await conn.execute('EXPLAIN ' + query, sql_values)
+    plan = '\n'.join(row[0] for row in await result.fetchall())
+    assert 'history_default' not in plan
+    with pytest.raises(RecordNotFound):
+        await db_get_history(conn, 'user1', '2000-01-01', '2000-01-31', None)
+
+
+@pytest.mark.asyncio
+async def test_db_create_history_partitions(conn, init_a_few_db_entries):
+    """Test that partitions are created ahead and take rows from the default one."""
+    assert await db_create_history_partitions(conn, 3) == 0
+    await conn.execute(
+        """
+        INSERT INTO history (entity_id, "user", action, date)
+        VALUES (1, 'user1', 'update', date_trunc('month', CURRENT_DATE) + interval '4 month')
+        """
+    )
+    assert await db_create_history_partitions(conn, 4) == 1
+    result = await conn.execute(
+        "SELECT tableoid::regclass::text FROM history WHERE action = 'update'")
+    assert (await result.scalar()).startswith('history_20')
+
+
 @pytest.mark.asyncio
 async def test_db_get_search_history(conn, init_a_few_db_entries):
     """
@@ -196,3 +555,48 @@ async def test_db_get_search_history_not_found(conn, init_a_few_db_entries):
     """
     with pytest.raises(RecordNotFound):
         await db_get_search_history(conn, 'user1')
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('hierarchy', HIERARCHIES)
+async def test_db_search_comments(conn, init_a_few_db_entries, hierarchy):
+    """Test that matches are found by stems, ranked and limited to a subtree."""
+    await db_create_comment(conn, 'user2', 'dima dima dima', 'comment', 3)
+    comments = await db_search_comments(conn, 'Dima', hierarchy=hierarchy)
+    assert [c.id for c in comments] == [5, 3, 1]
+    assert comments[0].rank > comments[1].rank
+    assert '<b>dima</b>' in comments[0].headline
+    comments = await db_search_comments(conn, 'comments -yana', hierarchy=hierarchy)
+    assert sorted(c.id for c in comments) == [1, 3]
+    comments = await db_search_comments(conn, 'dima', 'comment', 3, hierarchy=hierarchy)
+    assert [c.id for c in comments] == [5, 3]
+    with pytest.raises(RecordNotFound):
+        await db_search_comments(conn, 'dima', 'post', 2, hierarchy=hierarchy)
+
+
+@pytest.mark.asyncio
+async def test_db_search_comments_pages(conn, init_a_few_db_entries):
+    """Test that cursors walk through equally ranked matches."""
+    texts = ['same words {}'.format(i) for i in range(5)]
+    for text in texts:
+        await db_create_comment(conn, 'user1', text, 'post', 1)
+    seen = []
+    after = None
+    while True:
+        page = await db_search_comments(conn, 'same words', after=after, limit=2)
+        seen.extend(c.id for c in page)
+        if len(page) < 2:
+            break
+        after = encode_cursor(page[-1].rank, page[-1].id)
+    assert seen == [9, 8, 7, 6, 5]
+
+
+@pytest.mark.asyncio
+async def test_db_search_comments_changes(conn, init_a_few_db_entries):
+    """Test that changed and deleted comments are searched as they're now."""
+    await db_change_comment(conn, 'user1', 3, 'changed text')
+    comments = await db_search_comments(conn, 'changed')
+    assert [c.id for c in comments] == [3]
+    await db_delete_comment(conn, 'user1', 3)
+    with pytest.raises(RecordNotFound):
+        await db_search_comments(conn, 'changed')
@@ -0,0 +1,86 @@
+"""Test module for the app factory and its pre-forked workers."""
+
+import asyncio
+
+import pytest
+from aiohttp import web
+from launcher import InflightRequests, default_workers, drain, drain_middleware, init_drain, split_pools
+from main import create_app
+from settings import config
+
+
+def test_create_app():
+    """Test that apps are created without a loop and maintenance is optional."""
+    app = create_app('test')
+    assert app['config'] is config
+    assert app.router['lvl1']
+    assert len(create_app('test', maintenance=False).on_cleanup) == len(app.on_cleanup) - 1
+
+
+@pytest.mark.parametrize('workers, minsize, maxsize', [
+    (1, 2, 10),
+    (3, 1, 3),
+    (4, 1, 2),
+    (20, 1, 1),
+])
+def test_split_pools(workers, minsize, maxsize):
+    """Test that workers open no more connections than configured, one at least."""
+    settings = {'test': {'postgres': {
+        'minsize': 2, 'maxsize': 10,
+        'replicas': [{'port': 5435}, {'port': 5436, 'minsize': 2, 'maxsize': 10}],
+    }}}
+    split = split_pools(settings, 'test', workers)['test']['postgres']
+    assert (split['minsize'], split['maxsize']) == (minsize, maxsize)
+    assert split['replicas'] == [{'port': 5435}, {'port': 5436, 'minsize': minsize, 'maxsize': maxsize}]
+    assert settings['test']['postgres']['maxsize'] == 10
+
+
+@pytest.mark.parametrize('cores, maxsize, workers', [
+    (8, 5, 2),
+    (8, 1, 1),
+    (2, 20, 2),
+])
+def test_default_workers(monkeypatch, cores, maxsize, workers):
+    """Test that workers are as many as cores, but get two connections each."""
+    monkeypatch.setattr('os.cpu_count', lambda: cores)
+    assert default_workers({'test': {'postgres': {'maxsize': maxsize}}}, 'test') == workers
+
+
+@pytest.mark.asyncio
+async def test_inflight_requests_timeout():
+    inflight = InflightRequests()
+    assert await inflight.wait(0)
+    with inflight:
+        assert not await inflight.wait(0.01)
+    assert await inflight.wait(0)
+
+
+@pytest.mark.asyncio
+async def test_drain(test_client):
+    """Test that requests in flight are answered before the app is cleaned up."""
+    events = []
+    started = asyncio.Event()
+
+    async def slow(request):
+        started.set()
+        await asyncio.sleep(0.1)
+        events.append('answered')
+        return web.Response(text='ok')
+
+    async def close_pg(app):
+        events.append('closed')
+
+    app = web.Application(middlewares=[drain_middleware])
+    app['config'] = config
+    app.router.add_get('/slow', slow)
+    app.on_startup.append(lambda app: init_drain(app, 'test'))
+    app.on_shutdown.append(drain)
+    app.on_cleanup.append(close_pg)
+    client = await test_client(app)
+
+    request = asyncio.ensure_future(client.get('/slow'))
+    await started.wait()
+    await client.server.close()
+    assert (await request).status == 200
+    assert events == ['answered', 'closed']
+    await client.close()
@@ -0,0 +1,135 @@
+"""Test module for live subscriptions to trees."""
+
+import asyncio
+import json
+
+import pytest
+from db import db_change_comment, db_create_comment, db_create_comments_bulk
+from live import RESET, LiveHub, TooManySubscribers, format_event
+from notify import NotificationListener, changed_roots, compose_dsn
+from settings import config
+
+
+def _row(comment_id, path, root=('post', 1), text='text'):
+    return {
+        'type': 'comment', 'id': comment_id, 'creator': 'user1',
+        'date_created': None, 'date_last_modified': None, 'text': text,
+        'parent_type': 'comment' if len(path) > 1 else root[0],
+        'parent_id': path[-2] if len(path) > 1 else root[1],
+        'direct_reply_count': 0, 'descendant_count': 0, 'deleted_at': None,
+        'root_type': root[0], 'root_id': root[1], 'path': path,
+    }
+
+
+def _queued(subscription):
+    events = []
+    while not subscription._queue.empty():
+        events.append(subscription._queue.get_nowait())
+    return events
+
+
+def _comments(event):
+    assert event.startswith(b'event: comments\ndata: ')
+    return [row['id'] for row in json.loads(event.split(b'data: ', 1)[1].decode())]
+
+
+def test_live_hub_fan_out():
+    """Test that subscribers get changed comments of their subtrees only."""
+    hub = LiveHub(pool=None)
+    post, comment, other = (hub.subscribe(root) for root in (('post', 1), ('comment', 1), ('comment', 2)))
+    hub._fan_out([_row(3, [1, 3]), _row(1, [1], text='changed'), _row(4, [4])])
+    assert [_comments(event) for event in _queued(post)] == [[3, 1, 4]]
+    assert [_comments(event) for event in _queued(comment)] == [[3, 1]]
+    assert _queued(other) == []
+
+
+def test_live_hub_delete():
+    """Test that IDs of purged comments are sent to subscribers of their ancestors."""
+    hub = LiveHub(pool=None)
+    post, other = hub.subscribe(('post', 1)), hub.subscribe(('post', 2))
+    hub.on_notify({'op': 'delete', 'roots': [['post', 1], ['comment', 3]], 'ids': [3]})
+    assert _queued(post) == [format_event('delete', b'{"ids":[3]}')]
+    assert _queued(other) == []
+
+
+def test_live_hub_slow_subscriber():
+    """Test that a subscriber which doesn't keep up is reset and dropped."""
+    hub = LiveHub(pool=None, queue_size=2)
+    slow = hub.subscribe(('post', 1))
+    for _ in range(3):
+        hub._fan_out([_row(3, [1, 3])])
+    assert _queued(slow) == [RESET, None]
+    assert (hub.subscribers, hub.dropped) == (0, 1)
+
+
+def test_live_hub_reset():
+    """Test that subscribers are reset when notifications may be lost."""
+    hub = LiveHub(pool=None)
+    subscription = hub.subscribe(('post', 1))
+    hub.on_notify({'op': 'insert', 'truncated': True})
+    assert _queued(subscription) == [RESET, None]
+    subscription = hub.subscribe(('post', 1))
+    hub.on_listener_reset(False)
+    assert _queued(subscription) == [RESET, None]
+    assert hub.subscribers == 0
+
+
+def test_live_hub_max_subscribers():
+    hub = LiveHub(pool=None, max_subscribers=1)
+    subscription = hub.subscribe(('post', 1))
+    with pytest.raises(TooManySubscribers):
+        hub.subscribe(('post', 1))
+    hub.unsubscribe(subscription)
+    hub.subscribe(('post', 1))
+
+
+@pytest.mark.asyncio
+async def test_live_hub_notified(comments_app, conn, init_a_few_db_entries):
+    """Test that changes committed to the DB are pushed to subscribers."""
+    listener = NotificationListener(compose_dsn(config['test']['postgres']))
+    hub = LiveHub(comments_app['db'], heartbeat=5)
+    listener.add_handler(hub.on_notify, hub.on_listener_reset)
+    listener.start()
+    hub.start()
+    try:
+        while not listener.connected:
+            await asyncio.sleep(0.01)
+        subscription = hub.subscribe(('comment', 1))
+        other = hub.subscribe(('post', 2))
+        await db_create_comment(conn, 'user2', 'live reply', 'comment', 1)
+        await db_change_comment(conn, 'user1', 1, 'changed live')
+        events = subscription.events(heartbeat=5)
+        texts = {}
+        while texts.get(1) != 'changed live':
+            event = await asyncio.wait_for(events.__anext__(), 5)
+            texts.update((row['id'], row['text']) for row in json.loads(event.split(b'data: ', 1)[1].decode()))
+        assert 'live reply' in texts.values()
+        assert _queued(other) == []
+    finally:
+        await hub.close()
+        await listener.stop()
+
+
+@pytest.mark.asyncio
+async def test_notification_payload(conn, init_a_few_db_entries):
+    """Test that changed comments aren't sent twice, so big statements fit."""
+    listener = NotificationListener(compose_dsn(config['test']['postgres']))
+    messages = []
+    listener.add_handler(messages.append)
+    listener.start()
+    try:
+        while not listener.connected:
+            await asyncio.sleep(0.01)
+        ids = await db_create_comments_bulk(conn, 'user1', [
+            {'text': 'reply {}'.format(i), 'entity_type': 'comment', 'entity_id': 3} for i in range(800)
+        ])
+        while not messages:
+            await asyncio.sleep(0.01)
+    finally:
+        await listener.stop()
+    message = messages[0]
+    assert not message.get('truncated')
+    assert message['ids'] == ids
+    assert sorted(map(tuple, message['roots'])) == [('comment', 1), ('comment', 3), ('post', 1)]
+    assert set(changed_roots(message)) == {
+        ('post', 1), ('comment', 1), ('comment', 3)} | {('comment', i) for i in ids}
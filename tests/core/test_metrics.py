@@ -0,0 +1,58 @@
+"""Test module for metrics."""
+
+import pytest
+from metrics import Histogram, observe_db, render
+
+
+def test_histogram_render():
+    """Test that buckets are cumulative and sum/count are rendered."""
+    histogram = Histogram('test_seconds', 'Test.', ('function',), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, 'f')
+    assert histogram.render() == [
+        '# HELP test_seconds Test.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{function="f",le="0.1"} 1',
+        'test_seconds_bucket{function="f",le="1"} 2',
+        'test_seconds_bucket{function="f",le="+Inf"} 3',
+        'test_seconds_sum{function="f"} 5.55',
+        'test_seconds_count{function="f"} 3',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_observe_db():
+    """Test that calls, rows and errors of db functions are recorded."""
+    @observe_db
+    async def db_test_rows(rows):
+        if rows is None:
+            raise ValueError
+        return rows
+
+    await db_test_rows([1, 2])
+    with pytest.raises(ValueError):
+        await db_test_rows(None)
+    text = render()
+    assert 'db_query_duration_seconds_count{function="db_test_rows"} 2' in text
+    assert 'db_query_rows_sum{function="db_test_rows"} 2' in text
+    assert 'db_query_errors_total{function="db_test_rows",exception="ValueError"} 1' in text
+
+
+@pytest.mark.asyncio
+async def test_observe_db_generator_closed():
+    """Test that closing an observed generator closes the wrapped one."""
+    closed = []
+
+    @observe_db
+    async def db_test_batches():
+        try:
+            for i in range(3):
+                yield [i, i]
+        finally:
+            closed.append(True)
+
+    batches = db_test_batches()
+    assert await batches.__anext__() == [0, 0]
+    await batches.aclose()
+    assert closed == [True]
+    assert 'db_query_rows_sum{function="db_test_batches"} 2' in render()
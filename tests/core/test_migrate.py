@@ -0,0 +1,46 @@
+"""Test module for schema migrations."""
+
+import pytest
+from dbtools.migrate import MigrationError, load_migrations, migrate, split_statements
+
+
+def test_split_statements():
+    """Test that statements are split at line ends only, comments are skipped."""
+    sql = (
+        '-- migrate: no-transaction\n'
+        '-- a comment;\n'
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS a_idx\n'
+        "  ON a (b) WHERE c != ';';\n"
+        '\n'
+        'DROP INDEX CONCURRENTLY IF EXISTS d_idx;\n'
+    )
+    assert split_statements(sql) == [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS a_idx\n  ON a (b) WHERE c != ';'",
+        'DROP INDEX CONCURRENTLY IF EXISTS d_idx',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_migrate(conn, init_a_few_db_entries, tmpdir):
+    """Test that migrations are applied once, in order and up to the target."""
+    assert await migrate(conn) == []
+
+    tmpdir.join('1000_nickname.sql').write(
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS nickname varchar;\n')
+    tmpdir.join('1001_nickname_idx.sql').write(
+        '-- migrate: no-transaction\n'
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS users_nickname_idx ON users (nickname);\n')
+    tmpdir.join('README').write('not a migration')
+    migrations = load_migrations(str(tmpdir))
+    assert [(m.version, m.transactional) for m in migrations] == [(1000, True), (1001, False)]
+
+    assert await migrate(conn, migrations, target=1000) == [1000]
+    assert await migrate(conn, migrations) == [1001]
+    assert await migrate(conn, migrations) == []
+    result = await conn.execute(
+        "SELECT indisvalid FROM pg_index WHERE indexrelid = 'users_nickname_idx'::regclass")
+    assert await result.scalar()
+
+    tmpdir.join('1000_nickname.sql').write('SELECT 1;\n')
+    with pytest.raises(MigrationError):
+        await migrate(conn, load_migrations(str(tmpdir)))
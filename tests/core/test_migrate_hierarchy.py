@@ -0,0 +1,49 @@
+"""Test module for the migration to the materialized path hierarchy."""
+
+import pytest
+from dbtools.migrate_hierarchy import UPDATE_TRIGGERS, migrate
+from settings import config
+
+
+async def _paths(conn, table, column, post_id):
+    result = await conn.execute(
+        'SELECT id, root_type, root_id, path FROM {} WHERE {} = %s ORDER BY id'.format(table, column),
+        (post_id,))
+    return [row.as_tuple() for row in await result.fetchall()]
+
+
+async def _scalar(conn, query, *params):
+    return await (await conn.execute(query, *params)).scalar()
+
+
+@pytest.mark.asyncio
+async def test_migrate_hierarchy(conn, init_generated_trees):
+    """Test that paths are filled from the closure table as triggers write them."""
+    post_id, _ = init_generated_trees
+    post_paths = await _paths(conn, 'posts', 'id', post_id)
+    comment_paths = await _paths(conn, 'comments', 'root_id', post_id)
+    assert len(comment_paths) > 1000
+    history = await _scalar(conn, 'SELECT count(*) FROM history')
+
+    async with conn.begin():
+        for table in ('posts', 'comments'):
+            await conn.execute('ALTER TABLE {} DISABLE TRIGGER USER'.format(table))
+        await conn.execute(
+            'UPDATE posts SET root_type = NULL, root_id = NULL, path = NULL WHERE id = %s', (post_id,))
+        await conn.execute(
+            'UPDATE comments SET root_type = NULL, root_id = NULL, path = NULL WHERE root_id = %s',
+            (post_id,))
+        for table in ('posts', 'comments'):
+            await conn.execute('ALTER TABLE {} ENABLE TRIGGER USER'.format(table))
+    assert await _scalar(conn, 'SELECT count(*) FROM comments WHERE path IS NULL') == len(comment_paths)
+
+    await migrate(config['test']['postgres'])
+
+    assert await _paths(conn, 'posts', 'id', post_id) == post_paths
+    assert await _paths(conn, 'comments', 'root_id', post_id) == comment_paths
+    result = await conn.execute(
+        'SELECT tgname, tgenabled FROM pg_trigger WHERE tgrelid = %s::regclass AND tgname = ANY(%s::text[])',
+        ('comments', list(UPDATE_TRIGGERS)))
+    assert sorted(row.as_tuple() for row in await result.fetchall()) == [
+        (name, 'O') for name in sorted(UPDATE_TRIGGERS)]
+    assert await _scalar(conn, 'SELECT count(*) FROM history') == history
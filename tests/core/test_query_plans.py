@@ -0,0 +1,132 @@
+"""
+Query plan regression tests.
+
+Every `db_*` function is run over generated trees through a connection
+which EXPLAINs its statements, a sequential scan of a big table fails
+the test. Test tables are small, so the planner would scan them anyway:
+sequential scans are disabled for the session, then one is left in a plan
+only when no index can answer the query. Seq scans by triggers don't get
+to EXPLAIN, they're counted by `pg_stat_xact_user_tables` instead, which
+keeps counts of the backend not reported yet, so they're compared.
+Every call is rolled back, so the trees stay the same.
+"""
+
+from datetime import datetime
+
+import pytest
+from db import *
+
+
+# tables which grow with comments, the rest are small or empty
+# inheritance parents(`entities_metadata`)
+BIG_TABLES = {'comments', 'posts', 'entities', 'entities_closure_table', 'search_history'}
+
+
+def _is_big(table):
+    # history is partitioned by month, see 2_create_tables.sql
+    return table in BIG_TABLES or table == 'history' or table.startswith('history_')
+
+
+class ExplainingConnection:
+    """Connection which EXPLAINs every statement before running it."""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self.plans = []
+
+    async def execute(self, query, *args):
+        if not query.lstrip().upper().startswith('FETCH'):
+            result = await self._conn.execute('EXPLAIN (FORMAT JSON) ' + query, *args)
+            plan = await result.scalar()
+            self.plans.append((query, plan[0]['Plan']))
+        return await self._conn.execute(query, *args)
+
+    def begin(self):
+        return self._conn.begin()
+
+
+def seq_scans(plan):
+    """Yield tables scanned sequentially by the plan and its subplans."""
+    if plan['Node Type'] == 'Seq Scan':
+        yield plan['Relation Name']
+    for subplan in plan.get('Plans', ()):
+        yield from seq_scans(subplan)
+
+
+async def _executed_seq_scans(conn):
+    result = await conn.execute(
+        'SELECT relname, seq_scan FROM pg_stat_xact_user_tables WHERE seq_scan > 0')
+    return {row.relname: row.seq_scan for row in await result.fetchall()}
+
+
+async def _delete_and_restore(conn, comment_id, hierarchy):
+    await db_delete_comment(conn, 'user2', comment_id, hierarchy)
+    await db_restore_comment(conn, 'user2', comment_id, hierarchy)
+
+
+async def _stream_history(conn, *args):
+    async for _ in db_stream_history(conn, *args):
+        pass
+
+
+def _calls(post_id, comment_id, hierarchy):
+    """Calls of every `db_*` function, with both hierarchies where they differ."""
+    return {
+        'get_comments': lambda c: db_get_comments(c, 'user2', limit=10),
+        'get_comments_after': lambda c: db_get_comments(
+            c, 'user2', after=encode_cursor('2000-01-01T00:00:00+00:00', 1),
+            start_date='1999-01-01', end_date='2100-01-01'),
+        'create_comment': lambda c: db_create_comment(c, 'user1', 'new', 'comment', comment_id),
+        'create_comments_bulk': lambda c: db_create_comments_bulk(c, 'user1', [
+            {'ref': 0, 'text': 'a', 'entity_type': 'comment', 'entity_id': comment_id},
+            {'ref': 1, 'text': 'b', 'parent_ref': 0},
+        ]),
+        'get_1lvl_comments': lambda c: db_get_1lvl_comments(c, 'post', post_id),
+        'get_1lvl_comments_page': lambda c: db_get_1lvl_comments_page(
+            c, 'comment', comment_id, after=encode_cursor('2000-01-01T00:00:00+00:00', 1)),
+        'change_comment': lambda c: db_change_comment(c, 'user2', comment_id, 'changed'),
+        'delete_and_restore_comment': lambda c: _delete_and_restore(c, comment_id, hierarchy),
+        'get_child_comments': lambda c: db_get_child_comments(c, comment_id, hierarchy, max_depth=2),
+        'get_full_tree_post': lambda c: db_get_full_tree(c, 'post', post_id, hierarchy, max_depth=3),
+        'get_full_tree_comment': lambda c: db_get_full_tree(c, 'comment', comment_id, hierarchy),
+        'get_tree_window': lambda c: db_get_tree_window(c, 'post', post_id, sort='top'),
+        'get_comments_by_ids': lambda c: db_get_comments_by_ids(c, [comment_id]),
+        'get_tree_version': lambda c: db_get_tree_version(c, 'comment', comment_id),
+        'search_comments': lambda c: db_search_comments(c, 'benchmark', 'post', post_id,
+                                                        hierarchy=hierarchy),
+        'save_searches': lambda c: db_save_searches(c, [('user1', None, None, datetime.now(), None)]),
+        'get_history': lambda c: db_get_history(c, 'user2', '2000-01-01', '2100-01-01', comment_id),
+        'stream_history': lambda c: _stream_history(c, 'user2', '2000-01-01', None, None),
+        'get_search_history': lambda c: db_get_search_history(c, 'user1'),
+    }
+
+
+CALLS = sorted(_calls(None, None, 'closure'))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('hierarchy', ['closure', 'path'])
+@pytest.mark.parametrize('name', CALLS)
+async def test_no_seq_scans(conn, init_generated_trees, name, hierarchy):
+    """Test that queries of the db functions are answered by indexes."""
+    post_id, parent_ids = init_generated_trees
+    call = _calls(post_id, parent_ids[len(parent_ids) // 2], hierarchy)[name]
+    explaining = ExplainingConnection(conn)
+    tr = await conn.begin()
+    try:
+        await conn.execute('SET LOCAL enable_seqscan = off')
+        scans_before = await _executed_seq_scans(conn)
+        try:
+            await call(explaining)
+        except RecordNotFound:
+            pass
+        executed_scans = await _executed_seq_scans(conn)
+    finally:
+        await tr.rollback()
+
+    assert explaining.plans
+    for query, plan in explaining.plans:
+        scanned = [table for table in seq_scans(plan) if _is_big(table)]
+        assert not scanned, 'Seq Scan of {} by\n{}'.format(scanned, query)
+    assert not [table for table, scans in executed_scans.items()
+                if _is_big(table) and scans > scans_before.get(table, 0)]
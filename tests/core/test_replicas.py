@@ -0,0 +1,74 @@
+"""Test module for routing of reads to replicas."""
+
+from collections import namedtuple
+
+import pytest
+from replicas import ReplicaRouter
+
+
+Pool = namedtuple('Pool', ('name', 'size', 'freesize'))
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def _router(balancing='round_robin', **kwargs):
+    replicas = [Pool('replica1', 5, 5), Pool('replica2', 5, 5)]
+    return ReplicaRouter(Pool('primary', 5, 5), replicas, balancing=balancing, **kwargs)
+
+
+def test_router_no_replicas():
+    """Test that everything is read from the primary without replicas."""
+    router = ReplicaRouter(Pool('primary', 5, 5))
+    assert router.read_pool(('user', 'user1')).name == 'primary'
+
+
+def test_router_round_robin():
+    """Test that reads are spread over replicas in turn."""
+    router = _router()
+    names = [router.read_pool(('user', 'user1')).name for _ in range(4)]
+    assert names == ['replica2', 'replica1', 'replica2', 'replica1']
+
+
+def test_router_least_busy():
+    """Test that reads go to the replica with the least connections in use."""
+    router = ReplicaRouter(
+        Pool('primary', 5, 5), [Pool('replica1', 5, 1), Pool('replica2', 5, 4)],
+        balancing='least_busy')
+    assert {router.read_pool().name for _ in range(4)} == {'replica2'}
+
+
+def test_router_unknown_balancing():
+    """Test that an unknown balancing is rejected."""
+    with pytest.raises(RuntimeError):
+        _router(balancing='random')
+
+
+def test_router_sticky_after_write():
+    """Test that a user reads from the primary within the window after a write."""
+    clock = Clock()
+    router = _router(sticky_window=5, clock=clock)
+    router.mark_write(('user', 'user1'))
+    assert router.read_pool(('user', 'user1')).name == 'primary'
+    assert router.read_pool(('user', 'user2')).name != 'primary'
+    clock.now = 6
+    assert router.read_pool(('user', 'user1')).name != 'primary'
+    router.mark_write(('user', 'user2'))
+    assert list(router._sticky) == [('user', 'user2')]
+
+
+def test_router_sticky_changed_trees():
+    """Test that changed trees are read from the primary."""
+    clock = Clock()
+    router = _router(clock=clock)
+    router.on_notify({'op': 'insert', 'roots': [['post', 1], ['comment', 3]]})
+    assert router.read_pool(('user', 'user2'), ('comment', 3)).name == 'primary'
+    assert router.read_pool(('user', 'user2'), ('post', 2)).name != 'primary'
+    router.on_notify({'op': 'insert', 'truncated': True})
+    assert router.read_pool(('user', 'user2'), ('post', 2)).name == 'primary'
@@ -0,0 +1,44 @@
+"""Test module for write-behind of history searches."""
+
+import asyncio
+
+import pytest
+from db import *
+from search_history import SearchHistoryWriter
+
+
+@pytest.mark.asyncio
+async def test_search_history_buffered(comments_app, conn, init_a_few_db_entries):
+    """Test that searches are saved on flush only, by a single batch."""
+    writer = SearchHistoryWriter(comments_app['db'], flush_interval=60)
+    await db_get_history(conn, 'user1', None, '2100-01-01', 3, search_history=writer)
+    await db_get_history(conn, 'user1', '2000-01-01', None, None, search_history=writer)
+    with pytest.raises(RecordNotFound):
+        await db_get_search_history(conn, 'user1')
+    assert await writer.flush() == 2
+    searches = await db_get_search_history(conn, 'user1')
+    assert sorted(s.root_entity_id or 0 for s in searches) == [0, 3]
+
+
+@pytest.mark.asyncio
+async def test_search_history_max_batch(comments_app, conn, init_a_few_db_entries):
+    """Test that a full batch is flushed right away and the rest on close."""
+    writer = SearchHistoryWriter(comments_app['db'], max_batch=2, flush_interval=60)
+    writer.start()
+    for _ in range(2):
+        writer.add('user1', None, None, None)
+    await asyncio.sleep(0.1)
+    assert writer.written == 2
+    writer.add('user1', None, None, None)
+    await writer.close()
+    assert len(await db_get_search_history(conn, 'user1')) == 3
+
+
+@pytest.mark.asyncio
+async def test_search_history_flush_failed(comments_app, conn, init_a_few_db_entries):
+    """Test that searches of a failed flush are dropped and counted."""
+    writer = SearchHistoryWriter(comments_app['db'])
+    writer.add('user1', 'not a date', None, None)
+    assert await writer.flush() == 0
+    assert writer.dropped == 1
+    assert await writer.flush() == 0
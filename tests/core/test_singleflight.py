@@ -0,0 +1,66 @@
+"""Test module for coalescing of identical concurrent calls."""
+
+import asyncio
+
+import pytest
+from metrics import render
+from singleflight import SingleFlight
+
+
+def _call(calls, result=None, error=None):
+    async def call():
+        calls.append(result)
+        await asyncio.sleep(0.01)
+        if error is not None:
+            raise error
+        return result
+    return call
+
+
+@pytest.mark.asyncio
+async def test_single_flight_shared():
+    """Test that concurrent calls with the same key run once."""
+    flight = SingleFlight('test_shared')
+    calls = []
+    results = await asyncio.gather(
+        flight.do('a', _call(calls, 1)), flight.do('a', _call(calls, 2)), flight.do('b', _call(calls, 3)))
+    assert results == [1, 1, 3]
+    assert calls == [1, 3]
+    assert len(flight) == 0
+    assert await flight.do('a', _call(calls, 4)) == 4
+    text = render()
+    assert 'single_flight_calls_total{flight="test_shared"} 3' in text
+    assert 'single_flight_coalesced_total{flight="test_shared"} 1' in text
+
+
+@pytest.mark.asyncio
+async def test_single_flight_error_shared():
+    flight = SingleFlight('test_error')
+    calls = []
+    results = await asyncio.gather(
+        flight.do('a', _call(calls, error=ValueError())), flight.do('a', _call(calls)),
+        return_exceptions=True)
+    assert [type(result) for result in results] == [ValueError, ValueError]
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_single_flight_cancelled():
+    """Test that a cancelled caller leaves the call to the others, the last one cancels it."""
+    flight = SingleFlight('test_cancelled')
+    calls = []
+    first = asyncio.ensure_future(flight.do('a', _call(calls, 1)))
+    second = asyncio.ensure_future(flight.do('a', _call(calls, 2)))
+    await asyncio.sleep(0)
+    first.cancel()
+    assert await second == 1
+
+    only = asyncio.ensure_future(flight.do('a', _call(calls, 3)))
+    await asyncio.sleep(0)
+    task = flight._calls['a'].task
+    only.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await only
+    assert len(flight) == 0
+    await asyncio.sleep(0)
+    assert task.cancelled()
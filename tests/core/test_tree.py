@@ -0,0 +1,89 @@
+"""Test module for the server side tree assembly."""
+
+from datetime import datetime, timezone
+
+from tree import build_tree, build_window, flat_tree
+
+
+def _row(entity_type, entity_id, parent_type=None, parent_id=None, minute=0):
+    date = datetime(2018, 1, 1, 0, minute, tzinfo=timezone.utc)
+    return {
+        'type': entity_type, 'id': entity_id, 'creator': 'user1',
+        'date_created': date, 'date_last_modified': date,
+        'text': '{} {}'.format(entity_type, entity_id),
+        'parent_type': parent_type, 'parent_id': parent_id,
+        'direct_reply_count': 0, 'descendant_count': 0,
+    }
+
+
+ROWS = [
+    _row('post', 1),
+    _row('comment', 1, 'post', 1, 1),
+    _row('comment', 2, 'post', 1, 2),
+    _row('comment', 3, 'comment', 1, 3),
+    _row('comment', 4, 'post', 1, 4),
+]
+
+
+def test_build_tree():
+    """Test that rows are nested by parents keeping the order of rows."""
+    roots = build_tree(ROWS)
+    assert [(r['type'], r['id']) for r in roots] == [('post', 1)]
+    assert [c['id'] for c in roots[0]['children']] == [1, 2, 4]
+    assert [c['id'] for c in roots[0]['children'][0]['children']] == [3]
+    assert roots[0]['date_created'] == '2018-01-01T00:00:00+00:00'
+
+
+def test_build_tree_same_ids_of_different_types():
+    """Test that post 1 and comment 1 are different nodes."""
+    roots = build_tree(ROWS)
+    assert roots[0]['children'][0]['type'] == 'comment'
+    assert roots[0]['children'][0]['id'] == 1
+
+
+def test_build_tree_subtree_roots():
+    """Test that rows without a parent among rows become roots."""
+    roots = build_tree(ROWS[1:])
+    assert [r['id'] for r in roots] == [1, 2, 4]
+
+
+def test_build_tree_limits():
+    """Test that depth and fan-out limits cut the tree and report cut children."""
+    root, = build_tree(ROWS, max_depth=1, max_children=2)
+    assert [c['id'] for c in root['children']] == [1, 2]
+    assert root['more_children'] == 1
+    assert root['children'][0]['children'] == []
+    assert root['children'][0]['more_children'] == 1
+
+
+def _window_row(comment_id, parent_type, parent_id, depth, rank, replies=0):
+    row = _row('comment', comment_id, parent_type, parent_id, comment_id)
+    row.update(depth=depth, rank=rank, direct_reply_count=replies)
+    return row
+
+
+def test_build_window():
+    """Test that cut children and replies beyond the depth get continuation tokens."""
+    rows = [
+        _window_row(1, 'post', 1, 1, 1, replies=3),
+        _window_row(2, 'post', 1, 1, 2, replies=1),
+        _window_row(3, 'post', 1, 1, 3),
+        _window_row(4, 'comment', 1, 2, 1),
+        _window_row(5, 'comment', 1, 2, 2),
+        _window_row(6, 'comment', 1, 2, 3),
+        _window_row(7, 'comment', 2, 2, 1, replies=2),
+    ]
+    window = build_window(rows, 2, 2, lambda t, i, last: (t, i, last and last['id']), convert=None)
+    first, second = window['comments']
+    assert window['more'] == ('post', 1, 2)
+    assert [c['id'] for c in first['children']] == [4, 5]
+    assert first['more'] == ('comment', 1, 5)
+    assert second['more'] is None
+    assert second['children'][0]['more'] == ('comment', 7, None)
+
+
+def test_flat_tree():
+    """Test that flat encoding keeps rows as lists in columns order."""
+    tree = flat_tree(ROWS[:2])
+    assert tree['columns'][:2] == ['type', 'id']
+    assert tree['rows'][1][:2] == ['comment', 1]
@@ -4,7 +4,10 @@ Test module for views, checks the right data passed to the user.
 TODO: DB calls should be mocked here.
 """
 
+import asyncio
+
 import pytest
+import metrics
 
 
 @pytest.mark.asyncio
@@ -15,3 +18,99 @@ async def test_index(test_client, comments_app):
     assert resp.status == 200
     text = await resp.text()
     assert 'API:' in text
+
+
+@pytest.mark.asyncio
+async def test_metrics(test_client, comments_app):
+    """Test that requests are recorded and exposed in Prometheus format."""
+    client = await test_client(comments_app)
+    await client.get('/cache_stats')
+    await client.get('/no/such/page')
+    resp = await client.get('/metrics')
+    assert resp.status == 200
+    assert resp.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    text = await resp.text()
+    assert 'http_request_duration_seconds_count{route="/cache_stats",method="GET",status="200"}' in text
+    assert 'route="unmatched",method="GET",status="404"' in text
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('path', [
+    '/user1/get_full_tree?root_type=post&root_id=1',
+    '/user1/get_children?entity_id=1',
+    '/user1/lvl1?entity_type=post&entity_id=1',
+])
+async def test_conditional_get(test_client, comments_app, init_a_few_db_entries, path):
+    """Test that unchanged trees are answered by 304 and changed ones are sent."""
+    client = await test_client(comments_app)
+    resp = await client.get(path)
+    assert resp.status == 200
+    etag = resp.headers['ETag']
+    last_modified = resp.headers['Last-Modified']
+
+    resp = await client.get(path, headers={'If-None-Match': etag})
+    assert resp.status == 304
+    assert resp.headers['ETag'] == etag
+    resp = await client.get(path, headers={'If-Modified-Since': last_modified})
+    assert resp.status == 304
+
+    await client.post('/user2/create_comment', data={
+        'text': 'reply', 'entity_type': 'comment', 'entity_id': '3'})
+    resp = await client.get(path, headers={'If-None-Match': etag})
+    assert resp.status == 200
+    assert resp.headers['ETag'] != etag
+
+
+@pytest.mark.asyncio
+async def test_coalesced_tree_reads(test_client, comments_app, init_a_few_db_entries):
+    """Test that concurrent reads of a tree share a query."""
+    client = await test_client(comments_app)
+    calls = metrics.SINGLE_FLIGHT_CALLS._values.get(('tree',), 0)
+    responses = await asyncio.gather(*[
+        client.get('/user1/get_full_tree?root_type=post&root_id=1') for _ in range(10)])
+    assert [resp.status for resp in responses] == [200] * 10
+    assert len({await resp.read() for resp in responses}) == 1
+    assert metrics.SINGLE_FLIGHT_CALLS._values[('tree',)] - calls < 10
+
+
+@pytest.mark.asyncio
+async def test_get_tree_window(test_client, comments_app, init_a_few_db_entries):
+    """Test that cut branches are loaded by their continuation tokens."""
+    client = await test_client(comments_app)
+    for text in ('b', 'c'):
+        await client.post('/user2/create_comment', data={
+            'text': text, 'entity_type': 'comment', 'entity_id': '1'})
+    resp = await client.get('/user1/get_tree_window?root_type=post&root_id=1&max_depth=1')
+    assert resp.status == 200
+    window = await resp.json()
+    first, = window['comments']
+    assert (first['id'], first['children'], window['more']) == (1, [], None)
+
+    resp = await client.get('/user1/get_tree_window', params={'more': first['more'], 'max_children': '2'})
+    window = await resp.json()
+    assert [c['text'] for c in window['comments']] == ['dima commented some comment', 'b']
+    resp = await client.get('/user1/get_tree_window', params={'more': window['more']})
+    window = await resp.json()
+    assert [c['text'] for c in window['comments']] == ['c']
+    assert window['more'] is None
+
+    resp = await client.get('/user1/get_tree_window?root_type=post&root_id=1&sort=random')
+    assert resp.status == 400
+    resp = await client.get('/user1/get_tree_window?more=broken')
+    assert resp.status == 400
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('comments', [
+    [{'text': 'self', 'ref': 'a', 'parent_ref': 'a'}],
+    [{'text': 'a', 'ref': 'a', 'parent_ref': 'b'}, {'text': 'b', 'ref': 'b', 'parent_ref': 'a'}],
+    [{'text': 'unknown', 'parent_ref': 'c'}],
+    [{'text': 'unhashable', 'ref': ['a'], 'entity_type': 'post', 'entity_id': 1}],
+])
+async def test_create_comments_invalid_refs(test_client, comments_app, init_a_few_db_entries, comments):
+    """Test that refs which can't form a tree are a bad request and nothing is created."""
+    client = await test_client(comments_app)
+    resp = await client.post('/user3/create_comments', json={'comments': comments})
+    assert resp.status == 400
+    resp = await client.get('/user3/get_comments')
+    assert resp.status == 404